@@ -7,73 +7,409 @@ import math
 import numpy as np
 import sys
 import os
-import pickle
-import gzip
+import glob
+import shutil
+import multiprocessing
 from timeit import default_timer as timer
+import lattice_archive
+import instrumentation
 
-#if False it prints only error messages, if True it writes what it is doing at the moment and the intermediate results 
+#if False it prints only error messages, if True it writes what it is doing at the moment and the intermediate results
 verbose=True
 
-if(verbose):
-    init_start=timer()
-
-#we parse the command line arguments
-N_input_args=len(sys.argv)-1
-
-if(N_input_args<2):
-   print ('Syntax: pythone3 combine_processed_thermodynamic_lattice_output_smash.py <file data 1> [data 2] ... <outputfile>')
-   print ("where:")
-   print ("file data 1,2,3...N are the pickled files produced by preprocess_thermodynamic_lattice_output_smash.py")
-   print ("outputfile is obviously the name of the output file with the results of the postprocessing")
-   sys.exit(1)
-
-#we get the name of input and output files
-inputfiles=sys.argv[1:N_input_args]
-n_input=len(inputfiles)
-outputfile=sys.argv[N_input_args]
-
-for n_i, infile in enumerate(inputfiles):
-    if(infile[-3:]==".gz"):
-       if(verbose):
-           print("Opening gzipped file "+infile)
-       pi=gzip.open(infile,"rb")
-    else:
+#number of processes summing the timesteps, it can be changed with the --workers option
+workers=1
+
+#if True the inputs are added to the sums already stored in the output archive, it can be changed with the --append option
+append=False
+
+#how the timesteps of the inputs are combined, it can be changed with the --align option:
+#strict: all the inputs must have the same timesteps
+#common: only the timesteps present in all the inputs are kept
+#union: all the timesteps are kept, each of them with the number of events of the inputs containing it
+alignment="strict"
+
+#codec used to compress the output archive (None = not compressed), it can be changed with the --compress option
+compression=None
+
+#file where the statistics about the run (time spent in each stage, bytes read, peak memory) are written in json format
+#(None = no statistics), it can be changed with the --stats option
+stats_file=None
+
+def read_manifest(infile):
+    #it returns the list of the files whose events are included in an input file
+    #the older archives and the pickled files do not have a manifest, so they are identified by their own path
+    if(lattice_archive.is_archive(infile)):
+        entries=lattice_archive.read_archive(infile,"lattice")
+        if("manifest" in entries):
+            return entries["manifest"]
+        return [{"file":os.path.realpath(infile),"N_events":entries["N_events"]}]
+    return [{"file":os.path.realpath(infile)}]
+
+def open_inputs(inputfiles,outputfile,axes=None):
+    #it opens all the input files and it checks that they are compatible
+    #the arrays are presented with their axes in the order axes (by default the order of the first file), see lattice_archive.native_axes,
+    #so that files written before and after the change of the order of the cells can be combined
+    #the arrays of the archives are memory mapped, so at this stage they are not read yet,
+    #while the older pickled files are loaded entirely in memory (they can be converted into archives by running this script with just one input file)
+    #it returns the lattice of the first file, the total number of events, a list with the timesteps,
+    #the number of events at each timestep and the arrays of each input
+    #and the manifest, i.e. the list of the files whose events are included, with their number of events
+    #the archives produced by the preprocessor or by this script have their own manifest, which replaces them in the list
+    inputs=[]
+    manifest=[]
+    for n_i, infile in enumerate(inputfiles):
+        if((outputfile is not None) and (os.path.realpath(infile)==os.path.realpath(outputfile))):
+            print("Error, the output archive "+outputfile+" is also among the input files.\nI quit.")
+            sys.exit(2)
         if(verbose):
-             print("Opening file "+infile)
-        pi=open(infile,"rb")
+            print("Opening "+infile)
+        lattice,tt,N_file_events,T_arr,jQBS_arr,v_arr,M2_arr,file_manifest,N_t = lattice_archive.load(infile,"lattice",extra=("M2","manifest","N_events_t"),lazy=True)
+        if(file_manifest is None):
+            file_manifest=[{"file":os.path.realpath(infile),"N_events":N_file_events}]
+        included=[entry["file"] for entry in manifest]
+        for entry in file_manifest:
+            if(entry["file"] in included):
+                print("Error in file "+infile+": the events of "+entry["file"]+" are already included in the previous input files.\nI quit.")
+                sys.exit(2)
+        manifest=manifest+file_manifest
+        #the archives combined with --align union store the number of events at each timestep, the others have the same number at all timesteps
+        if(N_t is None):
+            N_t=[N_file_events]*len(tt)
 
-    indata=pickle.load(pi)
-    pi.close()
-    lattice,tt,N_file_events,T_arr,jQBS_arr,v_arr = indata[:]
+        if(n_i==0):
+            if(axes is None):
+                axes=lattice_archive.field_axes(lattice)
+        T_arr,jQBS_arr,v_arr,M2_arr=[lattice_archive.with_axes(lattice,arr,axes) for arr in (T_arr,jQBS_arr,v_arr,M2_arr)]
 
-    if (verbose):
-        print("Adding "+str(N_file_events)+" events")
-    if(n_i==0):
-        lattice_ref=lattice
-        tt_ref=tt
-        nt=len(tt)
-        Tmunu=T_arr.copy()
-        jQBS=jQBS_arr.copy()
-        v=v_arr.copy()
-        N_events=N_file_events
+        if(n_i==0):
+            lattice_ref=lattice
+            lattice_ref["axes"]=list(axes)
+            T_ref,jQBS_ref,v_ref,M2_ref=T_arr,jQBS_arr,v_arr,M2_arr
+            N_events=N_file_events
+        else:
+            if(not np.array_equal(lattice_ref["dimensions"],lattice["dimensions"])):
+                print("Error in file "+infile+": different lattice dimensions. Until now: "+str(lattice_ref["dimensions"])+", this time: "+str(lattice["dimensions"])+".\nI quit.")
+                sys.exit(2)
+            if(not np.array_equal(lattice_ref["spacing"],lattice["spacing"])):
+                print("Error in file "+infile+": different lattice spacing. Until now: "+str(lattice_ref["spacing"])+", this time: "+str(lattice["spacing"])+".\nI quit.")
+                sys.exit(2)
+            if(not np.array_equal(lattice_ref["origin"],lattice["origin"])):
+                print("Error in file "+infile+": different lattice origin. Until now: "+str(lattice_ref["origin"])+", this time: "+str(lattice["origin"])+".\nI quit.")
+                sys.exit(2)
+            #archives written before the introduction of the --components option of the preprocessor do not have this entry
+            if((lattice_ref.get("components",lattice.get("components"))!=lattice.get("components",lattice_ref.get("components"))) or (T_ref.shape[1:]!=T_arr.shape[1:]) or (jQBS_ref.shape[1:]!=jQBS_arr.shape[1:]) or (v_ref.shape[1:]!=v_arr.shape[1:])):
+                print("Error in file "+infile+": different stored components. Until now: "+str(lattice_ref.get("components"))+", this time: "+str(lattice.get("components"))+".\nI quit.")
+                sys.exit(2)
+            if((lattice_ref.get("moments")!=lattice.get("moments")) or ((M2_ref is None)!=(M2_arr is None))):
+                print("Error in file "+infile+": different components with second moments. Until now: "+str(lattice_ref.get("moments"))+", this time: "+str(lattice.get("moments"))+".\nI quit.")
+                sys.exit(2)
+            N_events=N_events+N_file_events
+        if (verbose):
+            print("Adding "+str(N_file_events)+" events")
+        inputs.append((list(tt),N_t,T_arr,jQBS_arr,v_arr,M2_arr))
+    return lattice_ref,N_events,inputs,manifest
+
+def align_inputs(inputfiles,inputs,fixed_tt=None):
+    #it chooses the output timesteps according to the alignment option, or it uses fixed_tt if it is not None
+    #it returns the output timesteps, the number of events at each of them and, for each input, the index of its timestep
+    #corresponding to each output timestep (-1 if missing) and its number of events at each output timestep (0 if missing)
+    #the inputs are not padded, the missing timesteps are just skipped when summing
+    input_tt=[tt for tt,N_t,T_arr,jQBS_arr,v_arr,M2_arr in inputs]
+    if(fixed_tt is not None):
+        tt_out=list(fixed_tt)
+    elif(alignment=="strict"):
+        tt_out=list(input_tt[0])
+    elif(alignment=="common"):
+        input_sets=[set(tt) for tt in input_tt[1:]]
+        tt_out=[t for t in input_tt[0] if all(t in times for times in input_sets)]
     else:
-        if(not np.array_equal(lattice_ref["dimensions"],lattice["dimensions"])):
-            print("Error in file "+infile+": different lattice dimensions. Until now: "+str(lattice_ref["dimensions"])+", this time: "+str(lattice["dimensions"])+".\nI quit.")
-            sys.exit(2)
-        if(not np.array_equal(lattice_ref["spacing"],lattice["spacing"])):
-            print("Error in file "+infile+": different lattice spacing. Until now: "+str(lattice_ref["spacing"])+", this time: "+str(lattice["spacing"])+".\nI quit.")
+        tt_out=sorted(set().union(*input_tt))
+    if(len(tt_out)==0):
+        print("Error, the input files do not have any timestep in common.\nI quit.")
+        sys.exit(2)
+    output_set=set(tt_out)
+    N_events_t=np.zeros(len(tt_out),dtype=np.int64)
+    alignments=[]
+    for infile,(tt,N_t,T_arr,jQBS_arr,v_arr,M2_arr) in zip(inputfiles,inputs):
+        if((alignment=="strict") and (tt!=tt_out)):
+            print("Error in file "+infile+": different timesteps. Until now: "+str(tt_out)+", this time: "+str(tt)+".")
+            print("The options --align common or --align union allow to combine files with different timesteps.\nI quit.")
             sys.exit(2)
-        if(not np.array_equal(lattice_ref["origin"],lattice["origin"])):
-            print("Error in file "+infile+": different lattice origin. Until now: "+str(lattice_ref["origin"])+", this time: "+str(lattice["origin"])+".\nI quit.")
+        if((alignment=="union") and any(t not in output_set for t in tt)):
+            print("Error in file "+infile+": its timesteps "+str([t for t in tt if t not in output_set])+" are not present in the output archive.\nI quit.")
             sys.exit(2)
+        position={t:i for i,t in enumerate(tt)}
+        index=np.array([position.get(t,-1) for t in tt_out],dtype=np.int64)
+        counts=np.where(index>=0,np.array(N_t,dtype=np.int64)[index],0)
+        N_events_t+=counts
+        alignments.append((index,counts))
+    return tt_out,N_events_t,alignments
+
+def init_worker(inputfiles,outputfile,field_dtypes,alignments,codec,axes):
+    #the worker processes open again the inputs (the checks have already been done by the main process)
+    #and, if the output is not compressed, the output fields created by the main process
+    #in append mode the first input is the archive being updated and outputfile is its staging copy
+    #if something goes wrong inputs is None, the error is reported by combine_timesteps (an exception here would make the pool restart the worker forever)
+    global verbose, lattice_ref, inputs, out_fields, out_dtypes, compression
+    verbose=False
+    inputs=None
+    compression=codec
+    out_dtypes=field_dtypes
+    try:
+        if(compression is None):
+            out_fields={name:lattice_archive.open_field(outputfile,name,"r+") for name in field_dtypes}
+        lattice_ref,N_events,opened,manifest=open_inputs(inputfiles,outputfile,axes)
+        inputs=[alignment_data+(T_arr,jQBS_arr,v_arr,M2_arr) for alignment_data,(tt,N_t,T_arr,jQBS_arr,v_arr,M2_arr) in zip(alignments,opened)]
+    except SystemExit:
+        inputs=None
+
+def combine_timestep(h):
+    #it returns a dictionary with the sums over all the inputs containing the timestep h of Tmunu, jQBS, v and, if present, M2
+    index,counts,T_ref,jQBS_ref,v_ref,M2_ref=inputs[0]
+    T_sum=np.zeros(T_ref.shape[1:],dtype=np.float64)
+    jQBS_sum=np.zeros(jQBS_ref.shape[1:],dtype=np.float64)
+    v_sum=np.zeros(v_ref.shape[1:],dtype=np.float64)
+    sums={"Tmunu":T_sum,"jQBS":jQBS_sum,"v":v_sum}
+    if(M2_ref is not None):
+        M2_sum=sums["M2"]=np.zeros(M2_ref.shape[1:],dtype=np.float64)
+    N_sum=0
+    for index,counts,T_arr,jQBS_arr,v_arr,M2_arr in inputs:
+        i=index[h]
+        if(i<0):
+            continue
+        #the timestep is read from the disk (and decompressed) before summing it, so that the two stages are measured separately
+        with instrumentation.stage("read"):
+            T_i=np.array(T_arr[i])
+            jQBS_i=np.array(jQBS_arr[i])
+            v_i=np.array(v_arr[i])
+            if(M2_ref is not None):
+                M2_i=np.array(M2_arr[i])
+        instrumentation.add("bytes_read",T_i.nbytes+jQBS_i.nbytes+v_i.nbytes+(M2_i.nbytes if M2_ref is not None else 0))
+        with instrumentation.stage("accumulate"):
+            if(M2_ref is not None):
+                if(N_sum==0):
+                    M2_sum+=M2_i
+                else:
+                    #the second moments must be merged before adding the sums
+                    lattice_archive.merge_moments(M2_sum,lattice_archive.moment_values(lattice_ref,T_sum,jQBS_sum,v_sum),N_sum,\
+                                                  M2_i,lattice_archive.moment_values(lattice_ref,T_i,jQBS_i,v_i),counts[h])
+            T_sum+=T_i
+            jQBS_sum+=jQBS_i
+            v_sum+=v_i
+        N_sum=N_sum+counts[h]
+    instrumentation.add("timesteps",1)
+    return sums
+
+def combine_timesteps(time_range):
+    #entry point of the worker processes, it sums the timesteps hmin<=h<hmax
+    #if the output is not compressed they are written directly in the output archive,
+    #otherwise they form a block, which is compressed and returned to the main process
+    #it returns the range of timesteps, the compressed block (None if the output is not compressed) and the measurements of the instrumentation
+    #in case of errors it returns None (the message has already been printed)
+    hmin, hmax = time_range
+    if(inputs is None):
+        return None
+    instrumentation.reset()
+    try:
+        if(compression is None):
+            for h in range(hmin,hmax):
+                for name, values in combine_timestep(h).items():
+                    with instrumentation.stage("write"):
+                        out_fields[name][h]=values
+            with instrumentation.stage("write"):
+                for arr in out_fields.values():
+                    arr.flush()
+            return time_range, None, instrumentation.snapshot()
+        else:
+            block={}
+            timesteps=[combine_timestep(h) for h in range(hmin,hmax)]
+            for name, dtype in out_dtypes.items():
+                block[name]=lattice_archive.compress_block(compression,np.array([sums[name] for sums in timesteps],dtype=dtype).tobytes())
+            return time_range, block, instrumentation.snapshot()
+    except SystemExit:
+        return None
+
+
+if __name__ == "__main__":
+
+    if(verbose):
+        init_start=timer()
+
+    #we parse the command line arguments
+    input_args=[]
+    arg_index=1
+    while(arg_index<len(sys.argv)):
+        if((sys.argv[arg_index]=="--workers") and (arg_index+1<len(sys.argv))):
+            workers=int(sys.argv[arg_index+1])
+            arg_index=arg_index+2
+        elif(sys.argv[arg_index]=="--append"):
+            append=True
+            arg_index=arg_index+1
+        elif((sys.argv[arg_index]=="--compress") and (arg_index+1<len(sys.argv))):
+            compression=sys.argv[arg_index+1]
+            lattice_archive.check_codec(compression)
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--stats") and (arg_index+1<len(sys.argv))):
+            stats_file=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--align") and (arg_index+1<len(sys.argv))):
+            alignment=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        else:
+            input_args.append(sys.argv[arg_index])
+            arg_index=arg_index+1
+    N_input_args=len(input_args)
+
+    if((N_input_args<2) or (workers<1) or (alignment not in ("strict","common","union")) or (append and ((alignment=="common") or (compression is not None)))):
+       print ('Syntax: pythone3 combine_processed_thermodynamic_lattice_output_smash.py [--workers N] [--append] [--align strict|common|union] [--compress codec] [--stats <json file>] <file data 1> [data 2] ... <outputfile>')
+       print ("where:")
+       print ("file data 1,2,3...N are the archives produced by preprocess_thermodynamic_lattice_output_smash.py (or the older pickled files)")
+       print ("outputfile is the name of the output archive (a directory) with the results of the postprocessing")
+       print ("--workers N (optional) splits the timesteps among N parallel processes (default: 1)")
+       print ("--append (optional) adds the input files to the sums already stored in the archive outputfile,")
+       print ("         the input files already included in outputfile according to its manifest are skipped")
+       print ("         the new sums are written in a copy of outputfile, which replaces it only at the end of the run")
+       print ("--align (optional) chooses how to combine files with different timesteps:")
+       print ("        strict (default) all the files must have the same timesteps")
+       print ("        common keeps only the timesteps present in all the files (not allowed with --append)")
+       print ("        union keeps all the timesteps, storing the number of events at each of them in N_events_t")
+       print ("        (with --append the timesteps of the input files must be among those of outputfile)")
+       print ("--compress codec (optional) stores the output fields compressed with codec, chosen among: "+", ".join(lattice_archive.codecs))
+       print ("         (not allowed with --append, the compressed archives cannot be modified in place)")
+       print ("--stats <json file> (optional) prints the time spent reading, summing and writing the data, the bytes read and the peak memory")
+       print ("         and it writes them in <json file>")
+       sys.exit(1)
+
+    #we get the name of input and output files
+    inputfiles=input_args[0:N_input_args-1]
+    n_input=len(inputfiles)
+    outputfile=input_args[N_input_args-1]
+
+    if(append):
+        if(not lattice_archive.is_archive(outputfile)):
+            print("Error, "+outputfile+" is not an archive, I cannot append the new events to it.\nI quit.")
             sys.exit(2)
-        N_events=N_events+N_file_events
-        Tmunu=Tmunu+T_arr
-        jQBS=jQBS+jQBS_arr
-        v=v+v_arr
+        included=[entry["file"] for entry in read_manifest(outputfile)]
+        new_inputfiles=[]
+        for infile in inputfiles:
+            files=[entry["file"] for entry in read_manifest(infile)]
+            n_included=len([f for f in files if f in included])
+            if(n_included==len(files)):
+                print(infile+" is already included in "+outputfile+", I skip it")
+            elif(n_included>0):
+                print("Error, only a part of the events of "+infile+" are already included in "+outputfile+".\nI quit.")
+                sys.exit(2)
+            else:
+                new_inputfiles.append(infile)
+        inputfiles=new_inputfiles
+        if(len(inputfiles)==0):
+            print("There are no new input files, "+outputfile+" is already up to date")
+            sys.exit(0)
+        #the staging copies left by the interrupted appends are removed, outputfile was not modified by them
+        for leftover in glob.glob(outputfile+".*.tmp")+glob.glob(outputfile+".*.old"):
+            if(verbose):
+                print("Removing "+leftover+", left by an interrupted run")
+            shutil.rmtree(leftover)
+        #the output archive is the first input, the other inputs are checked against it
+        #and their timesteps are aligned to the timesteps of the output archive, which cannot change
+        inputfiles=[outputfile]+inputfiles
+        lattice_ref,N_events,opened,manifest=open_inputs(inputfiles,None)
+        tt_ref,N_events_t,alignments=align_inputs(inputfiles,opened,fixed_tt=opened[0][0])
+        #the new sums are written in a staging copy next to outputfile, which replaces it only when complete,
+        #so that if the run is interrupted outputfile still contains the previous sums
+        staging=outputfile+"."+str(os.getpid())+".tmp"
+        tt,N_t,T_ref,jQBS_ref,v_ref,M2_ref=opened[0]
+        out_fields={}
+        for name, arr in (("Tmunu",T_ref),("jQBS",jQBS_ref),("v",v_ref),("M2",M2_ref)):
+            if(arr is not None):
+                out_fields[name]=lattice_archive.new_field(staging,name,arr.shape,arr.dtype)
+    else:
+        #the inputs in the older order of the cells are converted into the order written by the preprocessor
+        lattice_ref,N_events,opened,manifest=open_inputs(inputfiles,outputfile,lattice_archive.native_axes)
+        staging=outputfile
+        tt_ref,N_events_t,alignments=align_inputs(inputfiles,opened)
+        tt,N_t,T_ref,jQBS_ref,v_ref,M2_ref=opened[0]
+
+        #the output arrays are created directly in the output archive and filled one timestep at a time,
+        #so that only the data of a single timestep of each input are in memory at the same time
+        #they have the same type of the input arrays, but the sums are computed in double precision
+        out_dtype=np.result_type(*[T_arr.dtype for tt,N_t,T_arr,jQBS_arr,v_arr,M2_arr in opened])
+        out_shapes={"Tmunu":T_ref.shape,"jQBS":jQBS_ref.shape,"v":v_ref.shape}
+        if(M2_ref is not None):
+            out_shapes["M2"]=M2_ref.shape
+        out_fields={}
+        if(compression is None):
+            for name, shape in out_shapes.items():
+                out_fields[name]=lattice_archive.new_field(outputfile,name,(len(tt_ref),)+shape[1:],out_dtype)
+        else:
+            #the compressed fields are written in blocks with the same number of timesteps, so that the workers can compress whole blocks
+            block_timesteps=min([lattice_archive.timesteps_per_block(shape,out_dtype) for shape in out_shapes.values()])
+            for name, shape in out_shapes.items():
+                out_fields[name]=lattice_archive.new_compressed_field(outputfile,name,(len(tt_ref),)+shape[1:],out_dtype,compression,block_timesteps)
+    nt=len(tt_ref)
+    inputs=[alignment_data+(T_arr,jQBS_arr,v_arr,M2_arr) for alignment_data,(tt,N_t,T_arr,jQBS_arr,v_arr,M2_arr) in zip(alignments,opened)]
+    opened=None
 
+    if((workers>1) and not all(lattice_archive.is_archive(infile) for infile in inputfiles)):
+        #each worker would load again all the pickled files in memory
+        print("The pickled input files cannot be memory mapped, so I sum the timesteps with a single process")
+        workers=1
+
+    if((workers==1) or (nt<2)):
+        for h in range(nt):
+            for name, values in combine_timestep(h).items():
+                with instrumentation.stage("write"):
+                    out_fields[name][h]=values
+            if(verbose):
+                print("Done timestep: "+str(h+1)+", simulation time: "+str(tt_ref[h]))
+    else:
+        if(compression is None):
+            #we split the timesteps in contiguous ranges, each worker sums all the inputs in its ranges and writes them directly in the output archive
+            n_ranges=min(4*workers,nt)
+            bounds=np.linspace(0,nt,n_ranges+1).astype(int)
+        else:
+            #each range is a block of the compressed fields, which is compressed by the worker and written by the main process
+            bounds=list(range(0,nt,block_timesteps))+[nt]
+            n_ranges=len(bounds)-1
+        n_proc=min(workers,n_ranges)
+        time_ranges=[(int(bounds[r]),int(bounds[r+1])) for r in range(n_ranges)]
+        if(verbose):
+            print("Summing "+str(nt)+" timesteps with "+str(n_proc)+" processes")
+        field_dtypes={name:np.dtype(arr.dtype).str for name,arr in out_fields.items()}
+        with multiprocessing.Pool(n_proc,initializer=init_worker,initargs=(inputfiles,staging,field_dtypes,alignments,compression,lattice_archive.field_axes(lattice_ref))) as pool:
+            if(compression is None):
+                results=pool.imap_unordered(combine_timesteps,time_ranges)
+            else:
+                #the blocks must be written in order
+                results=pool.imap(combine_timesteps,time_ranges)
+            for result in results:
+                if(result is None):
+                    sys.exit(2)
+                time_range, block, measurements = result
+                instrumentation.merge(measurements)
+                if(block is not None):
+                    with instrumentation.stage("write"):
+                        for name, data in block.items():
+                            out_fields[name].add_compressed_block(data,time_range[1]-time_range[0])
+                if(verbose):
+                    print("Done timesteps from "+str(tt_ref[time_range[0]])+" to "+str(tt_ref[time_range[1]-1]))
+
+    if (verbose):
+        print ("Writing output file "+outputfile+" based on "+str(N_events)+" events")
+    metadata={"lattice":lattice_ref,"tt":tt_ref,"N_events":N_events,"manifest":manifest}
+    if(np.any(N_events_t!=N_events)):
+        #not all the events contain all the timesteps, the averages must be computed with the number of events at each timestep
+        metadata["N_events_t"]=N_events_t
+    with instrumentation.stage("write"):
+        lattice_archive.write_archive(staging,"lattice",metadata,out_fields)
+        if(staging!=outputfile):
+            #the previous archive is moved away and removed only after the complete staging copy has taken its place
+            previous=outputfile+"."+str(os.getpid())+".old"
+            os.replace(outputfile,previous)
+            os.replace(staging,outputfile)
+            shutil.rmtree(previous)
+    instrumentation.add("events",N_events)
 
-if (verbose):
-    print ("Writing output file "+outputfile+" based on "+str(N_events)+" events")
-with open(outputfile,"wb") as po:
-    pickle.dump((lattice,tt,N_events,Tmunu,jQBS,v),po)
+    if(stats_file is not None):
+        instrumentation.report("combine_processed_thermodynamic_lattice_output_smash.py",stats_file)
@@ -10,10 +10,10 @@ import numpy as np
 import sys
 import os
 import os.path
-import pickle
 import gzip
 from itertools import islice
 from datetime import datetime
+import lattice_archive
 
 #it decides if we use the chemical (True) or kinetic freezeout data (False)
 use_chem_fo_data=True
@@ -35,7 +35,7 @@ nlines=2000000
 N_input_files=len(sys.argv)-1
 
 if(N_input_files!=3):
-   print ('Syntax: python3 compute_mean_spin_smash.py <vorticity pickled file> <hadron_data_inputfile> <outputfile>')
+   print ('Syntax: python3 compute_mean_spin_smash.py <vorticity archive> <hadron_data_inputfile> <outputfile>')
    sys.exit(1)
 
 vorfile=sys.argv[1]
@@ -44,17 +44,8 @@ outfilename=sys.argv[3]
 
 datas=np.zeros((nlines,9),dtype=np.float64) #one multidimensional np array for hadrons with fields: t,x,y,z,pt,rapidity,Sx,Sy,Sz,Py
 
-if(vorfile[-3:]==".gz"):
-    print("Opening gzipped file "+vorfile)
-    vf=gzip.open(vorfile,"rb")
-else:
-    print("Opening file "+vorfile)
-    vf=open(vorfile,"rb")
-     
-data=pickle.load(vf)
-vf.close()
-
-intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=data[:]
+print("Opening "+vorfile)
+intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=lattice_archive.load(vorfile,"vorticity")
 
 dt=intt[1]-intt[0]
 dx=inxx[1]-inxx[0]
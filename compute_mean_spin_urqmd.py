@@ -6,10 +6,10 @@ import numpy as np
 import sys
 import os
 import os.path
-import pickle
 import gzip
 from itertools import islice
 from datetime import datetime
+import lattice_archive
 
 
 ids=[27,40] #urqmd itypes
@@ -38,7 +38,7 @@ avg_exc=np.zeros(len(ids),dtype=np.float64) #averages excluding the entry if its
 N_input_files=len(sys.argv)-1
 
 if(N_input_files!=2):
-   print ('Syntax: python3 compute_mean_spin_urqmd.py <vorticity pickled file> <hadron_data_inputfile>')
+   print ('Syntax: python3 compute_mean_spin_urqmd.py <vorticity archive> <hadron_data_inputfile>')
    sys.exit(1)
 
 vorfile=sys.argv[1]
@@ -52,17 +52,8 @@ for i,n in enumerate(names,0):
     datas.append(np.zeros((nlines,10),dtype=np.float64)) #one multidimensional np array for hadrons with fields: t,x,y,z,pt,rapidity,Sx,Sy,Sz,omega_zx
     ind.append(0) #counter for the accepted hadrons of the various kinds
 
-if(vorfile[-3:]==".gz"):
-    print("Opening gzipped file "+vorfile)
-    vf=gzip.open(vorfile,"rb")
-else:
-    print("Opening file "+vorfile)
-    vf=open(vorfile,"rb")
-     
-data=pickle.load(vf)
-vf.close()
-
-intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=data[:]
+print("Opening "+vorfile)
+intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=lattice_archive.load(vorfile,"vorticity")
 
 dt=intt[1]-intt[0]
 dx=inxx[1]-inxx[0]
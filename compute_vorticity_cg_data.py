@@ -12,6 +12,9 @@ import os
 import pickle
 import gzip
 from scipy.interpolate import interpn
+import lattice_archive
+import instrumentation
+import finite_differences
 
 """It computes the vorticity from the data produced by store_cg.py (v. 2.1), also if gzipped."""
 
@@ -22,6 +25,10 @@ der_type = 2 #1 = numpy derivatives, 2 = 2nd order centered differences with 1st
 
 temp_limit = 0.0005 # temperature limit to accept a cell in GeV for derivative computation
 
+compression = None # codec used to compress the output archives (e.g. "gzip" or "zstd"), None = not compressed
+
+stats_file = None # json file with the time spent in each stage and the peak memory (None = no statistics), it can be changed with the --stats option
+
 #we set the parameter hbarc
 hbarc=0.197326
 
@@ -30,14 +37,18 @@ enable_smooth=True
 
 
 #we get the name of input and output files
-N_input_files=len(sys.argv)-1
+input_args=sys.argv[1:]
+if((len(input_args)>=2) and (input_args[0]=="--stats")):
+   stats_file=input_args[1]
+   input_args=input_args[2:]
+N_input_files=len(input_args)
 
 if(N_input_files!=2):
-   print ('Syntax: python3 compute_vorticity_cg_data.py <inputfile pickled file> <outputfile>')
+   print ('Syntax: python3 compute_vorticity_cg_data.py [--stats <json file>] <inputfile pickled file> <outputfile>')
    sys.exit(1)
 
-inputfile=sys.argv[1]
-outputfile=sys.argv[2]
+inputfile=input_args[0]
+outputfile=input_args[1]
 
 if(inputfile[-3:]==".gz"):
     print("Opening gzipped file "+inputfile)
@@ -61,6 +72,11 @@ nx=len(inxx)
 ny=len(inyy)
 nz=len(inzz)
 
+instrumentation.add("bytes_read",os.path.getsize(inputfile))
+instrumentation.add("timesteps",nt)
+instrumentation.add("cells",nt*nx*ny*nz)
+instrumentation.lap("read")
+
 # this function replaces the value of a cell with the average values of the cells in the surroundig cube
 def smooth_down(array,i,j,k):
     tot=0
@@ -125,6 +141,7 @@ if(enable_smooth):
     by=by_fixed
     bz=bz_fixed
 
+instrumentation.lap("beta")
 
 if der_type == 1:
 
@@ -145,230 +162,26 @@ if der_type == 1:
 
 elif der_type == 2:
 
-    dbt_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((bt[h,0,j,k]!=0) and (bt[h,1,j,k]!=0)):
-                            dbt_dx[h,0,j,k]=(bt[h,1,j,k]-bt[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((bt[h,nx-1,j,k]!=0) and (bt[h,nx-2,j,k]!=0)):
-                            dbt_dx[h,nx-1,j,k]=(bt[h,nx-1,j,k]-bt[h,nx-2,j,k])/dx
-                    elif((bt[h,i-1,j,k]!=0) and (bt[h,i+1,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i+1,j,k]-bt[h,i-1,j,k])/(2*dx)
-                    elif((bt[h,i-1,j,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i,j,k]-bt[h,i-1,j,k])/(dx)
-                    elif((bt[h,i+1,j,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i+1,j,k]-bt[h,i,j,k])/(dx)
-
-    dbt_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bt[h,i,0,k]!=0) and (bt[h,i,1,k]!=0)):
-                            dbt_dy[h,i,0,k]=(bt[h,i,1,k]-bt[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bt[h,i,ny-1,k]!=0) and (bt[h,i,ny-2,k]!=0)):
-                            dbt_dy[h,i,ny-1,k]=(bt[h,i,ny-1,k]-bt[h,i,ny-2,k])/dy
-                    elif((bt[h,i,j-1,k]!=0) and (bt[h,i,j+1,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j+1,k]-bt[h,i,j-1,k])/(2*dy)
-                    elif((bt[h,i,j-1,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j,k]-bt[h,i,j-1,k])/(dy)
-                    elif((bt[h,i,j+1,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j+1,k]-bt[h,i,j,k])/(dy)
-
-    dbt_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((bt[h,i,j,0]!=0) and (bt[h,i,j,1]!=0)):
-                            dbt_dz[h,i,j,0]=(bt[h,i,j,1]-bt[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((bt[h,i,j,nz-1]!=0) and (bt[h,i,j,nz-2]!=0)):
-                            dbt_dz[h,i,j,nz-1]=(bt[h,i,j,nz-1]-bt[h,i,j,nz-2])/dz
-                    elif((bt[h,i,j,k-1]!=0) and (bt[h,i,j,k+1]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k+1]-bt[h,i,j,k-1])/(2*dz)
-                    elif((bt[h,i,j,k-1]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k]-bt[h,i,j,k-1])/(dz)
-                    elif((bt[h,i,j,k+1]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k+1]-bt[h,i,j,k])/(dz)
-
-    dbx_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((bx[0,i,j,k]!=0) and (bx[1,i,j,k]!=0)):
-                            dbx_dt[0,i,j,k]=(bx[1,i,j,k]-bx[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((bx[nt-1,i,j,k]!=0) and (bx[nt-2,i,j,k]!=0)):
-                            dbx_dt[nt-1,i,j,k]=(bx[nt-1,i,j,k]-bx[nt-2,i,j,k])/dt
-                    elif((bx[h-1,i,j,k]!=0) and (bx[h+1,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h+1,i,j,k]-bx[h-1,i,j,k])/(2*dt)
-                    elif((bx[h-1,i,j,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h,i,j,k]-bx[h-1,i,j,k])/(dt)
-                    elif((bx[h+1,i,j,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h+1,i,j,k]-bx[h,i,j,k])/(dt)
-
-
-    dby_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((by[0,i,j,k]!=0) and (by[1,i,j,k]!=0)):
-                            dby_dt[0,i,j,k]=(by[1,i,j,k]-by[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((by[nt-1,i,j,k]!=0) and (by[nt-2,i,j,k]!=0)):
-                            dby_dt[nt-1,i,j,k]=(by[nt-1,i,j,k]-by[nt-2,i,j,k])/dt
-                    elif((by[h-1,i,j,k]!=0) and (by[h+1,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h+1,i,j,k]-by[h-1,i,j,k])/(2*dt)
-                    elif((by[h-1,i,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h,i,j,k]-by[h-1,i,j,k])/(dt)
-                    elif((by[h+1,i,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h+1,i,j,k]-by[h,i,j,k])/(dt)
-
-
-    dbz_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((bz[0,i,j,k]!=0) and (bz[1,i,j,k]!=0)):
-                            dbz_dt[0,i,j,k]=(bz[1,i,j,k]-bz[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((bz[nt-1,i,j,k]!=0) and (bz[nt-2,i,j,k]!=0)):
-                            dbz_dt[nt-1,i,j,k]=(bz[nt-1,i,j,k]-bz[nt-2,i,j,k])/dt
-                    elif((bz[h-1,i,j,k]!=0) and (bz[h+1,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h+1,i,j,k]-bz[h-1,i,j,k])/(2*dt)
-                    elif((bz[h-1,i,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h,i,j,k]-bz[h-1,i,j,k])/(dt)
-                    elif((bz[h+1,i,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h+1,i,j,k]-bz[h,i,j,k])/(dt)
-
-
-    dbx_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bx[h,i,0,k]!=0) and (bx[h,i,1,k]!=0)):
-                            dbx_dy[h,i,0,k]=(bx[h,i,1,k]-bx[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bx[h,i,ny-1,k]!=0) and (bx[h,i,ny-2,k]!=0)):
-                            dbx_dy[h,i,ny-1,k]=(bx[h,i,ny-1,k]-bx[h,i,ny-2,k])/dy
-                    elif((bx[h,i,j-1,k]!=0) and (bx[h,i,j+1,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j+1,k]-bx[h,i,j-1,k])/(2*dy)
-                    elif((bx[h,i,j-1,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j,k]-bx[h,i,j-1,k])/(dy)
-                    elif((bx[h,i,j+1,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j+1,k]-bx[h,i,j,k])/(dy)
-
-
-    dbz_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bz[h,i,0,k]!=0) and (bz[h,i,1,k]!=0)):
-                            dbz_dy[h,i,0,k]=(bz[h,i,1,k]-bz[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bz[h,i,ny-1,k]!=0) and (bz[h,i,ny-2,k]!=0)):
-                            dbz_dy[h,i,ny-1,k]=(bz[h,i,ny-1,k]-bz[h,i,ny-2,k])/dy
-                    elif((bz[h,i,j-1,k]!=0) and (bz[h,i,j+1,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j+1,k]-bz[h,i,j-1,k])/(2*dy)
-                    elif((bz[h,i,j-1,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j,k]-bz[h,i,j-1,k])/(dy)
-                    elif((bz[h,i,j+1,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j+1,k]-bz[h,i,j,k])/(dy)
-
-
-    dby_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((by[h,0,j,k]!=0) and (by[h,1,j,k]!=0)):
-                            dby_dx[h,0,j,k]=(by[h,1,j,k]-by[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((by[h,nx-1,j,k]!=0) and (by[h,nx-2,j,k]!=0)):
-                            dby_dx[h,nx-1,j,k]=(by[h,nx-1,j,k]-by[h,nx-2,j,k])/dx
-                    elif((by[h,i-1,j,k]!=0) and (by[h,i+1,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i+1,j,k]-by[h,i-1,j,k])/(2*dx)
-                    elif((by[h,i-1,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i,j,k]-by[h,i-1,j,k])/(dx)
-                    elif((by[h,i+1,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i+1,j,k]-by[h,i,j,k])/(dx)
-
-    dbz_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((bz[h,0,j,k]!=0) and (bz[h,1,j,k]!=0)):
-                            dbz_dx[h,0,j,k]=(bz[h,1,j,k]-bz[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((bz[h,nx-1,j,k]!=0) and (bz[h,nx-2,j,k]!=0)):
-                            dbz_dx[h,nx-1,j,k]=(bz[h,nx-1,j,k]-bz[h,nx-2,j,k])/dx
-                    elif((bz[h,i-1,j,k]!=0) and (bz[h,i+1,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i+1,j,k]-bz[h,i-1,j,k])/(2*dx)
-                    elif((bz[h,i-1,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i,j,k]-bz[h,i-1,j,k])/(dx)
-                    elif((bz[h,i+1,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i+1,j,k]-bz[h,i,j,k])/(dx)
-
-    dby_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((by[h,i,j,0]!=0) and (by[h,i,j,1]!=0)):
-                            dby_dz[h,i,j,0]=(by[h,i,j,1]-by[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((by[h,i,j,nz-1]!=0) and (by[h,i,j,nz-2]!=0)):
-                            dby_dz[h,i,j,nz-1]=(by[h,i,j,nz-1]-by[h,i,j,nz-2])/dz
-                    elif((by[h,i,j,k-1]!=0) and (by[h,i,j,k+1]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k+1]-by[h,i,j,k-1])/(2*dz)
-                    elif((by[h,i,j,k-1]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k]-by[h,i,j,k-1])/(dz)
-                    elif((by[h,i,j,k+1]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k+1]-by[h,i,j,k])/(dz)
-
-    dbx_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((bx[h,i,j,0]!=0) and (bx[h,i,j,1]!=0)):
-                            dbx_dz[h,i,j,0]=(bx[h,i,j,1]-bx[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((bx[h,i,j,nz-1]!=0) and (bx[h,i,j,nz-2]!=0)):
-                            dbx_dz[h,i,j,nz-1]=(bx[h,i,j,nz-1]-bx[h,i,j,nz-2])/dz
-                    elif((bx[h,i,j,k-1]!=0) and (bx[h,i,j,k+1]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k+1]-bx[h,i,j,k-1])/(2*dz)
-                    elif((bx[h,i,j,k-1]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k]-bx[h,i,j,k-1])/(dz)
-                    elif((bx[h,i,j,k+1]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k+1]-bx[h,i,j,k])/(dz)
+    #see finite_differences.py for the treatment of the empty cells and of the borders
+    dbt_dx=finite_differences.masked_gradient(bt,dx,1)
+    dbt_dy=finite_differences.masked_gradient(bt,dy,2)
+    dbt_dz=finite_differences.masked_gradient(bt,dz,3)
+    dbx_dt=finite_differences.masked_gradient(bx,dt,0)
+    dby_dt=finite_differences.masked_gradient(by,dt,0)
+    dbz_dt=finite_differences.masked_gradient(bz,dt,0)
+
+    dbx_dy=finite_differences.masked_gradient(bx,dy,2)
+    dbz_dy=finite_differences.masked_gradient(bz,dy,2)
+    dby_dx=finite_differences.masked_gradient(by,dx,1)
+    dbz_dx=finite_differences.masked_gradient(bz,dx,1)
+    dby_dz=finite_differences.masked_gradient(by,dz,3)
+    dbx_dz=finite_differences.masked_gradient(bx,dz,3)
 else:
     print("Error, method to compute derivative unknown...")
     sys.exit(2)
 
+instrumentation.lap("derivatives")
+
 omega_tx=0.5*hbarc*(dbt_dx-dbx_dt)
 omega_ty=0.5*hbarc*(dbt_dy-dby_dt)
 omega_tz=0.5*hbarc*(dbt_dz-dbz_dt)
@@ -376,9 +189,11 @@ omega_tz=0.5*hbarc*(dbt_dz-dbz_dt)
 omega_yz=0.5*hbarc*(dby_dz-dbz_dy)
 omega_zx=0.5*hbarc*(dbz_dx-dbx_dz)
 omega_xy=0.5*hbarc*(dbx_dy-dby_dx)
+instrumentation.lap("vorticity")
 
-with open(outputfile,"wb") as po:
-     pickle.dump((intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy),po)
-with open(outputfile+"_gradients","wb") as po:
-     pickle.dump((intt,inxx,inyy,inzz,invx,invy,invz,temp,bt,bx,by,bz,dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy),po)
+lattice_archive.save(outputfile,"vorticity",intt,inxx,inyy,inzz,invx,invy,invz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy,compression=compression)
+lattice_archive.save(outputfile+"_gradients","gradients",intt,inxx,inyy,inzz,invx,invy,invz,temp,bt,bx,by,bz,dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy,compression=compression)
+instrumentation.lap("write")
+if(stats_file is not None):
+    instrumentation.report("compute_vorticity_cg_data.py",stats_file)
 print("All done.")
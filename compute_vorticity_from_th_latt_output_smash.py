@@ -7,9 +7,10 @@ import math
 import numpy as np
 import sys
 import os
-import pickle
-import gzip
-from scipy import interpolate
+import lattice_archive
+import instrumentation
+import finite_differences
+import eos_tables
 
 
 """
@@ -33,31 +34,37 @@ verbose = True # if True it informs about the advancement of the program
 
 temp_limit = 0.001 # temperature limit to accept a cell in GeV
 
+compression = None # codec used to compress the output archives (e.g. "gzip" or "zstd"), None = not compressed
+
+stats_file = None # json file with the time spent in each stage and the peak memory (None = no statistics), it can be changed with the --stats option
+
+slab_timesteps = None # number of timesteps processed together (None = all), the memory needed is proportional to it, it can be changed with the --slab option
+
 #we set the parameter hbarc
 hbarc=0.197326
 
 #we get the name of input and output files
-N_input_files=len(sys.argv)-1
-
-if (N_input_files!=2):
-   print ('Syntax: python3 compute_vorticity_from_th_lattice_output_smash.py <pickled archive file with SMASH data> <outputfile>')
+input_args=sys.argv[1:]
+while ((len(input_args)>=2) and (input_args[0] in ("--stats","--slab"))):
+   if (input_args[0]=="--stats"):
+      stats_file=input_args[1]
+   else:
+      slab_timesteps=int(input_args[1])
+   input_args=input_args[2:]
+N_input_files=len(input_args)
+
+if ((N_input_files!=2) or ((slab_timesteps is not None) and (slab_timesteps<1))):
+   print ('Syntax: python3 compute_vorticity_from_th_lattice_output_smash.py [--stats <json file>] [--slab N] <archive with SMASH data> <outputfile>')
+   print ('--slab N (optional) processes N timesteps at a time, writing them in the output archives before reading the following ones')
    sys.exit(1)
 
-inputfile=sys.argv[1]
-outputfile=sys.argv[2]
+inputfile=input_args[0]
+outputfile=input_args[1]
 
-if (inputfile[-3:]==".gz"):
-    if (verbose):
-       print("Opening gzipped file "+inputfile)
-    pi=gzip.open(inputfile,"rb")
-else:
-    if (verbose):
-       print("Opening file "+inputfile)
-    pi=open(inputfile,"rb")
-
-indata=pickle.load(pi)
-pi.close()
-lattice,tt,N_events,Tmunu,J,v = indata[:]
+if (verbose):
+   print("Opening "+inputfile)
+#the fields of the archives are memory mapped, the timesteps are read from the disk when they are processed
+lattice,tt,N_events,Tmunu_in,J_in,v_in,N_events_t = lattice_archive.load(inputfile,"lattice",extra=("N_events_t",),lazy=True)
 
 
 dt=tt[1]-tt[0]
@@ -70,16 +77,33 @@ xx=np.linspace(xstart+dx/2,xstart+dx*(nx-0.5),nx)
 yy=np.linspace(ystart+dy/2,ystart+dy*(ny-0.5),ny)
 zz=np.linspace(zstart+dz/2,zstart+dz*(nz-0.5),nz)
 
-if (verbose):
-    print("Coarse graining data read, now diving by the number of events, i.e.: "+str(N_events))
-Tmunu=Tmunu/N_events
-J=J/N_events
-v=v/N_events
+if (slab_timesteps is None):
+    slab_timesteps=nt
 
-# we use these arrays for convenience
-vx=v[:,0,:,:,:]
-vy=v[:,1,:,:,:]
-vz=v[:,2,:,:,:]
+if (verbose):
+    print("Coarse graining data opened, the timesteps will be divided by the number of events, i.e.: "+str(N_events))
+#the archives combined from runs with different timesteps contain the number of events at each timestep
+if (N_events_t is not None):
+    if (verbose):
+        print("The number of events depends on the timestep: "+str(list(N_events_t)))
+    N_events=np.array(N_events_t,dtype=np.float64)[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis]
+else:
+    N_events=np.full((nt,1,1,1,1),N_events,dtype=np.float64)
+#the calculations below index the cells as [h,component,i,j,k], so the fields are presented in this order
+Tmunu_in=lattice_archive.with_axes(lattice,Tmunu_in,lattice_archive.legacy_axes)
+J_in=lattice_archive.with_axes(lattice,J_in,lattice_archive.legacy_axes)
+v_in=lattice_archive.with_axes(lattice,v_in,lattice_archive.legacy_axes)
+
+def read_slab(hmin,hmax):
+    #it returns Tmunu, J and v at the timesteps hmin<=h<hmax, divided by the number of events
+    #the archive can be in single precision, but we always work in double precision
+    Tmunu=np.ascontiguousarray(np.divide(Tmunu_in[hmin:hmax],N_events[hmin:hmax],dtype=np.float64))
+    J=np.ascontiguousarray(np.divide(J_in[hmin:hmax],N_events[hmin:hmax],dtype=np.float64))
+    v=np.ascontiguousarray(np.divide(v_in[hmin:hmax],N_events[hmin:hmax],dtype=np.float64))
+    instrumentation.add("bytes_read",Tmunu.nbytes+J.nbytes+v.nbytes)
+    return Tmunu, J, v
+
+instrumentation.lap("read")
 
 # important indexes
 
@@ -101,90 +125,93 @@ kS0=8
 kS1=9
 kS2=10
 kS3=11
+#indexes of vx, vy, vz in v
+ivx=0
+ivy=1
+ivz=2
+
+#the preprocessor may have stored only some of the components, listed in the lattice dictionary
+#in this case the indexes are taken from those lists, a missing component has index None
+if ("components" in lattice):
+    components=lattice["components"]
+    def component_index(kind,name):
+        if (name in components[kind]):
+            return components[kind].index(name)
+        else:
+            return None
+    iT00=component_index("Tmunu","T00")
+    kQ0,kQ1,kQ2,kQ3=[component_index("jQBS","jQ"+str(m)) for m in range(4)]
+    kB0,kB1,kB2,kB3=[component_index("jQBS","jB"+str(m)) for m in range(4)]
+    kS0,kS1,kS2,kS3=[component_index("jQBS","jS"+str(m)) for m in range(4)]
+    ivx,ivy,ivz=[component_index("v",name) for name in ("vx","vy","vz")]
+    if (None in (iT00,kB0,kB1,kB2,kB3,ivx,ivy,ivz)):
+        print("Sorry, the archive must contain at least T00, jB0, jB1, jB2, jB3, vx, vy and vz, while it contains only: "+str(components))
+        sys.exit(2)
+    if ((eos_type == 1) and (None in (kQ0,kQ1,kQ2,kQ3))):
+        print("Sorry, the SMASH EoS needs also jQ0, jQ1, jQ2 and jQ3, while the archive contains only: "+str(components))
+        sys.exit(2)
+
+if der_type not in (1,2):
+    print("Error, method to compute derivative unknown...")
+    sys.exit(2)
 
-if (verbose):
-    print("Computing the gamma Lorentz factor")
-glf=1/np.sqrt(1-np.sum(v**2,axis=1))
-
-if (verbose):
-    print("Computing rhoQ")
-rhoQ=glf*(J[:,kQ0,:,:,:]-J[:,kQ1,:,:,:]*vx-J[:,kQ2,:,:,:]*vy-J[:,kQ3,:,:,:]*vz)
-
-if (verbose):
-    print("Computing rhoB")
-rhoB=glf*(J[:,kB0,:,:,:]-J[:,kB1,:,:,:]*vx-J[:,kB2,:,:,:]*vy-J[:,kB3,:,:,:]*vz)
-
-if (verbose):
-    print("Computing rhoS")
-rhoS=glf*(J[:,kS0,:,:,:]-J[:,kS1,:,:,:]*vx-J[:,kS2,:,:,:]*vy-J[:,kS3,:,:,:]*vz)
-
+def densities(J,v):
+    #it returns the velocity components, the gamma Lorentz factor and the charge, baryon and strangeness densities (None if not available)
 
+    # we use these arrays for convenience
+    vx=v[:,ivx,:,:,:]
+    vy=v[:,ivy,:,:,:]
+    vz=v[:,ivz,:,:,:]
 
-if eos_type == 1: #smash eos type
+    glf=1/np.sqrt(1-vx**2-vy**2-vz**2)
 
-    eosfile=eos_dir+"/hadgas_eos_SMASH.dat"
+    if (None in (kQ0,kQ1,kQ2,kQ3)):
+        rhoQ=None
+    else:
+        rhoQ=glf*(J[:,kQ0,:,:,:]-J[:,kQ1,:,:,:]*vx-J[:,kQ2,:,:,:]*vy-J[:,kQ3,:,:,:]*vz)
 
-    en_list=[]
-    B_list=[]
-    Q_list=[]
+    rhoB=glf*(J[:,kB0,:,:,:]-J[:,kB1,:,:,:]*vx-J[:,kB2,:,:,:]*vy-J[:,kB3,:,:,:]*vz)
 
-    def count_points(eosfile):
-        if(eosfile[-3:]==".gz"):
-            if(verbose):
-                print("Opening gzipped EoS file "+eosfile)
-            fin=gzip.open(eosfile,"rb")
-        else:
-            if(verbose):
-                print("Opening EoS file "+eosfile)
-            fin=open(eosfile,"rb")
-        # we skip the first row
-        fin.readline()
-        # we read the first row
-        eref,bref,qref=np.float64(fin.readline().split()[0:3])
-        en_list.append(eref)
-        B_list.append(bref)
-        Q_list.append(qref)
-        nE=1;nB=1;nQ=1
-        for line in fin:
-            enval,bval,qval=np.float64(line.split()[0:3])
-            if ((nE==1) and (nB==1)):
-                if (bval==bref):
-                    nQ=nQ+1
-                    Q_list.append(qval)
-                else:
-                    nB=nB+1
-                    B_list.append(bval)
-                    bref=bval
-            if ((nE==1) and (enval==eref)):
-                if (bval!=bref):
-                    nB=nB+1
-                    B_list.append(bval)
-                    bref=bval
-            if (enval!=eref):
-                nE=nE+1
-                en_list.append(enval)
-                eref=enval
-        fin.close()
-        return nE,nB,nQ
+    if (None in (kS0,kS1,kS2,kS3)):
+        rhoS=None
+    else:
+        rhoS=glf*(J[:,kS0,:,:,:]-J[:,kS1,:,:,:]*vx-J[:,kS2,:,:,:]*vy-J[:,kS3,:,:,:]*vz)
 
-    if (verbose):
-        print("Retrieving information about the tabulated EoS structure")
-    nE,nB,nQ=count_points(eosfile)
+    return vx, vy, vz, glf, rhoQ, rhoB, rhoS
 
-    en_arr=np.array(en_list,dtype=np.float64)
-    B_arr=np.array(B_list,dtype=np.float64)
-    Q_arr=np.array(Q_list,dtype=np.float64)
 
-    if (verbose):
-        print("Retrieving the data from the tabulated EoS")
-    raw_data=np.loadtxt(eosfile,skiprows=1,usecols=(3,4,5,6,7))
-    data=raw_data.reshape((nE,nB,nQ,5))
+if eos_type == 1: #smash eos type
 
-    if (verbose):
-        print("Computing the temperature by interpolating the EoS")
-    temp = interpolate.interpn((en_arr,B_arr,Q_arr),data[:,:,:,0],(Tmunu[:,iT00,:,:,:],rhoB,rhoQ),bounds_error=False,fill_value=-1)
+    eosfile=eos_dir+"/hadgas_eos_SMASH.dat"
 
-elif eos_type == 2: #urqmd eos type 
+    #the table is parsed only at the first run, then it is read from its binary cache (see eos_tables.py)
+    eos_table=eos_tables.load_table(eosfile,eos_tables.read_smash_table,verbose=verbose)
+
+    def thermodynamics(Tmunu,rhoB,rhoQ):
+        #it returns the temperature, the baryon chemical potential, the pressure and the entropy density of all the cells
+        #the cells outside the table get temperature -1 and zero for the other quantities
+        nh=Tmunu.shape[0]
+        temp=np.full((nh,nx,ny,nz),-1.,dtype=np.float64)
+        muB=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        pressure=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        entr_dens=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        for h in range(nh):
+            inside=eos_table.inside(Tmunu[h,iT00],rhoB[h],rhoQ[h])
+            edens_in, rhoB_in, rhoQ_in = Tmunu[h,iT00][inside], rhoB[h][inside], rhoQ[h][inside]
+            #the cells and the interpolation weights are computed once and used for all the quantities
+            weights=eos_table.weights(edens_in,rhoB_in,rhoQ_in)
+            temp_in=eos_table.interpolate("T",weights)
+            muB_in=eos_table.interpolate("muB",weights)
+            p_in=eos_table.interpolate("p",weights)
+            temp[h][inside]=temp_in
+            muB[h][inside]=muB_in
+            pressure[h][inside]=p_in
+            #the table does not contain the entropy density, we get it from s=(e+p-muB*nB-muQ*nQ)/T (the strangeness density is zero)
+            muQ_in=eos_table.interpolate("muQ",weights)
+            entr_dens[h][inside]=np.divide(edens_in+p_in-muB_in*rhoB_in-muQ_in*rhoQ_in,temp_in,out=np.zeros(temp_in.shape),where=temp_in>0)
+        return temp, muB, pressure, entr_dens
+
+elif eos_type == 2: #urqmd eos type
 
     #these are the unit values of energy density and pressure
     e0=0.14651751415742
@@ -196,424 +223,220 @@ elif eos_type == 2: #urqmd eos type
     Nn_std=401
     en_std_max=1000.
     rho_std_max=40.
-    enarr_std=np.linspace(0.,en_std_max,num=Ne_std)
-    rhoarr_std=np.linspace(0.,rho_std_max,num=Nn_std)
 
     fmed=eos_dir+"/hg_eos_small.dat"
     Ne_med=201
     Nn_med=201
     en_med_max=10.
     rho_med_max=2.
-    enarr_med=np.linspace(0.,en_med_max,num=Ne_med)
-    rhoarr_med=np.linspace(0.,rho_med_max,num=Nn_med)
 
     fmin=eos_dir+"/hg_eos_mini.dat"
     Ne_min=201
     Nn_min=201
     en_min_max=0.1
     rho_min_max=0.02
-    enarr_min=np.linspace(0.,en_min_max,num=Ne_min)
-    rhoarr_min=np.linspace(0.,rho_min_max,num=Nn_min)
-
-    temparr_std=np.zeros((Ne_std,Nn_std),dtype=np.float64)
-    muarr_std=np.zeros((Ne_std,Nn_std),dtype=np.float64)
-    sarr_std=np.zeros((Ne_std,Nn_std),dtype=np.float64)
-    parr_std=np.zeros((Ne_std,Nn_std),dtype=np.float64)
-
-    temparr_med=np.zeros((Ne_med,Nn_med),dtype=np.float64)
-    muarr_med=np.zeros((Ne_med,Nn_med),dtype=np.float64)
-    sarr_med=np.zeros((Ne_med,Nn_med),dtype=np.float64)
-    parr_med=np.zeros((Ne_med,Nn_med),dtype=np.float64)
-
-    temparr_min=np.zeros((Ne_min,Nn_min),dtype=np.float64)
-    muarr_min=np.zeros((Ne_min,Nn_min),dtype=np.float64)
-    sarr_min=np.zeros((Ne_min,Nn_min),dtype=np.float64)
-    parr_min=np.zeros((Ne_min,Nn_min),dtype=np.float64)
-
-    def readeos(ff,tarr,marr,parr,sarr,nx,ny):
-        for j in range(ny):
-            for i in range(nx):
-                stuff=ff.readline().split()
-                tarr[i,j],marr[i,j],parr[i,j],sarr[i,j]=np.float64(stuff[0]),np.float64(stuff[1]),np.float64(stuff[3]),np.float64(stuff[5])
 
     if verbose:
         print("Reading the tabulated EoS from the files")
 
-    with open(fstd,"r") as infile:
-        readeos(infile,temparr_std,muarr_std,parr_std,sarr_std,Ne_std,Nn_std)
-        temp_interp_std=interpolate.interp2d(enarr_std, rhoarr_std, temparr_std.transpose(), kind='linear')
-        muB_interp_std=interpolate.interp2d(enarr_std, rhoarr_std, muarr_std.transpose(), kind='linear')
-        p_interp_std=interpolate.interp2d(enarr_std, rhoarr_std, parr_std.transpose(), kind='linear')
-        s_interp_std=interpolate.interp2d(enarr_std, rhoarr_std, sarr_std.transpose(), kind='linear')
-
-    with open(fmed,"r") as infile:
-        readeos(infile,temparr_med,muarr_med,parr_med,sarr_med,Ne_med,Nn_med)
-        temp_interp_med=interpolate.interp2d(enarr_med, rhoarr_med, temparr_med.transpose(), kind='linear')
-        muB_interp_med=interpolate.interp2d(enarr_med, rhoarr_med, muarr_med.transpose(), kind='linear')
-        p_interp_med=interpolate.interp2d(enarr_med, rhoarr_med, parr_med.transpose(), kind='linear')
-        s_interp_med=interpolate.interp2d(enarr_med, rhoarr_med, sarr_med.transpose(), kind='linear')
-
-    with open(fmin,"r") as infile:
-        readeos(infile,temparr_min,muarr_min,parr_min,sarr_min,Ne_min,Nn_min)
-        temp_interp_min=interpolate.interp2d(enarr_min, rhoarr_min, temparr_min.transpose(), kind='linear')
-        muB_interp_min=interpolate.interp2d(enarr_min, rhoarr_min, muarr_min.transpose(), kind='linear')
-        p_interp_min=interpolate.interp2d(enarr_min, rhoarr_min, parr_min.transpose(), kind='linear')
-        s_interp_min=interpolate.interp2d(enarr_min, rhoarr_min, sarr_min.transpose(), kind='linear')
- 
+    #the tables are parsed only at the first run, then they are read from their binary caches (see eos_tables.py)
+    eos_std=eos_tables.load_table(fstd,eos_tables.read_urqmd_table,Ne_std,Nn_std,en_std_max,rho_std_max,verbose=verbose)
+    eos_med=eos_tables.load_table(fmed,eos_tables.read_urqmd_table,Ne_med,Nn_med,en_med_max,rho_med_max,verbose=verbose)
+    eos_min=eos_tables.load_table(fmin,eos_tables.read_urqmd_table,Ne_min,Nn_min,en_min_max,rho_min_max,verbose=verbose)
+
     if verbose:
         print("Done.\n")
 
     def get_mub_T(rhoB_input_w_sign,edens):
-        #before callin this function we already checked that both arguments are > 0
-        compute=True
-        if rhoB_input_w_sign >= 0:
-            rhoB_tmp=rhoB_input_w_sign
-        else:
-            rhoB_tmp = 0.
+        #it returns the baryon chemical potential, the temperature, the pressure and the entropy density of all the cells,
+        #rhoB_input_w_sign and edens are arrays with the same shape
+        #the cells are split among the three tables with boolean masks and each table is interpolated with a single vectorised call,
+        #the cells and the interpolation weights are computed once and used for all the quantities
+        #a negative net baryon density is replaced by zero
+        rhoB_val=np.where(rhoB_input_w_sign>=0,rhoB_input_w_sign,0.)/n0
         edens_val=edens/e0
-        rhoB_val=rhoB_tmp/n0
-        if(edens_val<=en_std_max):
-            if((edens_val<en_min_max ) and (rhoB_val<rho_min_max)):
-                ftemp=temp_interp_min
-                fmuB=muB_interp_min
-                fpr=p_interp_min
-                fs=s_interp_min
-            if(edens_val<en_med_max ) and (rhoB_val<rho_med_max) and ((edens_val>=en_min_max ) or (rhoB_val>=rho_min_max)):     
-                ftemp=temp_interp_med
-                fmuB=muB_interp_med
-                fpr=p_interp_med
-                fs=s_interp_med
-            if((edens_val>=en_med_max ) or (rhoB_val>=rho_med_max)):     
-                if(rhoB_val>rho_std_max):
-                    print("Net baryon density exceeding the maximum of the table. Changed from "+str(rhoB_val)+" to "+str(rho_std_max*0.999999))
-                    rhoB_val=rho_std_max*0.999999
-                ftemp=temp_interp_std
-                fmuB=muB_interp_std
-                fpr=p_interp_std
-                fs=s_interp_std
-        elif(edens_val>en_std_max):    
-            compute=False
-#           temperature=350./1000.
-#           muB=3./1000.
-            temperature=0.
-            muB=0.
-            pressure=0.
-            entr_dens=0.
-        else:        
-            compute=False
-            temperature=0.
-            muB=0.
-            pressure=0.
-            entr_dens=0.
-     
-        if(compute): #all is expressed in GeV
-            temperature=ftemp(edens_val,rhoB_val)[0]/1000.
-            #muB=3*fmuB(edens,rhoB)[0]/1000. 
-            #pressure=fpr(edens,rhoB)[0]*e0
-            #entr_dens=fs(edens,rhoB)[0]*n0
-
-        #return muB, temperature, pressure, entr_dens
-        return temperature
-
-    temp=np.zeros((nt,nx,ny,nz),dtype=np.float64)
-    for h in range(nt):
+        muB=np.zeros(edens_val.shape,dtype=np.float64)
+        temperature=np.zeros(edens_val.shape,dtype=np.float64)
+        pressure=np.zeros(edens_val.shape,dtype=np.float64)
+        entr_dens=np.zeros(edens_val.shape,dtype=np.float64)
+        #the cells with energy density above the maximum of the tables, negative or not a number get zero for all the quantities
+        inside=(edens_val>=0) & (edens_val<=en_std_max)
+        in_min=inside & (edens_val<en_min_max) & (rhoB_val<rho_min_max)
+        in_med=inside & (edens_val<en_med_max) & (rhoB_val<rho_med_max) & np.logical_not(in_min)
+        in_std=inside & np.logical_not(in_min | in_med)
+        exceeding=in_std & (rhoB_val>rho_std_max)
+        if(np.any(exceeding)):
+            print("Net baryon density exceeding the maximum of the table in "+str(np.count_nonzero(exceeding))+" cells (max: "+str(np.amax(rhoB_val[exceeding]))+"). Changed to "+str(rho_std_max*0.999999))
+            rhoB_val=np.where(exceeding,rho_std_max*0.999999,rhoB_val)
+        for selected, eos_table in ((in_min,eos_min),(in_med,eos_med),(in_std,eos_std)):
+            if(np.any(selected)):
+                weights=eos_table.weights(edens_val[selected],rhoB_val[selected])
+                #all is expressed in GeV
+                temperature[selected]=eos_table.interpolate("T",weights)/1000.
+                muB[selected]=3*eos_table.interpolate("muB",weights)/1000.
+                pressure[selected]=eos_table.interpolate("p",weights)*e0
+                entr_dens[selected]=eos_table.interpolate("s",weights)*n0
+        return muB, temperature, pressure, entr_dens
+
+    def thermodynamics(Tmunu,rhoB,rhoQ):
+        #it returns the temperature, the baryon chemical potential, the pressure and the entropy density of all the cells
+        #the lookup is done one timestep at a time, to limit the size of the temporary arrays
+        nh=Tmunu.shape[0]
+        temp=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        muB=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        pressure=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        entr_dens=np.zeros((nh,nx,ny,nz),dtype=np.float64)
+        for h in range(nh):
+            muB[h],temp[h],pressure[h],entr_dens[h]=get_mub_T(rhoB[h],Tmunu[h,iT00])
+        return temp, muB, pressure, entr_dens
+
+instrumentation.lap("eos")
+
+def beta(temp,glf,vx,vy,vz,tt_slab,fout):
+    #it returns the components of the beta four vector, for each timestep it writes in fout its time, taken from tt_slab, and the number
+    #of cells with negative, null, positive and above temp_limit temperature (nothing is written if the time is None)
+    bt=np.zeros(temp.shape,dtype=np.float64)
+    bx=np.zeros(temp.shape,dtype=np.float64)
+    by=np.zeros(temp.shape,dtype=np.float64)
+    bz=np.zeros(temp.shape,dtype=np.float64)
+
+    sp="     "
+    for h in range(temp.shape[0]):
+        count_null=0
+        count_neg=0
+        count_pos=0
+        count_good=0
         for i in range(nx):
             for j in range(ny):
                 for k in range(nz):
-                    temp[h,i,j,k]=get_mub_T(rhoB[h,i,j,k],Tmunu[h,iT00,i,j,k])
-
-
-bt=np.zeros(temp.shape,dtype=np.float64)
-bx=np.zeros(temp.shape,dtype=np.float64)
-by=np.zeros(temp.shape,dtype=np.float64)
-bz=np.zeros(temp.shape,dtype=np.float64)
+                    if temp[h,i,j,k] < 0:
+                        count_neg=count_neg+1
+                        continue
+                    if temp[h,i,j,k] == 0:
+                        count_null=count_null+1
+                        continue
+                    if temp[h,i,j,k] > 0:
+                        count_pos=count_pos+1
+                    if(temp[h,i,j,k]>temp_limit):
+                        count_good=count_good+1
+                        bt[h,i,j,k]=glf[h,i,j,k]/temp[h,i,j,k]
+                        #we are using the covariant components, index down, so they get a -1 sign (Minkowski metric signature +---)
+                        bx[h,i,j,k]=-vx[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
+                        by[h,i,j,k]=-vy[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
+                        bz[h,i,j,k]=-vz[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
+
+        if (tt_slab[h] is not None):
+            fout.write(str(tt_slab[h])+sp+str(count_neg)+sp+str(count_null)+sp+str(count_pos)+sp+str(count_good)+"\n")
+
+    return bt, bx, by, bz
+
+def derivatives(bt,bx,by,bz):
+    #it returns the partial derivatives of the components of beta, in the same order of the gradients archive
+    if der_type == 1:
+
+        dbt_dx=np.gradient(bt,dx,axis=1)
+        dbt_dy=np.gradient(bt,dy,axis=2)
+        dbt_dz=np.gradient(bt,dz,axis=3)
+        dbx_dt=np.gradient(bx,dt,axis=0)
+        dby_dt=np.gradient(by,dt,axis=0)
+        dbz_dt=np.gradient(bz,dt,axis=0)
+
+        dbx_dy=np.gradient(bx,dy,axis=2)
+        dbx_dz=np.gradient(bx,dz,axis=3)
+        dby_dx=np.gradient(by,dx,axis=1)
+        dby_dz=np.gradient(by,dz,axis=3)
+        dbz_dx=np.gradient(bz,dx,axis=1)
+        dbz_dy=np.gradient(bz,dy,axis=2)
+
+    elif der_type == 2:
+
+        #see finite_differences.py for the treatment of the empty cells and of the borders
+        dbt_dx=finite_differences.masked_gradient(bt,dx,1)
+        dbt_dy=finite_differences.masked_gradient(bt,dy,2)
+        dbt_dz=finite_differences.masked_gradient(bt,dz,3)
+        dbx_dt=finite_differences.masked_gradient(bx,dt,0)
+        dby_dt=finite_differences.masked_gradient(by,dt,0)
+        dbz_dt=finite_differences.masked_gradient(bz,dt,0)
+
+        dbx_dy=finite_differences.masked_gradient(bx,dy,2)
+        dbz_dy=finite_differences.masked_gradient(bz,dy,2)
+        dby_dx=finite_differences.masked_gradient(by,dx,1)
+        dbz_dx=finite_differences.masked_gradient(bz,dx,1)
+        dby_dz=finite_differences.masked_gradient(by,dz,3)
+        dbx_dz=finite_differences.masked_gradient(bx,dz,3)
+
+    return dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy
+
+#the output fields are created directly in the output archives and filled one slab of timesteps at a time
+#the baryon chemical potential, the pressure and the entropy density are stored together with the temperature
+vorticity_names=[name for name in lattice_archive.legacy_layouts["vorticity"] if name not in lattice_archive.metadata_entries["vorticity"]]+["muB","pressure","entropy_density"]
+gradients_names=[name for name in lattice_archive.legacy_layouts["gradients"] if name not in lattice_archive.metadata_entries["gradients"]]
+
+def new_fields(path,names):
+    if (compression is None):
+        return {name:lattice_archive.new_field(path,name,(nt,nx,ny,nz)) for name in names}
+    else:
+        return {name:lattice_archive.new_compressed_field(path,name,(nt,nx,ny,nz),codec=compression) for name in names}
+
+vorticity_fields=new_fields(outputfile,vorticity_names)
+gradients_fields=new_fields(outputfile+"_gradients",gradients_names)
 
 fout=open("cells.dat","w")
-sp="     "
-for h in range(nt):
-    count_null=0
-    count_neg=0
-    count_pos=0
-    count_good=0
-    for i in range(nx):
-        for j in range(ny):
-            for k in range(nz):
-                if temp[h,i,j,k] < 0:
-                    count_neg=count_neg+1
-                    continue
-                if temp[h,i,j,k] == 0:
-                    count_null=count_null+1
-                    continue
-                if temp[h,i,j,k] > 0:
-                    #print(str(Tmunu[h,iT00,i,j,k])+sp+str(rhoB[h,i,j,k])+sp+str(rhoQ[h,i,j,k])+sp+str(temp[h,i,j,k]))
-                    count_pos=count_pos+1
-                if(temp[h,i,j,k]>temp_limit):
-                    count_good=count_good+1
-                    bt[h,i,j,k]=glf[h,i,j,k]/temp[h,i,j,k]
-                    #we are using the covariant components, index down, so they get a -1 sign (Minkowski metric signature +---)
-                    bx[h,i,j,k]=-vx[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
-                    by[h,i,j,k]=-vy[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
-                    bz[h,i,j,k]=-vz[h,i,j,k]*glf[h,i,j,k]/temp[h,i,j,k]
-
-
-    fout.write(str(tt[h])+sp+str(count_neg)+sp+str(count_null)+sp+str(count_pos)+sp+str(count_good)+"\n")
-    
-fout.close()
-
+for hmin in range(0,nt,slab_timesteps):
+    hmax=min(hmin+slab_timesteps,nt)
+    #the time derivatives need also the previous and the following timesteps (the halo), which are computed again with the near slabs
+    lo=max(hmin-1,0)
+    hi=min(hmax+1,nt)
+    core=slice(hmin-lo,hmax-lo)
+    if (verbose and (slab_timesteps<nt)):
+        print("Processing the timesteps from "+str(hmin)+" to "+str(hmax-1)+" of "+str(nt))
+
+    Tmunu,J,v=read_slab(lo,hi)
+    instrumentation.add("timesteps",hmax-hmin)
+    instrumentation.add("cells",int((hmax-hmin)*nx*ny*nz))
+    instrumentation.lap("read")
+
+    vx,vy,vz,glf,rhoQ,rhoB,rhoS=densities(J,v)
+    instrumentation.lap("densities")
+
+    temp,muB,pressure,entr_dens=thermodynamics(Tmunu,rhoB,rhoQ)
+    #the arrays which are not needed anymore are released
+    Tmunu=J=rhoQ=rhoB=rhoS=None
+    instrumentation.lap("eos")
+
+    #the counts of the cells are written only for the timesteps of the slab, not for those of the halo
+    bt,bx,by,bz=beta(temp,glf,vx,vy,vz,[tt[lo+h] if (hmin<=lo+h<hmax) else None for h in range(hi-lo)],fout)
+    instrumentation.lap("beta")
+
+    dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy=derivatives(bt,bx,by,bz)
+    instrumentation.lap("derivatives")
+
+    omega_tx=0.5*hbarc*(dbt_dx-dbx_dt)
+    omega_ty=0.5*hbarc*(dbt_dy-dby_dt)
+    omega_tz=0.5*hbarc*(dbt_dz-dbz_dt)
+
+    omega_yz=0.5*hbarc*(dby_dz-dbz_dy)
+    omega_zx=0.5*hbarc*(dbz_dx-dbx_dz)
+    omega_xy=0.5*hbarc*(dbx_dy-dby_dx)
+    instrumentation.lap("vorticity")
+
+    slab={"vx":vx,"vy":vy,"vz":vz,"temp":temp,"muB":muB,"pressure":pressure,"entropy_density":entr_dens,\
+          "omega_tx":omega_tx,"omega_ty":omega_ty,"omega_tz":omega_tz,"omega_yz":omega_yz,"omega_zx":omega_zx,"omega_xy":omega_xy,\
+          "bt":bt,"bx":bx,"by":by,"bz":bz,"dbt_dx":dbt_dx,"dbt_dy":dbt_dy,"dbt_dz":dbt_dz,"dbx_dt":dbx_dt,"dby_dt":dby_dt,"dbz_dt":dbz_dt,\
+          "dbx_dy":dbx_dy,"dbx_dz":dbx_dz,"dby_dx":dby_dx,"dby_dz":dby_dz,"dbz_dx":dbz_dx,"dbz_dy":dbz_dy}
+    for fields in (vorticity_fields,gradients_fields):
+        for name, field in fields.items():
+            values=slab[name][core]
+            for h in range(hmin,hmax):
+                field[h]=values[h-hmin]
+    slab=None
+    instrumentation.lap("write")
 
-if der_type == 1:
-
-    dbt_dx=np.gradient(bt,dx,axis=1)
-    dbt_dy=np.gradient(bt,dy,axis=2)
-    dbt_dz=np.gradient(bt,dz,axis=3)
-    dbx_dt=np.gradient(bx,dt,axis=0)
-    dby_dt=np.gradient(by,dt,axis=0)
-    dbz_dt=np.gradient(bz,dt,axis=0)
-
-    dbx_dy=np.gradient(bx,dy,axis=2)
-    dbx_dz=np.gradient(bx,dz,axis=3)
-    dby_dx=np.gradient(by,dx,axis=1)
-    dby_dz=np.gradient(by,dz,axis=3)
-    dbz_dx=np.gradient(bz,dx,axis=1)
-    dbz_dy=np.gradient(bz,dy,axis=2)
-
-elif der_type == 2:
-
-    dbt_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((bt[h,0,j,k]!=0) and (bt[h,1,j,k]!=0)):
-                            dbt_dx[h,0,j,k]=(bt[h,1,j,k]-bt[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((bt[h,nx-1,j,k]!=0) and (bt[h,nx-2,j,k]!=0)):
-                            dbt_dx[h,nx-1,j,k]=(bt[h,nx-1,j,k]-bt[h,nx-2,j,k])/dx
-                    elif((bt[h,i-1,j,k]!=0) and (bt[h,i+1,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i+1,j,k]-bt[h,i-1,j,k])/(2*dx)
-                    elif((bt[h,i-1,j,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i,j,k]-bt[h,i-1,j,k])/(dx)
-                    elif((bt[h,i+1,j,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dx[h,i,j,k]=(bt[h,i+1,j,k]-bt[h,i,j,k])/(dx)
-
-    dbt_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bt[h,i,0,k]!=0) and (bt[h,i,1,k]!=0)):
-                            dbt_dy[h,i,0,k]=(bt[h,i,1,k]-bt[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bt[h,i,ny-1,k]!=0) and (bt[h,i,ny-2,k]!=0)):
-                            dbt_dy[h,i,ny-1,k]=(bt[h,i,ny-1,k]-bt[h,i,ny-2,k])/dy
-                    elif((bt[h,i,j-1,k]!=0) and (bt[h,i,j+1,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j+1,k]-bt[h,i,j-1,k])/(2*dy)
-                    elif((bt[h,i,j-1,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j,k]-bt[h,i,j-1,k])/(dy)
-                    elif((bt[h,i,j+1,k]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dy[h,i,j,k]=(bt[h,i,j+1,k]-bt[h,i,j,k])/(dy)
-
-    dbt_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((bt[h,i,j,0]!=0) and (bt[h,i,j,1]!=0)):
-                            dbt_dz[h,i,j,0]=(bt[h,i,j,1]-bt[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((bt[h,i,j,nz-1]!=0) and (bt[h,i,j,nz-2]!=0)):
-                            dbt_dz[h,i,j,nz-1]=(bt[h,i,j,nz-1]-bt[h,i,j,nz-2])/dz
-                    elif((bt[h,i,j,k-1]!=0) and (bt[h,i,j,k+1]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k+1]-bt[h,i,j,k-1])/(2*dz)
-                    elif((bt[h,i,j,k-1]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k]-bt[h,i,j,k-1])/(dz)
-                    elif((bt[h,i,j,k+1]!=0) and (bt[h,i,j,k]!=0)):
-                        dbt_dz[h,i,j,k]=(bt[h,i,j,k+1]-bt[h,i,j,k])/(dz)
-
-    dbx_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((bx[0,i,j,k]!=0) and (bx[1,i,j,k]!=0)):
-                            dbx_dt[0,i,j,k]=(bx[1,i,j,k]-bx[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((bx[nt-1,i,j,k]!=0) and (bx[nt-2,i,j,k]!=0)):
-                            dbx_dt[nt-1,i,j,k]=(bx[nt-1,i,j,k]-bx[nt-2,i,j,k])/dt
-                    elif((bx[h-1,i,j,k]!=0) and (bx[h+1,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h+1,i,j,k]-bx[h-1,i,j,k])/(2*dt)
-                    elif((bx[h-1,i,j,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h,i,j,k]-bx[h-1,i,j,k])/(dt)
-                    elif((bx[h+1,i,j,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dt[h,i,j,k]=(bx[h+1,i,j,k]-bx[h,i,j,k])/(dt)
-
-
-    dby_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((by[0,i,j,k]!=0) and (by[1,i,j,k]!=0)):
-                            dby_dt[0,i,j,k]=(by[1,i,j,k]-by[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((by[nt-1,i,j,k]!=0) and (by[nt-2,i,j,k]!=0)):
-                            dby_dt[nt-1,i,j,k]=(by[nt-1,i,j,k]-by[nt-2,i,j,k])/dt
-                    elif((by[h-1,i,j,k]!=0) and (by[h+1,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h+1,i,j,k]-by[h-1,i,j,k])/(2*dt)
-                    elif((by[h-1,i,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h,i,j,k]-by[h-1,i,j,k])/(dt)
-                    elif((by[h+1,i,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dt[h,i,j,k]=(by[h+1,i,j,k]-by[h,i,j,k])/(dt)
-
-
-    dbz_dt=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(h==0):
-                        if((bz[0,i,j,k]!=0) and (bz[1,i,j,k]!=0)):
-                            dbz_dt[0,i,j,k]=(bz[1,i,j,k]-bz[0,i,j,k])/dt
-                    elif(h==nt-1):
-                        if((bz[nt-1,i,j,k]!=0) and (bz[nt-2,i,j,k]!=0)):
-                            dbz_dt[nt-1,i,j,k]=(bz[nt-1,i,j,k]-bz[nt-2,i,j,k])/dt
-                    elif((bz[h-1,i,j,k]!=0) and (bz[h+1,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h+1,i,j,k]-bz[h-1,i,j,k])/(2*dt)
-                    elif((bz[h-1,i,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h,i,j,k]-bz[h-1,i,j,k])/(dt)
-                    elif((bz[h+1,i,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dt[h,i,j,k]=(bz[h+1,i,j,k]-bz[h,i,j,k])/(dt)
-
-
-    dbx_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bx[h,i,0,k]!=0) and (bx[h,i,1,k]!=0)):
-                            dbx_dy[h,i,0,k]=(bx[h,i,1,k]-bx[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bx[h,i,ny-1,k]!=0) and (bx[h,i,ny-2,k]!=0)):
-                            dbx_dy[h,i,ny-1,k]=(bx[h,i,ny-1,k]-bx[h,i,ny-2,k])/dy
-                    elif((bx[h,i,j-1,k]!=0) and (bx[h,i,j+1,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j+1,k]-bx[h,i,j-1,k])/(2*dy)
-                    elif((bx[h,i,j-1,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j,k]-bx[h,i,j-1,k])/(dy)
-                    elif((bx[h,i,j+1,k]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dy[h,i,j,k]=(bx[h,i,j+1,k]-bx[h,i,j,k])/(dy)
-
-
-    dbz_dy=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(j==0):
-                        if((bz[h,i,0,k]!=0) and (bz[h,i,1,k]!=0)):
-                            dbz_dy[h,i,0,k]=(bz[h,i,1,k]-bz[h,i,0,k])/dy
-                    elif(j==ny-1):
-                        if((bz[h,i,ny-1,k]!=0) and (bz[h,i,ny-2,k]!=0)):
-                            dbz_dy[h,i,ny-1,k]=(bz[h,i,ny-1,k]-bz[h,i,ny-2,k])/dy
-                    elif((bz[h,i,j-1,k]!=0) and (bz[h,i,j+1,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j+1,k]-bz[h,i,j-1,k])/(2*dy)
-                    elif((bz[h,i,j-1,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j,k]-bz[h,i,j-1,k])/(dy)
-                    elif((bz[h,i,j+1,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dy[h,i,j,k]=(bz[h,i,j+1,k]-bz[h,i,j,k])/(dy)
-
-
-    dby_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((by[h,0,j,k]!=0) and (by[h,1,j,k]!=0)):
-                            dby_dx[h,0,j,k]=(by[h,1,j,k]-by[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((by[h,nx-1,j,k]!=0) and (by[h,nx-2,j,k]!=0)):
-                            dby_dx[h,nx-1,j,k]=(by[h,nx-1,j,k]-by[h,nx-2,j,k])/dx
-                    elif((by[h,i-1,j,k]!=0) and (by[h,i+1,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i+1,j,k]-by[h,i-1,j,k])/(2*dx)
-                    elif((by[h,i-1,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i,j,k]-by[h,i-1,j,k])/(dx)
-                    elif((by[h,i+1,j,k]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dx[h,i,j,k]=(by[h,i+1,j,k]-by[h,i,j,k])/(dx)
-
-    dbz_dx=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(i==0):
-                        if((bz[h,0,j,k]!=0) and (bz[h,1,j,k]!=0)):
-                            dbz_dx[h,0,j,k]=(bz[h,1,j,k]-bz[h,0,j,k])/dx
-                    elif(i==nx-1):
-                        if((bz[h,nx-1,j,k]!=0) and (bz[h,nx-2,j,k]!=0)):
-                            dbz_dx[h,nx-1,j,k]=(bz[h,nx-1,j,k]-bz[h,nx-2,j,k])/dx
-                    elif((bz[h,i-1,j,k]!=0) and (bz[h,i+1,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i+1,j,k]-bz[h,i-1,j,k])/(2*dx)
-                    elif((bz[h,i-1,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i,j,k]-bz[h,i-1,j,k])/(dx)
-                    elif((bz[h,i+1,j,k]!=0) and (bz[h,i,j,k]!=0)):
-                        dbz_dx[h,i,j,k]=(bz[h,i+1,j,k]-bz[h,i,j,k])/(dx)
-
-    dby_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((by[h,i,j,0]!=0) and (by[h,i,j,1]!=0)):
-                            dbt_dy[h,i,j,0]=(by[h,i,j,1]-by[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((by[h,i,j,nz-1]!=0) and (by[h,i,j,nz-2]!=0)):
-                            dby_dz[h,i,j,nz-1]=(by[h,i,j,nz-1]-by[h,i,j,nz-2])/dz
-                    elif((by[h,i,j,k-1]!=0) and (by[h,i,j,k+1]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k+1]-by[h,i,j,k-1])/(2*dz)
-                    elif((by[h,i,j,k-1]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k]-by[h,i,j,k-1])/(dz)
-                    elif((by[h,i,j,k+1]!=0) and (by[h,i,j,k]!=0)):
-                        dby_dz[h,i,j,k]=(by[h,i,j,k+1]-by[h,i,j,k])/(dz)
-
-    dbx_dz=np.zeros(temp.shape,dtype=np.float64)
-    for h in range(nt):
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    if(k==0):
-                        if((bx[h,i,j,0]!=0) and (bx[h,i,j,1]!=0)):
-                            dbx_dy[h,i,j,0]=(bx[h,i,j,1]-bx[h,i,j,0])/dz
-                    elif(k==nz-1):
-                        if((bx[h,i,j,nz-1]!=0) and (bx[h,i,j,nz-2]!=0)):
-                            dbx_dz[h,i,j,nz-1]=(bx[h,i,j,nz-1]-bx[h,i,j,nz-2])/dz
-                    elif((bx[h,i,j,k-1]!=0) and (bx[h,i,j,k+1]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k+1]-bx[h,i,j,k-1])/(2*dz)
-                    elif((bx[h,i,j,k-1]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k]-bx[h,i,j,k-1])/(dz)
-                    elif((bx[h,i,j,k+1]!=0) and (bx[h,i,j,k]!=0)):
-                        dbx_dz[h,i,j,k]=(bx[h,i,j,k+1]-bx[h,i,j,k])/(dz)
-else:
-    print("Error, method to compute derivative unknown...")
-    sys.exit(2)
-
-
-omega_tx=0.5*hbarc*(dbt_dx-dbx_dt)
-omega_ty=0.5*hbarc*(dbt_dy-dby_dt)
-omega_tz=0.5*hbarc*(dbt_dz-dbz_dt)
-
-omega_yz=0.5*hbarc*(dby_dz-dbz_dy)
-omega_zx=0.5*hbarc*(dbz_dx-dbx_dz)
-omega_xy=0.5*hbarc*(dbx_dy-dby_dx)
+fout.close()
 
-with open(outputfile,"wb") as po:
-     pickle.dump((tt,xx,yy,zz,vx,vy,vz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy),po)
-with open(outputfile+"_gradients","wb") as po:
-     pickle.dump((tt,xx,yy,zz,vx,vy,vz,temp,bt,bx,by,bz,dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy),po)
+lattice_archive.write_archive(outputfile,"vorticity",{"tt":tt,"xx":xx,"yy":yy,"zz":zz},vorticity_fields)
+lattice_archive.write_archive(outputfile+"_gradients","gradients",{"tt":tt,"xx":xx,"yy":yy,"zz":zz},gradients_fields)
+instrumentation.lap("write")
+if (stats_file is not None):
+    instrumentation.report("compute_vorticity_from_th_latt_output_smash.py",stats_file)
 print("All done.")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# eos_tables.py - version 0.1.0 - 18/10/2026
+
+# it reads the tabulated equations of state used by compute_vorticity_from_th_latt_output_smash.py
+# and interpolates them on whole arrays of cells
+# the ascii tables are parsed only the first time: they are then saved in a binary cache (an archive of kind eos,
+# see lattice_archive.py) next to the original file, which is memory mapped by the following runs
+# the cache is rebuilt automatically if the size or the modification time of the ascii file change
+# the cache is written in a temporary directory and then renamed, so that the jobs reading it at the same time never see a partial cache
+
+import os
+import sys
+import shutil
+import numpy as np
+import lattice_archive
+
+#the binary copy of the table file.dat is stored in the directory file.dat+cache_suffix
+cache_suffix=".cache"
+#version of the content of the caches, the caches with a different version are rebuilt
+cache_version=1
+
+#maximum relative deviation from the average spacing for which the points of an axis are considered regularly spaced
+uniform_tolerance=1.e-6
+
+class Table:
+    #a tabulated EoS: axes is a list with the grid points along each axis, fields a dictionary with the tabulated quantities,
+    #each of them with one index for each axis
+    #the interpolation is multilinear (bilinear or trilinear) and it is done in two steps: weights finds the cells containing
+    #the points and the interpolation weights, interpolate uses them for a quantity, so that the weights can be shared by all the quantities
+
+    def __init__(self,axes,fields):
+        self.axes=[np.asarray(points,dtype=np.float64) for points in axes]
+        self.fields=fields
+        #for the regularly spaced axes the cells are found directly from the spacing, otherwise with a binary search
+        self.uniform=[]
+        for points in self.axes:
+            step=(points[-1]-points[0])/(len(points)-1)
+            self.uniform.append(bool(np.all(np.abs(np.diff(points)-step)<=uniform_tolerance*abs(step))))
+
+    def inside(self,*coords):
+        #it returns a mask with the points inside the table (the points which are not a number are outside)
+        mask=np.ones(np.shape(coords[0]),dtype=bool)
+        for points, x in zip(self.axes,coords):
+            mask&=(x>=points[0]) & (x<=points[-1])
+        return mask
+
+    def weights(self,*coords):
+        #it returns, for each axis, the indexes of the lower corner of the cells containing the points and the weights of the upper corner
+        #the points outside the table are moved to the nearest cell, so the callers must select them with inside if needed
+        result=[]
+        for points, uniform, x in zip(self.axes,self.uniform,coords):
+            n=len(points)
+            if(uniform):
+                step=(points[-1]-points[0])/(n-1)
+                index=np.floor((x-points[0])/step)
+                #the negative indexes and those of the points which are not a number are set to zero
+                index=np.minimum(np.where(index>=0,index,0),n-2).astype(np.int64)
+            else:
+                index=np.clip(np.searchsorted(points,x,side="right")-1,0,n-2)
+            result.append((index,(x-points[index])/(points[index+1]-points[index])))
+        return result
+
+    def interpolate(self,name,weights):
+        #it interpolates the quantity name at the points whose weights have been computed by weights
+        field=self.fields[name]
+        values=0.
+        for corner in range(2**len(weights)):
+            index=[]
+            factor=1.
+            for axis, (lower, w) in enumerate(weights):
+                if((corner>>axis)&1):
+                    index.append(lower+1)
+                    factor=factor*w
+                else:
+                    index.append(lower)
+                    factor=factor*(1-w)
+            values=values+factor*field[tuple(index)]
+        return values
+
+def read_urqmd_table(eosfile,Ne,Nn,en_max,rho_max):
+    #table of the UrQMD hadron gas EoS, with Ne x Nn points regularly spaced from 0 to en_max and rho_max
+    #each row contains T, mu_B, (unused), p, (unused), s, the energy density index runs faster than the net baryon density one
+    data=np.loadtxt(eosfile,usecols=(0,1,3,5),max_rows=Ne*Nn,ndmin=2)
+    if(data.shape[0]!=Ne*Nn):
+        print("Error, the EoS file "+eosfile+" contains "+str(data.shape[0])+" points, while "+str(Ne*Nn)+" were expected.\nI quit.")
+        sys.exit(2)
+    data=data.reshape(Nn,Ne,4).transpose(1,0,2)
+    axes=[np.linspace(0.,en_max,num=Ne),np.linspace(0.,rho_max,num=Nn)]
+    return Table(axes,{name:np.ascontiguousarray(data[:,:,n]) for n,name in enumerate(("T","muB","p","s"))})
+
+def read_smash_table(eosfile):
+    #table of the SMASH hadron gas EoS, after a header line each row contains e, nB, nQ, T, p, mu_B, mu_Q, mu_S,
+    #the charge density index runs faster than the baryon density one, which runs faster than the energy density one
+    data=np.loadtxt(eosfile,skiprows=1,usecols=range(8),ndmin=2)
+    #the number of points along each axis is found from the rows in which the slower coordinates change
+    changes_B=np.flatnonzero(data[:,1]!=data[0,1])
+    changes_e=np.flatnonzero(data[:,0]!=data[0,0])
+    nBQ=changes_e[0] if len(changes_e)>0 else data.shape[0]
+    nQ=changes_B[0] if ((len(changes_B)>0) and (changes_B[0]<nBQ)) else nBQ
+    nB=nBQ//nQ
+    nE=data.shape[0]//nBQ
+    if(nE*nB*nQ!=data.shape[0]):
+        print("Error, the points of the EoS file "+eosfile+" do not form a grid: "+str(data.shape[0])+" points, while "+str(nE)+" x "+str(nB)+" x "+str(nQ)+" were expected.\nI quit.")
+        sys.exit(2)
+    data=data.reshape(nE,nB,nQ,8)
+    axes=[data[:,0,0,0],data[0,:,0,1],data[0,0,:,2]]
+    return Table(axes,{name:np.ascontiguousarray(data[:,:,:,n]) for n,name in zip(range(3,8),("T","p","muB","muQ","muS"))})
+
+def source_info(eosfile,reader,args):
+    #description of the ascii table stored in the cache, to check that the cache is up to date
+    status=os.stat(eosfile)
+    return {"file":os.path.realpath(eosfile),"size":status.st_size,"mtime":status.st_mtime,"reader":reader.__name__,\
+            "args":list(args),"cache_version":cache_version}
+
+def load_table(eosfile,reader,*args,verbose=False):
+    #it returns the table read by reader(eosfile,*args) from its binary cache, if it is up to date, otherwise from the ascii file
+    cache=eosfile+cache_suffix
+    source=source_info(eosfile,reader,args)
+    if(lattice_archive.is_archive(cache)):
+        kind, metadata, fields = lattice_archive.open_archive(cache)
+        if((kind=="eos") and (metadata.get("source")==source)):
+            if(verbose):
+                print("Reading the EoS from the binary cache "+cache)
+            return Table(metadata["axes"],fields)
+    if(verbose):
+        print("Reading the EoS from "+eosfile+" and saving it in the binary cache "+cache)
+    table=reader(eosfile,*args)
+    tmpdir=cache+"."+str(os.getpid())+".tmp"
+    try:
+        lattice_archive.write_archive(tmpdir,"eos",{"source":source,"axes":table.axes},table.fields)
+        if(os.path.isdir(cache)):
+            #the outdated cache is moved away before replacing it, the jobs which memory mapped its fields keep reading them
+            olddir=cache+"."+str(os.getpid())+".old"
+            os.replace(cache,olddir)
+            shutil.rmtree(olddir,ignore_errors=True)
+        os.replace(tmpdir,cache)
+    except OSError as error:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+        #another job may have written the cache in the meantime, otherwise (e.g. the directory of the EoS is read only) the table is used anyway
+        if(not lattice_archive.is_archive(cache)):
+            print("Warning, I cannot write the binary cache of the EoS "+cache+": "+str(error))
+    return table
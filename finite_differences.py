@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+# finite_differences.py - version 0.1.0 - 18/10/2026
+
+# partial derivatives of the fields of the vorticity scripts (compute_vorticity_from_th_latt_output_smash.py and compute_vorticity_cg_data.py)
+# the cells with zero value are considered empty (e.g. below the temperature limit) and they are not used:
+# the derivative is computed with centered differences if both the neighbours are not empty, otherwise with the first order
+# difference with the non empty neighbour, if also the cell itself is not empty, otherwise it is zero
+# at the borders only the first order difference with the internal neighbour is used
+
+import numpy as np
+
+def masked_gradient(field,spacing,axis):
+    #it returns the derivative of field along axis, with grid spacing spacing, computed on whole arrays with shifted slices
+    #the operations are the same of the loops over the cells used in the previous versions, so the results are identical
+    field=np.asarray(field)
+    gradient=np.zeros(field.shape,dtype=np.float64)
+    n=field.shape[axis]
+    if(n<2):
+        return gradient
+    #views with the axis of the derivative in front, writing into g fills gradient
+    f=np.moveaxis(field,axis,0)
+    g=np.moveaxis(gradient,axis,0)
+    full=(f!=0)
+    g[0]=np.where(full[0] & full[1],(f[1]-f[0])/spacing,0.)
+    g[n-1]=np.where(full[n-1] & full[n-2],(f[n-1]-f[n-2])/spacing,0.)
+    if(n>2):
+        previous, current, following = f[:-2], f[1:-1], f[2:]
+        full_previous, full_current, full_following = full[:-2], full[1:-1], full[2:]
+        centered=full_previous & full_following
+        backward=np.logical_not(centered) & full_previous & full_current
+        forward=np.logical_not(centered | backward) & full_following & full_current
+        g[1:-1]=np.where(centered,(following-previous)/(2*spacing),\
+                np.where(backward,(current-previous)/(spacing),np.where(forward,(following-current)/(spacing),0.)))
+    return gradient
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# instrumentation of the scripts: time spent in the various stages of the computation,
+# amount of data read, number of processed events and timesteps, peak memory
+# the scripts accumulate the measurements with stage, lap and add and, if requested with the --stats option,
+# they print a summary and they write it in json format with report
+# the worker processes send to the main process their measurements, obtained with snapshot, which are added with merge
+
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+try:
+    import resource
+except ImportError:
+    resource=None
+
+#time in seconds spent in each stage, summed over the threads and the worker processes
+stage_times={}
+#counters of bytes, events, timesteps, etc.
+counters={}
+#maximum peak resident memory of the worker processes, in MB
+peak_rss_workers=0.
+
+#the measurements can be added also by the background threads
+lock=threading.Lock()
+
+#starting time of the script and end of the last lap
+start_time=timer()
+last_lap=start_time
+
+def add_time(name,seconds):
+    with lock:
+        stage_times[name]=stage_times.get(name,0.)+seconds
+
+def add(name,value):
+    with lock:
+        counters[name]=counters.get(name,0)+value
+
+@contextmanager
+def stage(name):
+    #the time spent inside the with block is added to the stage name
+    begin=timer()
+    try:
+        yield
+    finally:
+        add_time(name,timer()-begin)
+
+def lap(name):
+    #the time elapsed since the previous lap (or since the start) is added to the stage name
+    #it is used by the scripts that run their stages one after the other, outside of functions
+    global last_lap
+    now=timer()
+    add_time(name,now-last_lap)
+    last_lap=now
+
+def peak_rss(who="self"):
+    #peak resident memory in MB of the process (self) or of its terminated child processes (children), None if it is not available
+    if(resource is None):
+        return None
+    usage=resource.getrusage(resource.RUSAGE_SELF if who=="self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    #ru_maxrss is in kB on Linux and in bytes on macOS
+    if(sys.platform=="darwin"):
+        return usage/1024.**2
+    return usage/1024.
+
+def reset():
+    #it clears the measurements, the worker processes call it before each task
+    global last_lap
+    with lock:
+        stage_times.clear()
+        counters.clear()
+    last_lap=timer()
+
+def snapshot():
+    #measurements of the current process, to be sent to the main process
+    with lock:
+        return {"stages":dict(stage_times),"counters":dict(counters),"peak_rss_mb":peak_rss()}
+
+def merge(measurements):
+    #it adds the measurements of a worker process to those of the current process
+    global peak_rss_workers
+    if(measurements is None):
+        return
+    for name, seconds in measurements["stages"].items():
+        add_time(name,seconds)
+    for name, value in measurements["counters"].items():
+        add(name,value)
+    if(measurements["peak_rss_mb"] is not None):
+        peak_rss_workers=max(peak_rss_workers,measurements["peak_rss_mb"])
+
+def report(script,filename=None):
+    #it prints a summary of the measurements and, if filename is given, it writes them in json format
+    wall_time=timer()-start_time
+    rates={name+"_per_second":counters[name]/wall_time for name in ("events","timesteps","bytes_read") if ((name in counters) and (wall_time>0))}
+    peak_children=peak_rss("children")
+    if(peak_children is not None):
+        peak_children=max(peak_children,peak_rss_workers)
+    stats={"script":script,"wall_time":wall_time,"stages":stage_times,"counters":counters,"rates":rates,\
+           "peak_rss_mb":peak_rss(),"peak_rss_workers_mb":peak_children}
+    print("Statistics of "+script+":")
+    print("  wall time: "+'{:.3f}'.format(wall_time)+" s")
+    for name, seconds in sorted(stage_times.items(),key=lambda item: -item[1]):
+        print("  "+name+": "+'{:.3f}'.format(seconds)+" s")
+    for name, value in counters.items():
+        print("  "+name+": "+str(value))
+    for name, value in rates.items():
+        print("  "+name+": "+'{:.3f}'.format(value))
+    if(stats["peak_rss_mb"] is not None):
+        print("  peak memory: "+'{:.1f}'.format(stats["peak_rss_mb"])+" MB, worker processes: "+'{:.1f}'.format(peak_children)+" MB")
+    if(filename is not None):
+        tmpfile=filename+"."+str(os.getpid())+".tmp"
+        with open(tmpfile,"w") as outfile:
+            json.dump(stats,outfile,indent=1)
+        os.replace(tmpfile,filename)
+    return stats
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+
+# lattice_archive.py - version 0.1.0 - 18/10/2026
+
+# it reads and writes the archives exchanged by the scripts of this repository
+# an archive is a directory containing a file metadata.json with the small entries (lattice description, times, number of events...)
+# and one .npy file for each large array, so that the consumers can memory map single fields and read only the time slices they need
+# the fields can also be stored compressed, as a sequence of independently decompressible blocks of timesteps (a .blocks file),
+# so that the readers decompress only the blocks they need
+# the archives produced by the previous versions of the scripts, i.e. (possibly gzipped) pickled tuples, can still be read
+
+import json
+import numpy as np
+import sys
+import os
+import pickle
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
+try:
+    import lz4.frame
+except ImportError:
+    lz4=None
+
+#version 1: only .npy fields, version 2: also compressed fields
+archive_version=2
+
+#available codecs for the compressed fields, gzip is always available (each block is a gzip member, so the whole .blocks file can also be read by gunzip)
+codecs=["gzip"]
+if(zstandard is not None):
+    codecs.insert(0,"zstd")
+if(lz4 is not None):
+    codecs.insert(-1,"lz4")
+#codec used when the producers are asked to compress without specifying the codec: the fastest available
+default_codec=codecs[0]
+#compression levels
+codec_levels={"zstd":3,"lz4":0,"gzip":1}
+#the blocks contain the smallest number of whole timesteps exceeding this size in bytes
+block_size=16*1024**2
+#number of threads compressing and decompressing the blocks
+compression_threads=min(8,os.cpu_count() or 1)
+
+metadata_file="metadata.json"
+
+#the order of the entries in the tuples of the legacy pickled archives, for each kind of archive
+legacy_layouts={
+"lattice":["lattice","tt","N_events","Tmunu","jQBS","v"],
+"vorticity":["tt","xx","yy","zz","vx","vy","vz","temp","omega_tx","omega_ty","omega_tz","omega_yz","omega_zx","omega_xy"],
+"gradients":["tt","xx","yy","zz","vx","vy","vz","temp","bt","bx","by","bz","dbt_dx","dbt_dy","dbt_dz","dbx_dt","dby_dt","dbz_dt",\
+"dbx_dy","dbx_dz","dby_dx","dby_dz","dbz_dx","dbz_dy"]
+}
+
+#the entries stored in metadata.json instead of in separate .npy files
+metadata_entries={
+"lattice":["lattice","tt","N_events"],
+"vorticity":["tt","xx","yy","zz"],
+"gradients":["tt","xx","yy","zz"]
+}
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path,metadata_file))
+
+def field_file(path,name):
+    return os.path.join(path,name+".npy")
+
+def blocks_file(path,name):
+    return os.path.join(path,name+".blocks")
+
+def compress_block(codec,data):
+    with instrumentation.stage("compression"):
+        if(codec=="zstd"):
+            return zstandard.ZstdCompressor(level=codec_levels[codec]).compress(data)
+        elif(codec=="lz4"):
+            return lz4.frame.compress(data,compression_level=codec_levels[codec])
+        else:
+            return gzip.compress(data,compresslevel=codec_levels[codec],mtime=0)
+
+def decompress_block(codec,data):
+    with instrumentation.stage("decompression"):
+        if(codec=="zstd"):
+            return zstandard.ZstdDecompressor().decompress(data)
+        elif(codec=="lz4"):
+            return lz4.frame.decompress(data)
+        else:
+            return gzip.decompress(data)
+
+def check_codec(codec):
+    if(codec not in codecs):
+        print("Error, the compression codec "+str(codec)+" is not available, the available codecs are: "+", ".join(codecs)+".\nI quit.")
+        sys.exit(2)
+
+def timesteps_per_block(shape,dtype):
+    timestep_size=int(np.prod(shape[1:]))*np.dtype(dtype).itemsize
+    return max(1,-(-block_size//max(timestep_size,1)))
+
+#the threads are shared by all the compressed fields
+executor=None
+
+def get_executor():
+    global executor
+    if(executor is None):
+        executor=ThreadPoolExecutor(compression_threads)
+    return executor
+
+def reset_executor():
+    #the threads are not copied in the processes created with fork, so they create their own executor
+    global executor
+    executor=None
+
+if(hasattr(os,"register_at_fork")):
+    os.register_at_fork(after_in_child=reset_executor)
+
+class CompressedFieldWriter:
+    #it writes a compressed field receiving its timesteps in increasing order, as in field[h]=value
+    #the blocks are compressed in parallel by the threads of the executor and written in order
+
+    def __init__(self,path,name,shape,dtype,codec,block_timesteps=None):
+        check_codec(codec)
+        self.path=path
+        self.name=name
+        self.shape=tuple(shape)
+        self.dtype=np.dtype(dtype)
+        self.codec=codec
+        if(block_timesteps is None):
+            block_timesteps=timesteps_per_block(self.shape,self.dtype)
+        self.block_timesteps=block_timesteps
+        self.next_timestep=0
+        self.buffer=[]
+        self.blocks=[]
+        self.pending=deque()
+        self.outfile=open(blocks_file(path,name),"wb")
+
+    def __setitem__(self,h,value):
+        if(h!=self.next_timestep):
+            print("Internal error, the timesteps of the compressed field "+self.name+" must be written in order, "+str(self.next_timestep)+" was expected, "+str(h)+" received.\nI quit.")
+            sys.exit(2)
+        self.buffer.append(np.asarray(value,dtype=self.dtype).reshape(self.shape[1:]))
+        self.next_timestep=self.next_timestep+1
+        if((len(self.buffer)==self.block_timesteps) or (self.next_timestep==self.shape[0])):
+            self.add_block(get_executor().submit(compress_block,self.codec,np.ascontiguousarray(self.buffer).tobytes()))
+            self.buffer=[]
+
+    def add_compressed_block(self,data,n_timesteps):
+        #it adds a block of n_timesteps already compressed (e.g. by another process)
+        if((n_timesteps!=self.block_timesteps) and (self.next_timestep+n_timesteps!=self.shape[0])):
+            print("Internal error, the blocks of the compressed field "+self.name+" must contain "+str(self.block_timesteps)+" timesteps, except the last one.\nI quit.")
+            sys.exit(2)
+        self.next_timestep=self.next_timestep+n_timesteps
+        self.add_block(data)
+
+    def add_block(self,block):
+        #block can be the compressed data or a future returning them, we keep at most two blocks per thread in memory
+        self.pending.append(block)
+        while(len(self.pending)>2*compression_threads):
+            self.write_block(self.pending.popleft())
+
+    def write_block(self,block):
+        if(not isinstance(block,bytes)):
+            block=block.result()
+        self.blocks.append([self.outfile.tell(),len(block)])
+        self.outfile.write(block)
+
+    def close(self):
+        if(self.next_timestep!=self.shape[0]):
+            print("Internal error, only "+str(self.next_timestep)+" of the "+str(self.shape[0])+" timesteps of the compressed field "+self.name+" have been written.\nI quit.")
+            sys.exit(2)
+        while(len(self.pending)>0):
+            self.write_block(self.pending.popleft())
+        self.outfile.close()
+
+    def info(self):
+        return {"shape":list(self.shape),"dtype":self.dtype.str,"compression":self.codec,"block_timesteps":self.block_timesteps,"blocks":self.blocks}
+
+class CompressedField:
+    #read only access to a compressed field, it decompresses only the blocks containing the requested timesteps
+    #it supports the indexing of numpy arrays (the first index selects the timesteps) and the conversion into a numpy array
+
+    def __init__(self,path,name,info):
+        self.filename=blocks_file(path,name)
+        self.shape=tuple(info["shape"])
+        self.dtype=np.dtype(info["dtype"])
+        self.ndim=len(self.shape)
+        self.size=int(np.prod(self.shape))
+        self.codec=info["compression"]
+        self.block_timesteps=info["block_timesteps"]
+        self.blocks=info["blocks"]
+        check_codec(self.codec)
+        #the last decompressed block is kept, because the timesteps are often read one after the other
+        self.cached_block=(None,None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_block(self,b):
+        if(self.cached_block[0]==b):
+            return self.cached_block[1]
+        offset, size = self.blocks[b]
+        with open(self.filename,"rb") as infile:
+            infile.seek(offset)
+            data=infile.read(size)
+        instrumentation.add("bytes_compressed",size)
+        values=np.frombuffer(decompress_block(self.codec,data),dtype=self.dtype).reshape((-1,)+self.shape[1:])
+        self.cached_block=(b,values)
+        return values
+
+    def timesteps(self,hmin,hmax):
+        #it returns the timesteps hmin<=h<hmax, decompressing the blocks in parallel
+        first_block=hmin//self.block_timesteps
+        last_block=(hmax-1)//self.block_timesteps
+        if(last_block<first_block):
+            return np.zeros((0,)+self.shape[1:],dtype=self.dtype)
+        if(first_block==last_block):
+            values=self.read_block(first_block)
+        else:
+            values=np.concatenate(list(get_executor().map(self.read_block,range(first_block,last_block+1))))
+        start=first_block*self.block_timesteps
+        return values[hmin-start:hmax-start]
+
+    def __getitem__(self,key):
+        if(not isinstance(key,tuple)):
+            key=(key,)
+        if((len(key)>0) and isinstance(key[0],(int,np.integer))):
+            h=int(key[0])
+            if(h<0):
+                h=h+self.shape[0]
+            if((h<0) or (h>=self.shape[0])):
+                raise IndexError("index "+str(key[0])+" is out of bounds for the first axis with size "+str(self.shape[0]))
+            return self.timesteps(h,h+1)[(0,)+key[1:]]
+        if((len(key)>0) and isinstance(key[0],slice) and (key[0].step in (None,1))):
+            hmin, hmax, step = key[0].indices(self.shape[0])
+            return self.timesteps(hmin,max(hmin,hmax))[(slice(None),)+key[1:]]
+        return self.timesteps(0,self.shape[0])[key]
+
+    def __array__(self,dtype=None,copy=None):
+        values=self.timesteps(0,self.shape[0])
+        if(dtype is not None):
+            values=values.astype(dtype)
+        return values
+
+    def astype(self,dtype):
+        return self.timesteps(0,self.shape[0]).astype(dtype)
+
+def write_compressed_field(path,name,arr,codec):
+    writer=CompressedFieldWriter(path,name,arr.shape,arr.dtype,codec)
+    for h in range(arr.shape[0]):
+        writer[h]=arr[h]
+    writer.close()
+    return writer
+
+def json_value(obj):
+    #numpy arrays and scalars are converted into python lists and numbers
+    if(hasattr(obj,"tolist")):
+        return obj.tolist()
+    raise TypeError("Object of type "+type(obj).__name__+" cannot be stored in "+metadata_file)
+
+def decode_metadata(metadata):
+    #we restore the numpy types of the entries used as arrays by the scripts
+    if("lattice" in metadata):
+        lattice=metadata["lattice"]
+        lattice["dimensions"]=np.array(lattice["dimensions"],dtype=np.int32)
+        lattice["spacing"]=np.array(lattice["spacing"],dtype=np.float64)
+        lattice["origin"]=np.array(lattice["origin"],dtype=np.float64)
+    for coord in ("xx","yy","zz"):
+        if(coord in metadata):
+            metadata[coord]=np.array(metadata[coord],dtype=np.float64)
+    return metadata
+
+def prepare_directory(path):
+    if(os.path.exists(path) and not os.path.isdir(path)):
+        print("Error, "+path+" exists and it is not a directory, I cannot write the archive there.\nI quit.")
+        sys.exit(2)
+    os.makedirs(path,exist_ok=True)
+
+def remove_metadata(path):
+    #it marks an archive as incomplete, before its fields are modified
+    if(is_archive(path)):
+        os.remove(os.path.join(path,metadata_file))
+
+def new_field(path,name,shape,dtype=np.float64):
+    #it creates a field of an archive that can be filled slice by slice, the archive is complete only after write_metadata
+    prepare_directory(path)
+    #an existing archive is being overwritten, until the new metadata are written it is incomplete
+    remove_metadata(path)
+    #the dimensions can be numpy integers (e.g. taken from the lattice dictionary), which are not allowed in the .npy header
+    return np.lib.format.open_memmap(field_file(path,name),mode="w+",dtype=dtype,shape=tuple(int(n) for n in shape))
+
+def new_compressed_field(path,name,shape,dtype=np.float64,codec=default_codec,block_timesteps=None):
+    #as new_field, but the timesteps must be written in increasing order and the field must be closed before write_metadata
+    prepare_directory(path)
+    remove_metadata(path)
+    return CompressedFieldWriter(path,name,tuple(int(n) for n in shape),dtype,codec,block_timesteps)
+
+def open_field(path,name,mode="r"):
+    #it memory maps a single field of an archive, also if the archive is not complete yet
+    return np.load(field_file(path,name),mmap_mode=mode)
+
+def field_info(arr):
+    if(isinstance(arr,CompressedFieldWriter)):
+        return arr.info()
+    return {"shape":list(arr.shape),"dtype":np.dtype(arr.dtype).str}
+
+def write_metadata(path,kind,metadata,fields):
+    #metadata.json is written last and atomically, its presence marks a complete archive
+    os.makedirs(path,exist_ok=True)
+    info={name:field_info(arr) for name,arr in fields.items()}
+    #the archives without compressed fields can be read also by the scripts supporting only the version 1
+    if(any("compression" in field for field in info.values())):
+        content={"archive_version":archive_version,"kind":kind,"time_axis":0}
+    else:
+        content={"archive_version":1,"kind":kind,"time_axis":0}
+    content["fields"]=info
+    content["metadata"]=metadata
+    tmpfile=os.path.join(path,metadata_file+"."+str(os.getpid())+".tmp")
+    with open(tmpfile,"w") as outfile:
+        json.dump(content,outfile,default=json_value,indent=1)
+    os.replace(tmpfile,os.path.join(path,metadata_file))
+
+def write_archive(path,kind,metadata,fields,compression=None):
+    #the fields which are not already in the archive are written as .npy files or, if compression is a codec, as compressed fields
+    prepare_directory(path)
+    written={}
+    for name, arr in fields.items():
+        if(isinstance(arr,CompressedFieldWriter)):
+            #the field has been created in place with new_compressed_field, all its blocks must be on disk
+            arr.close()
+            written[name]=arr
+            stale_file=field_file(path,name)
+        elif(isinstance(arr,np.memmap) and os.path.abspath(arr.filename)==os.path.abspath(field_file(path,name))):
+            #the field has been created in place with new_field, we just make sure that it is on disk
+            arr.flush()
+            written[name]=arr
+            stale_file=blocks_file(path,name)
+        elif(compression is not None):
+            written[name]=write_compressed_field(path,name,arr,compression)
+            stale_file=field_file(path,name)
+        else:
+            np.save(field_file(path,name),arr)
+            written[name]=arr
+            stale_file=blocks_file(path,name)
+        #we remove the file with the same field written in the other format by a previous run
+        if(os.path.exists(stale_file)):
+            os.remove(stale_file)
+    write_metadata(path,kind,metadata,written)
+
+def open_archive(path,mode="r"):
+    #it returns the kind, the metadata and a dictionary with the memory mapped fields of an archive
+    with open(os.path.join(path,metadata_file),"r") as infile:
+        content=json.load(infile)
+    if(content.get("archive_version",0)>archive_version):
+        print("Error, the archive "+path+" has version "+str(content["archive_version"])+", but I can read only up to version "+str(archive_version)+".\nI quit.")
+        sys.exit(2)
+    fields={}
+    for name, info in content["fields"].items():
+        if("compression" in info):
+            if(mode!="r"):
+                print("Error, the compressed field "+name+" of the archive "+path+" cannot be modified in place.\nI quit.")
+                sys.exit(2)
+            fields[name]=CompressedField(path,name,info)
+        else:
+            fields[name]=open_field(path,name,mode)
+    return content["kind"],decode_metadata(content["metadata"]),fields
+
+def load_legacy(path,kind):
+    if(path[-3:]==".gz"):
+        pi=gzip.open(path,"rb")
+    else:
+        pi=open(path,"rb")
+    data=pickle.load(pi)
+    pi.close()
+    if(len(data)!=len(legacy_layouts[kind])):
+        print("Error, "+path+" contains "+str(len(data))+" entries, while an archive of kind "+kind+" should contain "+str(len(legacy_layouts[kind]))+".\nI quit.")
+        sys.exit(2)
+    return dict(zip(legacy_layouts[kind],data))
+
+def read_archive(path,kind):
+    #it returns a dictionary with all the entries of an archive of the given kind, the fields of the new archives are memory mapped
+    if(is_archive(path)):
+        archive_kind,metadata,fields=open_archive(path)
+        if(archive_kind!=kind):
+            print("Error, "+path+" is an archive of kind "+archive_kind+", but I expected an archive of kind "+kind+".\nI quit.")
+            sys.exit(2)
+        entries=metadata.copy()
+        entries.update(fields)
+        return entries
+    if(not os.path.isfile(path)):
+        print("Error, "+path+" is neither an archive directory nor a pickled file.\nI quit.")
+        sys.exit(2)
+    return load_legacy(path,kind)
+
+def load(path,kind,extra=(),lazy=False):
+    #it returns the same tuple stored in the legacy pickled archives, followed by the optional entries listed in extra (None if missing)
+    #the compressed fields are decompressed into numpy arrays, unless lazy is True: in this case they are returned as CompressedField,
+    #which decompresses only the requested timesteps, for the consumers that read the fields one timestep at a time
+    entries=read_archive(path,kind)
+    missing=[name for name in legacy_layouts[kind] if name not in entries]
+    if(len(missing)>0):
+        print("Error, the entries "+", ".join(missing)+" are missing in "+path+".\nI quit.")
+        sys.exit(2)
+    if(not lazy):
+        entries={name:(np.asarray(value) if isinstance(value,CompressedField) else value) for name,value in entries.items()}
+    return tuple(entries[name] for name in legacy_layouts[kind])+tuple(entries.get(name) for name in extra)
+
+def save(path,kind,*data,extra_fields=None,extra_metadata=None,compression=None):
+    #it writes an archive from the same tuple stored in the legacy pickled archives, plus the optional arrays in extra_fields
+    #and the optional entries of metadata.json in extra_metadata
+    if(len(data)!=len(legacy_layouts[kind])):
+        print("Internal error, an archive of kind "+kind+" needs "+str(len(legacy_layouts[kind]))+" entries, but I received "+str(len(data))+".\nI quit.")
+        sys.exit(2)
+    entries=dict(zip(legacy_layouts[kind],data))
+    metadata={name:entries[name] for name in metadata_entries[kind]}
+    fields={name:entries[name] for name in legacy_layouts[kind] if name not in metadata_entries[kind]}
+    if(extra_metadata is not None):
+        metadata.update(extra_metadata)
+    if(extra_fields is not None):
+        fields.update({name:arr for name,arr in extra_fields.items() if arr is not None})
+    write_archive(path,kind,metadata,fields,compression)
+
+#order of the axes of the fields of the archives of kind lattice, stored in lattice["axes"]
+#the preprocessor stores the cells in the same order of the SMASH output files, with x as the fastest index (native_axes),
+#the archives written before the introduction of this entry have x as the slowest index (legacy_axes)
+native_axes=["t","component","z","y","x"]
+legacy_axes=["t","component","x","y","z"]
+
+def field_axes(lattice):
+    return list(lattice.get("axes",legacy_axes))
+
+def axis_index(lattice,name):
+    #position of the axis name ("t", "component", "x", "y" or "z") in the fields of an archive with the given lattice
+    return field_axes(lattice).index(name)
+
+class TransposedField:
+    #a compressed field with its axes permuted, the permutation is applied to the timesteps when they are read,
+    #so that only the blocks containing the requested timesteps are decompressed
+
+    def __init__(self,field,perm):
+        self.field=field
+        self.perm=list(perm)
+        self.shape=tuple(field.shape[p] for p in self.perm)
+        self.dtype=field.dtype
+        self.ndim=field.ndim
+        self.size=field.size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,key):
+        if(isinstance(key,(int,np.integer))):
+            return self.field[key].transpose([p-1 for p in self.perm[1:]])
+        if(isinstance(key,slice) and (key.step in (None,1))):
+            #a range of timesteps, e.g. a slab of the script D
+            return self.field[key].transpose(self.perm)
+        return np.asarray(self.field).transpose(self.perm)[key]
+
+    def __array__(self,dtype=None,copy=None):
+        values=np.asarray(self.field).transpose(self.perm)
+        if(dtype is not None):
+            values=values.astype(dtype)
+        return values
+
+    def astype(self,dtype):
+        return np.asarray(self.field).transpose(self.perm).astype(dtype)
+
+def with_axes(lattice,arr,axes):
+    #it returns the field arr (or a single timestep of it) of an archive with the given lattice with its axes in the order axes,
+    #numpy arrays are transposed without copying the data, the time axis cannot be moved
+    if(arr is None):
+        return None
+    current=field_axes(lattice)[-arr.ndim:]
+    target=list(axes)[-arr.ndim:]
+    if(current==target):
+        return arr
+    perm=[current.index(name) for name in target]
+    if(isinstance(arr,CompressedField)):
+        return TransposedField(arr,perm)
+    return arr.transpose(perm)
+
+#the archives of kind lattice can contain the field M2 with the sums of the squared deviations from the mean over the events
+#of the components listed in lattice["moments"], with shape nt,len(lattice["moments"]) followed by the spatial axes (see lattice["axes"])
+#the variance of the components is M2/(N_events-1) and the variance of their mean over the events is M2/(N_events*(N_events-1))
+
+def moment_values(lattice,Tmunu,jQBS,v):
+    #it returns the components listed in lattice["moments"] stacked along the component axis (the fourth from the end),
+    #Tmunu, jQBS and v can be single timesteps or arrays with all the timesteps
+    arrays={"Tmunu":Tmunu,"jQBS":jQBS,"v":v}
+    values=[]
+    for name in lattice["moments"]:
+        for family, names in lattice["components"].items():
+            if(name in names):
+                values.append(arrays[family][...,names.index(name),:,:,:])
+    return np.stack(values,axis=-4)
+
+def merge_moments(M2,sums,N,p_M2,p_sums,p_N):
+    #it adds in place to M2 the second moments p_M2 of other p_N events, given the sums over the events of both sets
+    #(parallel algorithm by Chan, Golub and LeVeque)
+    delta=p_sums/p_N-sums/N
+    M2+=p_M2+delta**2*(N*p_N/(N+p_N))
@@ -5,11 +5,11 @@ import math
 import numpy as np
 import sys
 import os
-import pickle
 import matplotlib
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib.pyplot as plt
 from matplotlib.colors import DivergingNorm
+import lattice_archive
 hbarc=0.197326
 
 
@@ -26,7 +26,7 @@ minlogval=-3 #minimum value to display in log plots
 N_input_files=len(sys.argv)-1
 
 if(N_input_files!=3):
-   print ('Syntax: python3 make_vort_deriv_plots_for_dbg_smash.py <pickle binary data file> <output directory> <plot common title>')
+   print ('Syntax: python3 make_vort_deriv_plots_for_dbg_smash.py <vorticity gradients archive> <output directory> <plot common title>')
    sys.exit(1)
 
 inputfile=sys.argv[1]
@@ -35,10 +35,7 @@ common_title=sys.argv[3]
 if(not os.path.exists(od)):
   os.mkdir(od)
 
-with open(inputfile,"rb") as pi:
-     data=pickle.load(pi)
-
-tt,xx,yy,zz,vx,vy,vz,temp,bt,bx,by,bz,dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy=data[:]
+tt,xx,yy,zz,vx,vy,vz,temp,bt,bx,by,bz,dbt_dx,dbt_dy,dbt_dz,dbx_dt,dby_dt,dbz_dt,dbx_dy,dbx_dz,dby_dx,dby_dz,dbz_dx,dbz_dy=lattice_archive.load(inputfile,"gradients")
 
 omega_tx=0.5*hbarc*(dbt_dx-dbx_dt)
 omega_ty=0.5*hbarc*(dbt_dy-dby_dt)
@@ -7,11 +7,10 @@ import math
 import numpy as np
 import sys
 import os
-import pickle
 import matplotlib
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib.pyplot as plt
-import gzip
+import lattice_archive
 
 # we make 2D x-z plots at y=y_of_interest, for t_min<=t<=t_max 
 y_of_interest=[0.]
@@ -25,7 +24,7 @@ vorticity_cmap = matplotlib.cm.gnuplot
 N_input_files=len(sys.argv)-1
 
 if(N_input_files!=3):
-   print ('Syntax: python3 make_vorticity_plots_smash.py <pickle binary data file> <output directory> <plot common title>')
+   print ('Syntax: python3 make_vorticity_plots_smash.py <vorticity archive> <output directory> <plot common title>')
    sys.exit(1)
 
 inputfile=sys.argv[1]
@@ -34,17 +33,8 @@ common_title=sys.argv[3]
 if(not os.path.exists(od)):
   os.mkdir(od)
 
-if(inputfile[-3:]==".gz"):
-    print("Opening gzipped file "+inputfile)
-    infile=gzip.open(inputfile,"rb")
-else:
-    print("Opening file "+inputfile)
-    infile=open(inputfile,"rb")
-
-data=pickle.load(infile)
-infile.close()
-
-tt,xx,yy,zz,vx,vy,vz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=data[:]
+print("Opening "+inputfile)
+tt,xx,yy,zz,vx,vy,vz,temp,omega_tx,omega_ty,omega_tz,omega_yz,omega_zx,omega_xy=lattice_archive.load(inputfile,"vorticity")
 
 
 yy_selected=[] #it contains the indexes of yy correponding to the z_of_interest points
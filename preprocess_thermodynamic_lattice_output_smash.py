@@ -5,103 +5,99 @@ import math
 import numpy as np
 import sys
 import os
-import pickle
 import os.path
 import glob
+import hashlib
+import gzip
+import lzma
+import io
+import queue
+import threading
+import multiprocessing
+import json
+import shutil
+import socket
+import time
+from itertools import islice
 from timeit import default_timer as timer
+import lattice_archive
+import instrumentation
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
 
 sys.setrecursionlimit(10000)
 
 #use binary (True) or ascii (False) input data
 use_binary=False
 
-#density tpye (it can be baryon or hadron)
+#density tpye (it can be baryon or hadron, or both to process the two families of files in a single run), it can be changed with the --density-type option
 density_type="hadron"
 #density_type="baryon"
+#density_type="both"
 
-#if False it prints only error messages, if True it writes what it is doing at the moment and the intermediate results 
+#prefixes of the names of the files of each density type
+density_prefixes={"hadron":"hadron_","baryon":"net_baryon_"}
+
+#if False it prints only error messages, if True it writes what it is doing at the moment and the intermediate results
 verbose=False
 
 #output file version check
 designed_lattice_version=1.0
 
-if(verbose):
-    init_start=timer()
+#number of processes reading the event files, it can be changed with the --workers option
+workers=1
 
-#we parse the command line arguments
-N_input_args=len(sys.argv)-1
+#spatial box of cells to keep, as [imin,imax,jmin,jmax,kmin,kmax] with imin<=i<imax etc. (None = whole lattice),
+#it can be changed with the --box option
+box=None
+#time interval [tmin,tmax] of the timesteps to keep (None = all timesteps), it can be changed with the --time-range option
+time_window=None
 
-if(N_input_args!=2):
-   print ('Syntax: python3 preprocess_thermodynamic_lattice_output_smash.py <data dir> <outputfile>')
-   print ("where:\n  <data dir> is the directory containing the files produced by SMASH with Thermodynamic Lattice Output")
-   print ("  <outputfile> is obviously the name of the output file with the results of the postprocessing")
-   sys.exit(1)
+#components stored in the output file (None = all), it can be changed with the --components option
+selected_components=None
+#type of the arrays in the output file, it can be changed to np.float32 with the --float32 option
+#the sums over the events are always computed in double precision
+output_dtype=np.float64
 
-#we get the name of input and output files
-inputdir=sys.argv[1]
-outputfile=sys.argv[2]
+#components whose second moments over the events are accumulated together with the sums (None = none),
+#it can be changed with the --moments option
+moment_components=None
 
-#we prepare lists of the input files
-if (density_type == "hadron"):
-    if(use_binary):
-        net_bar_files=glob.glob(inputdir+'/hadron_j_QBS_*.bin')
-        Tmunu_files=glob.glob(inputdir+'/hadron_tmn_landau_*.bin')
-        vLandau_files=glob.glob(inputdir+'/hadron_v_landau_*.bin')
-    else:
-        net_bar_files=glob.glob(inputdir+'/hadron_j_QBS_*.dat')
-        Tmunu_files=glob.glob(inputdir+'/hadron_tmn_landau_*.dat')
-        vLandau_files=glob.glob(inputdir+'/hadron_v_landau_*.dat')
-elif (density_type == "baryon"):
-    if(use_binary):
-        net_bar_files=glob.glob(inputdir+'/net_baryon_j_QBS_*.bin')
-        Tmunu_files=glob.glob(inputdir+'/net_baryon_tmn_landau_*.bin')
-        vLandau_files=glob.glob(inputdir+'/net_baryon_v_landau_*.bin')
-    else:
-        net_bar_files=glob.glob(inputdir+'/net_baryon_j_QBS_*.dat')
-        Tmunu_files=glob.glob(inputdir+'/net_baryon_tmn_landau_*.dat')
-        vLandau_files=glob.glob(inputdir+'/net_baryon_v_landau_*.dat')
-else:
-    print("Unknown density_type parameter (please, check the first lines of the script source code and fix it)")
-    sys.exit(2)
-
-#we sort the lists of input files
-net_bar_files.sort()
-Tmunu_files.sort()
-vLandau_files.sort()
-
-nf_bar=len(net_bar_files)
-nf_tmn=len(Tmunu_files)
-nf_vl=len(vLandau_files)
-
-if((nf_bar != nf_tmn) or (nf_bar != nf_vl)):
-    print("Sorry, but I can't continue.")
-    print("I have found "+str(nf_bar)+" density current files, "+str(nf_tmn)+" Tmunu files, "+str(nf_vl)+" Landau velocity files")
-    sys.exit(2)
-
-#we check that all the input files have non zero length
-for i in range(nf_bar):
-    if((os.path.getsize(net_bar_files[i])==0) or (os.path.getsize(Tmunu_files[i])==0) or (os.path.getsize(vLandau_files[i])==0)):
-        print("Because of a zero length file, I will not consider:")
-        print(nf_bar.pop(i))
-        print(nf_tmn.pop(i))
-        print(nf_vl.pop(i))
-
-#we update the length of the files
-nf_bar=len(net_bar_files)
-nf_tmn=len(Tmunu_files)
-nf_vl=len(vLandau_files)
-
-if(nf_bar*nf_tmn*nf_vl==0):
-    print("Input files missing. I quit")
-    sys.exit(2)
-else:
-    nf=nf_bar #we use a common variable for all file lengths
-
-#dictionary containing information about the grid
-lattice={}
-
-#number of events
-N_events=0
+#codec used to compress the arrays of the output archive (None = not compressed), it can be changed with the --compress option
+compression=None
+
+#extensions of the compressed input files, they are decompressed by a background thread while the data are parsed
+compressed_extensions=(".gz",".xz",".zst")
+#size in bytes of the blocks of decompressed data and maximum number of blocks waiting to be parsed
+decompression_block_size=4*1024**2
+decompression_queue_length=16
+
+#directory where the binary copies of the ascii input files are stored (None = no cache), it can be changed with the --cache option
+cache_dir=None
+#maximum size of the cache in GB, when it is exceeded the least recently used files are deleted, it can be changed with the --cache-size option
+cache_max_size=100.
+#the temporary copies left by the interrupted runs on other hosts are deleted when they are not modified for this number of hours
+#(those of the interrupted runs on this host are deleted as soon as their process is not alive)
+cache_stale_hours=24.
+
+#interval in minutes between the checkpoints of the partial sums (None = no checkpoints), it can be changed with the --checkpoint option
+#the checkpoints are written in the directory <outputfile>.checkpoint, which is removed when the output archive is complete
+checkpoint_interval=None
+#if True the run continues from the checkpoints of a previous interrupted run, it can be set with the --resume option
+resume=False
+#interval in minutes used with --resume when --checkpoint is not given
+default_checkpoint_interval=30.
+
+#file where the statistics about the run (time spent in each stage, bytes read, events per second, peak memory) are written
+#in json format (None = no statistics), it can be changed with the --stats option
+stats_file=None
+
+#index of the input files written by the --scan option and read by the --index option (None = no index)
+index_file=None
+#if True the input files are only scanned and the index is written, without processing the events
+scan_only=False
 
 #correspondences between the indexes of the 1D Tmunu array and the energy momentum rank 2 tensor
 iT00=0
@@ -127,17 +123,116 @@ kb1=5
 kb2=6
 kb3=7
 
-#empty list with the results
-T_list=[]
-jQBS_list=[]
-v_list=[]
+#names of the components of Tmunu, j_QBS and v in the input files, in the same order
+Tmunu_names=["T00","T01","T02","T03","T11","T12","T13","T22","T23","T33"]
+jQBS_names=["jQ0","jQ1","jQ2","jQ3","jB0","jB1","jB2","jB3","jS0","jS1","jS2","jS3"]
+v_names=["vx","vy","vz"]
 
-#empty list with the output times
-tt=[]
+#predefined sets of components that can be given to the --components option
+#vorticity: what is used by compute_vorticity_from_th_latt_output_smash.py (no off-diagonal Tmunu, no strangeness current)
+component_presets={"vorticity":["T00","jQ0","jQ1","jQ2","jQ3","jB0","jB1","jB2","jB3","vx","vy","vz"]}
 
 #format to display the computation time
 tf='{:8.5f}'
 
+class DecompressedStream(io.RawIOBase):
+    #read only file object with the content of a compressed file
+    #a background thread decompresses the file in blocks and puts them into a queue of limited length,
+    #so that decompression and parsing overlap, while the memory used stays bounded
+    def __init__(self,filename):
+        self.name=filename
+        self.blocks=queue.Queue(maxsize=decompression_queue_length)
+        self.pending=memoryview(b"")
+        self.finished=False
+        self.stop=threading.Event()
+        self.worker=threading.Thread(target=self.decompress,daemon=True)
+        self.worker.start()
+
+    def decompress(self):
+        try:
+            if(self.name.endswith(".gz")):
+                fd=gzip.open(self.name,"rb")
+            elif(self.name.endswith(".xz")):
+                fd=lzma.open(self.name,"rb")
+            else:
+                fd=zstandard.ZstdDecompressor().stream_reader(open(self.name,"rb"),closefd=True)
+            with fd:
+                while(not self.stop.is_set()):
+                    with instrumentation.stage("decompression"):
+                        block=fd.read(decompression_block_size)
+                    if(len(block)==0):
+                        break
+                    instrumentation.add("bytes_decompressed",len(block))
+                    self.put(block)
+            instrumentation.add("bytes_compressed",os.path.getsize(self.name))
+        except Exception as err:
+            self.put(err)
+        self.put(None)
+
+    def put(self,item):
+        #it waits until there is room in the queue, unless the reader has been closed
+        while(not self.stop.is_set()):
+            try:
+                self.blocks.put(item,timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self,buf):
+        while((len(self.pending)==0) and (not self.finished)):
+            block=self.blocks.get()
+            if(block is None):
+                self.finished=True
+            elif(isinstance(block,Exception)):
+                print("Error when decompressing file "+self.name+": "+str(block)+"\nI quit.")
+                sys.exit(2)
+            else:
+                self.pending=memoryview(block)
+        n=min(len(buf),len(self.pending))
+        buf[:n]=self.pending[:n]
+        self.pending=self.pending[n:]
+        return n
+
+    def close(self):
+        self.stop.set()
+        super().close()
+
+def is_compressed(filename):
+    return filename.endswith(compressed_extensions)
+
+def open_input(filename,binary):
+    #it opens an input file, compressed files are decompressed by a background thread
+    if(is_compressed(filename)):
+        if(filename.endswith(".zst") and (zstandard is None)):
+            print("Sorry, the python module zstandard is needed to read "+filename+".\nI quit.")
+            sys.exit(2)
+        stream=io.BufferedReader(DecompressedStream(filename),buffer_size=decompression_block_size)
+        if(binary):
+            return stream
+        else:
+            return io.TextIOWrapper(stream)
+    elif(binary):
+        return open(filename,"rb")
+    else:
+        return open(filename,"r")
+
+def read_values(infile,dtype,count):
+    #it works with both ordinary files and decompressed streams, unlike np.fromfile
+    with instrumentation.stage("parse"):
+        data=infile.read(count*np.dtype(dtype).itemsize)
+    instrumentation.add("bytes_read",len(data))
+    return np.frombuffer(data,dtype=dtype)
+
+def find_input_files(inputdir,prefix,extension):
+    #it returns the files with the given prefix and extension, also compressed
+    files=glob.glob(inputdir+"/"+prefix+"*"+extension)
+    for compressed_extension in compressed_extensions:
+        files=files+glob.glob(inputdir+"/"+prefix+"*"+extension+compressed_extension)
+    return files
+
 #functions to read the header
 def read_ascii_header(infile):
     lattice_version=float(infile.readline().split()[4])
@@ -151,213 +246,1100 @@ def read_ascii_header(infile):
     return lattice_dimensions, lattice_spacing, lattice_origin
 
 def read_binary_header(infile):
-    lattice_version=np.fromfile(infile,dtype=np.float64,count=1)[0]
+    lattice_version=read_values(infile,np.float64,1)[0]
     if(lattice_version != designed_lattice_version):
         print("Sorry, this code for analysis is designed for output version: "+str(designed_lattice_version)+", while you provided "+str(lattice_version)+"\n. I quit.")
         sys.exit(2)
-    lattice_quantity=np.fromfile(infile,dtype=np.int32,count=1)[0]
-    lattice_dimensions=np.fromfile(infile,dtype=np.int32,count=3)
-    lattice_spacing=np.fromfile(infile,dtype=np.float64,count=3)
-    lattice_origin=np.fromfile(infile,dtype=np.float64,count=3)
+    lattice_quantity=read_values(infile,np.int32,1)[0]
+    lattice_dimensions=read_values(infile,np.int32,3)
+    lattice_spacing=read_values(infile,np.float64,3)
+    lattice_origin=read_values(infile,np.float64,3)
     return lattice_dimensions, lattice_spacing, lattice_origin
 
-def read_ascii_timestep_tmn(infile):
+def read_ascii_block(infile,nrows,nvalues,time):
+    #it reads nrows lines at once and it converts them to float64 with a single call, instead of parsing them line by line
+    #time is the time of the timestep, used only in the error messages
+    with instrumentation.stage("parse"):
+        text="".join(islice(infile,nrows))
+        try:
+            values=np.fromstring(text,dtype=np.float64,sep=" ")
+        except ValueError as error:
+            #the recent versions of numpy do not stop at the first malformed value, they raise an exception
+            print("Error when reading file "+infile.name+" at time "+str(time)+": "+str(error)+".\nI quit.")
+            sys.exit(2)
+    instrumentation.add("bytes_read",len(text))
+    if(len(values)!=nvalues):
+        print("Error when reading file "+infile.name+" at time "+str(time)+": "+str(nvalues)+" values were expected in the timestep, but "+str(len(values))+" were found.\nI quit.")
+        sys.exit(2)
+    return values
+
+def read_ascii_time(infile):
     #it returns True in case of EoF
     time_entry=infile.readline()
     if(time_entry==''):
-        return True, None, None
+        return True, None
     else:
-        time=np.float64(time_entry)
-    Tmunu=np.empty((10,nx,ny,nz),dtype=np.float64)
-    for i in range(10):
-        tmp_arr=np.loadtxt(infile,max_rows=ny*nz).flatten().reshape(nz,ny,nx).transpose()
-        Tmunu[i,:,:,:]=tmp_arr.copy()
-    return False, time, Tmunu
+        return False, np.float64(time_entry)
+
+def read_ascii_timestep_tmn(infile,nx,ny,nz,time):
+    #it reads the data after the time entry, already read by read_ascii_time
+    #the 10 components are written one after the other, each of them in ny*nz rows with nx values
+    #so the array with shape (10,nz,ny,nx) is already in the order of the output archive and it is not transposed
+    Tmunu=read_ascii_block(infile,10*ny*nz,10*nx*ny*nz,time).reshape(10,nz,ny,nx)
+    return Tmunu
 
-def read_binary_timestep_tmn(infile):
+def skip_ascii_rows(infile,nrows):
+    #it moves forward by nrows lines without parsing them
+    with instrumentation.stage("skip"):
+        instrumentation.add("bytes_read",sum(len(row) for row in islice(infile,nrows)))
+
+def read_binary_timestep_tmn(infile,nx,ny,nz):
     #it returns True in case of EoF
-    time_entry=np.fromfile(infile,dtype=np.float64,count=1)
+    #it is used only for the streams that cannot be memory mapped (i.e. compressed files)
+    time_entry=read_values(infile,np.float64,1)
     if(len(time_entry)==0):
         return True, None, None
     else:
         time=time_entry[0]
-    Tmunu=np.empty((10,nx,ny,nz),dtype=np.float64)
-    for i in range(10):
-        tmp_arr=np.fromfile(infile,dtype=np.float64,count=nx*ny*nz).flatten().reshape(nz,ny,nx).transpose()
-        Tmunu[i,:,:,:]=tmp_arr.copy()
+    Tmunu=read_values(infile,np.float64,10*nx*ny*nz).reshape(10,nz,ny,nx)
     return False, time, Tmunu
 
-def read_ascii_timestep_jqbs(infile):
+def read_ascii_timestep_jqbs(infile,nx,ny,nz,time):
     #we do not check the time entry
     time_entry=infile.readline()
-    tmp_arr=np.loadtxt(infile,max_rows=nx*ny*nz).flatten().reshape(nz,ny,nx,12).transpose()
+    tmp_arr=read_ascii_block(infile,nx*ny*nz,nx*ny*nz*12,time).reshape(nz,ny,nx,12).transpose(3,0,1,2)
     return tmp_arr
 
-def read_binary_timestep_jqbs(infile):
+def read_binary_timestep_jqbs(infile,nx,ny,nz):
     #we do not check the time entry
-    time_entry=np.fromfile(infile,dtype=np.float64,count=1)
-    tmp_arr=np.fromfile(infile,dtype=np.float64,count=nx*ny*nz*12).flatten().reshape(nz,ny,nx,12).transpose()
+    time_entry=read_values(infile,np.float64,1)
+    tmp_arr=read_values(infile,np.float64,nx*ny*nz*12).reshape(nz,ny,nx,12).transpose(3,0,1,2)
     return tmp_arr
 
-def read_ascii_timestep_vl(infile):
+def read_ascii_timestep_vl(infile,nx,ny,nz,time):
     #we do not check the time entry
     time_entry=infile.readline()
-    tmp_arr=np.loadtxt(infile,max_rows=nx*ny*nz).flatten().reshape(nz,ny,nx,3).transpose()
+    tmp_arr=read_ascii_block(infile,nx*ny*nz,nx*ny*nz*3,time).reshape(nz,ny,nx,3).transpose(3,0,1,2)
     return tmp_arr
 
-def read_binary_timestep_vl(infile):
+def read_binary_timestep_vl(infile,nx,ny,nz):
     #we do not check the time entry
-    time_entry=np.fromfile(infile,dtype=np.float64,count=1)
-    tmp_arr=np.fromfile(infile,dtype=np.float64,count=nx*ny*nz*3).flatten().reshape(nz,ny,nx,3).transpose()
+    time_entry=read_values(infile,np.float64,1)
+    tmp_arr=read_values(infile,np.float64,nx*ny*nz*3).reshape(nz,ny,nx,3).transpose(3,0,1,2)
     return tmp_arr
 
-for n_i in range(nf):
-    i_tmn=Tmunu_files[n_i]
-    i_jqbs=net_bar_files[n_i]
-    i_vl=vLandau_files[n_i]
+def binary_step_dtype(ncomp,lattice_dimensions):
+    #every timestep of a binary file is a record made by the time and by ncomp*nx*ny*nz values
+    lx,ly,lz=lattice_dimensions[:]
+    return np.dtype([("time",np.float64),("data",np.float64,(ncomp*lx*ly*lz,))])
+
+def map_binary_file(filename,ncomp):
+    #it maps the whole binary file in memory without reading it
+    #it returns the lattice information, an array with the times and a 2D array (timestep, values), both as views of the file
+    with open(filename,"rb") as infile:
+        lattice_dimensions, lattice_spacing, lattice_origin = read_binary_header(infile)
+        offset=infile.tell()
+    lx,ly,lz=lattice_dimensions[:]
+    step_dtype=binary_step_dtype(ncomp,lattice_dimensions)
+    #an incomplete last timestep (e.g. from an interrupted run) is ignored
+    n_steps=(os.path.getsize(filename)-offset)//step_dtype.itemsize
+    if(n_steps==0):
+        return lattice_dimensions, lattice_spacing, lattice_origin, np.empty(0,dtype=np.float64), np.empty((0,ncomp*lx*ly*lz),dtype=np.float64)
+    steps=np.memmap(filename,dtype=step_dtype,mode="r",offset=offset,shape=(n_steps,))
+    return lattice_dimensions, lattice_spacing, lattice_origin, steps["time"], steps["data"]
+
+def mapped_timestep_tmn(data,h,nx,ny,nz):
+    #view with shape (10,nz,ny,nx) of the timestep h, no data is copied
+    return data[h].reshape(10,nz,ny,nx)
+
+def mapped_timestep_jqbs(data,h,nx,ny,nz):
+    #view with shape (12,nz,ny,nx) of the timestep h, no data is copied
+    #in the file the components are the fastest index, the view moves them in front without changing the order of the cells
+    return data[h].reshape(nz,ny,nx,12).transpose(3,0,1,2)
+
+def mapped_timestep_vl(data,h,nx,ny,nz):
+    #view with shape (3,nz,ny,nx) of the timestep h, no data is copied
+    return data[h].reshape(nz,ny,nx,3).transpose(3,0,1,2)
+
+def cache_file_name(filename):
+    #name of the binary copy of an ascii file in the cache, the key changes if the file is modified
+    file_stat=os.stat(filename)
+    key=os.path.abspath(filename)+"|"+str(file_stat.st_size)+"|"+str(file_stat.st_mtime_ns)
+    return os.path.join(cache_dir,hashlib.sha1(key.encode()).hexdigest()+".bin")
+
+#temporary copies being written by this process, they are deleted by discard_cache_writers if the reading of the event is not completed
+cache_writers=[]
+
+def open_cache_writer(filename,lattice_dimensions,lattice_spacing,lattice_origin):
+    #it creates a temporary binary file with the same header of the SMASH binary output
+    #it is renamed with the final name only when complete, so that interrupted conversions are never used
+    #the name of the temporary file contains the host and the process writing it, so that evict_cache can recognize the stale ones
+    fc=open(cache_file_name(filename)+"."+socket.gethostname()+"."+str(os.getpid())+".tmp","wb")
+    cache_writers.append(fc)
+    np.array([designed_lattice_version],dtype=np.float64).tofile(fc)
+    np.array([0],dtype=np.int32).tofile(fc) #the lattice quantity is not used by this script
+    np.array(lattice_dimensions,dtype=np.int32).tofile(fc)
+    np.array(lattice_spacing,dtype=np.float64).tofile(fc)
+    np.array(lattice_origin,dtype=np.float64).tofile(fc)
+    return fc
+
+def write_cache_timestep(fc,time,values):
+    #values must be in the same order of the file, i.e. (10,nz,ny,nx) for Tmunu and (nz,ny,nx,ncomp) for j_QBS and v
+    with instrumentation.stage("cache"):
+        np.array([time],dtype=np.float64).tofile(fc)
+        np.ascontiguousarray(values).tofile(fc)
+
+def close_cache_writer(fc,filename):
+    fc.close()
+    os.replace(fc.name,cache_file_name(filename))
+    cache_writers.remove(fc)
+
+def discard_cache_writers():
+    #it closes and deletes the temporary copies of the event which was being read when an error occurred
+    while(len(cache_writers)>0):
+        fc=cache_writers.pop()
+        fc.close()
+        if(os.path.exists(fc.name)):
+            os.remove(fc.name)
+
+def process_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        #the process exists, but it belongs to another user
+        return True
+    return True
+
+def stale_cache_file(tmpfile):
+    #a temporary copy is stale if the process writing it on this host is not alive or if it has not been modified for cache_stale_hours
+    fields=os.path.basename(tmpfile).split(".")
+    if((len(fields)>=5) and (fields[-3]==socket.gethostname()) and fields[-2].isdigit()):
+        if(not process_alive(int(fields[-2]))):
+            return True
+    return os.path.getmtime(tmpfile)<time.time()-cache_stale_hours*3600
+
+def evict_cache():
+    #it deletes the stale temporary copies and the least recently used files until the cache is smaller than cache_max_size
+    #the modification time of the files in the cache is updated every time that they are used
+    #it is called both at the beginning and at the end of a run, so that the files left by the interrupted runs are removed
+    for tmpfile in glob.glob(os.path.join(cache_dir,"*.bin.*.tmp")):
+        try:
+            if(stale_cache_file(tmpfile)):
+                os.remove(tmpfile)
+                if(verbose):
+                    print("Removed the stale temporary file "+tmpfile+" from the cache")
+        except FileNotFoundError:
+            #it has just been completed or removed by its own process
+            pass
+    cached_files=glob.glob(os.path.join(cache_dir,"*.bin"))
+    cached_files.sort(key=os.path.getmtime)
+    #the temporary copies still being written count in the size of the cache, but they are not deleted
+    cache_size=sum(os.path.getsize(f) for f in cached_files+glob.glob(os.path.join(cache_dir,"*.bin.*.tmp")) if os.path.exists(f))
+    while((cache_size>cache_max_size*1024**3) and (len(cached_files)>0)):
+        oldest=cached_files.pop(0)
+        cache_size=cache_size-os.path.getsize(oldest)
+        os.remove(oldest)
+        if(verbose):
+            print("Removed "+oldest+" from the cache")
+
+def init_worker(settings):
+    #the settings given on the command line are copied in the worker processes
+    globals().update(settings)
+
+def component_indexes(names):
+    #it returns the indexes of the selected components among names, or a slice (i.e. a view, not a copy) if they are all selected
+    if(selected_components is None):
+        return slice(None)
+    indexes=[i for i,n in enumerate(names) if n in selected_components]
+    if(len(indexes)==len(names)):
+        return slice(None)
+    return indexes
+
+def component_names(names,indexes):
+    #names of the components selected by component_indexes
+    if(isinstance(indexes,slice)):
+        return names[indexes]
+    return [names[i] for i in indexes]
+
+def time_selected(time):
+    return (time_window is None) or ((time>=time_window[0]) and (time<=time_window[1]))
+
+def crop_box(lattice_dimensions,lattice_spacing,lattice_origin):
+    #it returns the slices with the selected cells and the dimensions and origin of the cropped lattice
+    if(box is None):
+        return (slice(None),slice(None),slice(None)), lattice_dimensions, lattice_origin
+    for d in range(3):
+        if((box[2*d]<0) or (box[2*d+1]>lattice_dimensions[d]) or (box[2*d]>=box[2*d+1])):
+            print("Error, the box "+str(box)+" is not compatible with the lattice dimensions "+str(lattice_dimensions)+".\nI quit.")
+            sys.exit(2)
+    slices=(slice(box[0],box[1]),slice(box[2],box[3]),slice(box[4],box[5]))
+    cropped_dimensions=np.array([box[1]-box[0],box[3]-box[2],box[5]-box[4]],dtype=lattice_dimensions.dtype)
+    cropped_origin=lattice_origin+np.array([box[0],box[2],box[4]])*lattice_spacing
+    return slices, cropped_dimensions, cropped_origin
+
+def check_lattice(lattice,lattice_dimensions,lattice_spacing,lattice_origin,filename):
+    #it stops the program if the lattice of a file is different from the lattice that we have until now
+    if(not np.array_equal(lattice["dimensions"],lattice_dimensions)):
+        print("Error in file "+filename+": different lattice dimensions. Until now: "+str(lattice["dimensions"])+", this time: "+str(lattice_dimensions)+".\nI quit.")
+        sys.exit(2)
+    if(not np.array_equal(lattice["spacing"],lattice_spacing)):
+        print("Error in file "+filename+": different lattice spacing. Until now: "+str(lattice["spacing"])+", this time: "+str(lattice_spacing)+".\nI quit.")
+        sys.exit(2)
+    if(not np.array_equal(lattice["origin"],lattice_origin)):
+        print("Error in file "+filename+": different lattice origin. Until now: "+str(lattice["origin"])+", this time: "+str(lattice_origin)+".\nI quit.")
+        sys.exit(2)
+
+def checkpoint_settings():
+    #settings that must be the same when a run is resumed from a checkpoint
+    settings={"binary":use_binary,"box":box,"time_window":time_window,"selected_components":selected_components,"moment_components":moment_components}
+    #as they are read from the checkpoint, after the conversion to json
+    return json.loads(json.dumps(settings))
+
+def write_checkpoint(path,results,file_lattice,processed):
+    #the checkpoint is written in a new directory, which then replaces the previous one, so that a complete checkpoint always exists
+    lattice,tt,N_events,T_arr,jQBS_arr,v_arr,M2_arr=results
+    lattice_archive.save(path+".new","lattice",lattice,tt,N_events,T_arr,jQBS_arr,v_arr,extra_fields={"M2":M2_arr},\
+                         extra_metadata={"processed":processed,"file_lattice":file_lattice,"settings":checkpoint_settings()})
+    if(os.path.exists(path)):
+        if(os.path.exists(path+".old")):
+            shutil.rmtree(path+".old")
+        os.rename(path,path+".old")
+    os.rename(path+".new",path)
+    if(os.path.exists(path+".old")):
+        shutil.rmtree(path+".old")
     if(verbose):
-        print("Opening "+i_tmn)
-        start_time = timer()
-    if(use_binary):
-        if(i_tmn[-3:]==".gz"):
-            fp_tmn=gzip.open(i_tmn,"rb")
-        else:
-            fp_tmn=open(i_tmn,"rb")
-        lattice_dimensions, lattice_spacing, lattice_origin = read_binary_header(fp_tmn)
+        print("Checkpoint written in "+path+" after "+str(N_events)+" events")
+
+def read_checkpoint(path,Tmunu_files):
+    #it returns the partial sums and the lattice of the input files stored in the checkpoint, or None if there is no checkpoint
+    #if the run was interrupted while the checkpoint was replaced, the previous one is used
+    if(lattice_archive.is_archive(path)):
+        source=path
+    elif(lattice_archive.is_archive(path+".old")):
+        source=path+".old"
     else:
-        if(i_tmn[-3:]==".gz"):
-            fp_tmn=gzip.open(i_tmn,"r")
+        return None
+    lattice,tt,N_events,T_arr,jQBS_arr,v_arr,M2_arr,processed,file_lattice,settings=lattice_archive.load(source,"lattice",extra=("M2","processed","file_lattice","settings"))
+    if(settings!=checkpoint_settings()):
+        print("Error, the checkpoint "+source+" was written with different settings: "+str(settings)+", while now they are: "+str(checkpoint_settings())+".\nI quit.")
+        sys.exit(2)
+    if(processed!=[os.path.realpath(f) for f in Tmunu_files[:len(processed)]]):
+        print("Error, the events in the checkpoint "+source+" are not the first events of its chunk of input files.\nI quit.")
+        sys.exit(2)
+    file_lattice={"dimensions":np.array(file_lattice["dimensions"],dtype=np.int32),"spacing":np.array(file_lattice["spacing"],dtype=np.float64),\
+                  "origin":np.array(file_lattice["origin"],dtype=np.float64)}
+    #the sums are copied in memory, where they are updated
+    if(M2_arr is not None):
+        M2_arr=np.array(M2_arr)
+    return lattice,tt,N_events,np.array(T_arr),np.array(jQBS_arr),np.array(v_arr),M2_arr,file_lattice
+
+def process_events(Tmunu_files,net_bar_files,vLandau_files,file_offsets=None,checkpoint=None):
+    #it reads the events and it returns the sum over them in the same format of the output file
+    #file_offsets, if given, contains for each event the times and the offsets of the timesteps in the files read from the index
+    #checkpoint, if given, is the path of the checkpoint of the partial sums, written every checkpoint_interval minutes and after the last event
+    nf=len(Tmunu_files)
+
+    #dictionary containing information about the grid (after cropping it)
+    lattice={}
+    #dictionary containing information about the grid in the input files
+    file_lattice={}
+
+    #empty list with the timesteps of the first event, afterwards the results are accumulated in T_arr, jQBS_arr and v_arr
+    T_list=[]
+    jQBS_list=[]
+    v_list=[]
+
+    #empty list with the output times
+    tt=[]
+
+    #the events already summed in the checkpoint of an interrupted run are skipped
+    first_event=0
+    if(checkpoint is not None):
+        last_checkpoint=timer()
+        state=read_checkpoint(checkpoint,Tmunu_files)
+        if(state is not None):
+            lattice,tt,first_event,T_arr,jQBS_arr,v_arr,M2_arr,file_lattice=state
+            nt=len(tt)
+            nx,ny,nz=file_lattice["dimensions"][:]
+            (sx,sy,sz), cropped_dimensions, cropped_origin = crop_box(file_lattice["dimensions"],file_lattice["spacing"],file_lattice["origin"])
+            tmn_sel=component_indexes(Tmunu_names)
+            jqbs_sel=component_indexes(jQBS_names)
+            vl_sel=component_indexes(v_names)
+            if(verbose):
+                print("Resuming from the checkpoint "+checkpoint+" after "+str(first_event)+" events")
+
+    for n_i in range(first_event,nf):
+        i_tmn=Tmunu_files[n_i]
+        i_jqbs=net_bar_files[n_i]
+        i_vl=vLandau_files[n_i]
+        #the ascii files already converted in a previous run are read from their binary copies in the cache
+        cached=(cache_dir is not None) and (not use_binary) and all(os.path.exists(cache_file_name(f)) for f in (i_tmn,i_jqbs,i_vl))
+        #the binary files which are not compressed are memory mapped and read without copying them
+        mapped=cached or (use_binary and not (is_compressed(i_tmn) or is_compressed(i_jqbs) or is_compressed(i_vl)))
+        #otherwise we store a binary copy of the ascii files while we read them
+        caching=(cache_dir is not None) and (not use_binary) and (not cached)
+        if(verbose):
+            print("Opening "+i_tmn)
+            start_time = timer()
+        if(mapped):
+            if(cached):
+                src_tmn, src_jqbs, src_vl = cache_file_name(i_tmn), cache_file_name(i_jqbs), cache_file_name(i_vl)
+                for f in (src_tmn,src_jqbs,src_vl):
+                    os.utime(f) #we mark the files as recently used
+                if(verbose):
+                    print("Using the binary copies in the cache")
+            else:
+                src_tmn, src_jqbs, src_vl = i_tmn, i_jqbs, i_vl
+            lattice_dimensions, lattice_spacing, lattice_origin, times_tmn, data_tmn = map_binary_file(src_tmn,10)
+            lattice_dimensions_jqbs, lattice_spacing_jqbs, lattice_origin_jqbs, times_jqbs, data_jqbs = map_binary_file(src_jqbs,12)
+            lattice_dimensions_vl, lattice_spacing_vl, lattice_origin_vl, times_vl, data_vl = map_binary_file(src_vl,3)
+            #the number of timesteps is known in advance, all the three files must have the same
+            nt_file=len(times_tmn)
+            if((len(times_jqbs)!=nt_file) or (len(times_vl)!=nt_file)):
+                print("Error: "+i_tmn+", "+i_jqbs+" and "+i_vl+" contain "+str(nt_file)+", "+str(len(times_jqbs))+", "+str(len(times_vl))+" timesteps, respectively.\nI quit.")
+                sys.exit(2)
+        elif(use_binary):
+            fp_tmn=open_input(i_tmn,True)
+            lattice_dimensions, lattice_spacing, lattice_origin = read_binary_header(fp_tmn)
         else:
-            fp_tmn=open(i_tmn,"r")
-        lattice_dimensions, lattice_spacing, lattice_origin = read_ascii_header(fp_tmn)
-    if(verbose):
-        print("Opening "+i_jqbs)
-        start_time = timer()
-    if(use_binary):
-        if(i_jqbs[-3:]==".gz"):
-            fp_jqbs=gzip.open(i_jqbs,"rb")
+            fp_tmn=open_input(i_tmn,False)
+            lattice_dimensions, lattice_spacing, lattice_origin = read_ascii_header(fp_tmn)
+        if(verbose and not mapped):
+            print("Opening "+i_jqbs)
+        if(mapped):
+            pass
+        elif(use_binary):
+            fp_jqbs=open_input(i_jqbs,True)
+            lattice_dimensions_jqbs, lattice_spacing_jqbs, lattice_origin_jqbs = read_binary_header(fp_jqbs)
         else:
-            fp_jqbs=open(i_jqbs,"rb")
-        lattice_dimensions_jqbs, lattice_spacing_jqbs, lattice_origin_jqbs = read_binary_header(fp_jqbs)
-    else:
-        if(i_jqbs[-3:]==".gz"):
-            fp_jqbs=gzip.open(i_jqbs,"r")
+            fp_jqbs=open_input(i_jqbs,False)
+            lattice_dimensions_jqbs, lattice_spacing_jqbs, lattice_origin_jqbs = read_ascii_header(fp_jqbs)
+        if(verbose and not mapped):
+            print("Opening "+i_vl)
+        if(mapped):
+            pass
+        elif(use_binary):
+            fp_vl=open_input(i_vl,True)
+            lattice_dimensions_vl, lattice_spacing_vl, lattice_origin_vl = read_binary_header(fp_vl)
         else:
-            fp_jqbs=open(i_jqbs,"r")
-        lattice_dimensions_jqbs, lattice_spacing_jqbs, lattice_origin_jqbs = read_ascii_header(fp_jqbs)
-    if(verbose):
-        print("Opening "+i_vl)
-        start_time = timer()
-    if(use_binary):
-        if(i_vl[-3:]==".gz"):
-            fp_vl=gzip.open(i_vl,"rb")
+            fp_vl=open_input(i_vl,False)
+            lattice_dimensions_vl, lattice_spacing_vl, lattice_origin_vl = read_ascii_header(fp_vl)
+
+        #we skip the check that the grid data for the various quantities are compatible with each other
+
+        if(caching):
+            fc_tmn=open_cache_writer(i_tmn,lattice_dimensions,lattice_spacing,lattice_origin)
+            fc_jqbs=open_cache_writer(i_jqbs,lattice_dimensions_jqbs,lattice_spacing_jqbs,lattice_origin_jqbs)
+            fc_vl=open_cache_writer(i_vl,lattice_dimensions_vl,lattice_spacing_vl,lattice_origin_vl)
+
+        if(n_i==0): #initially we need to acquire some information
+            file_lattice["dimensions"]=lattice_dimensions
+            file_lattice["spacing"]=lattice_spacing
+            file_lattice["origin"]=lattice_origin
+            nx,ny,nz=lattice_dimensions[:]
+            #sx, sy and sz select the cells inside the box
+            (sx,sy,sz), lattice["dimensions"], lattice["origin"] = crop_box(lattice_dimensions,lattice_spacing,lattice_origin)
+            lattice["spacing"]=lattice_spacing
+            cnx,cny,cnz=lattice["dimensions"][:]
+            #components of the arrays that we keep
+            tmn_sel=component_indexes(Tmunu_names)
+            jqbs_sel=component_indexes(jQBS_names)
+            vl_sel=component_indexes(v_names)
+            lattice["components"]={"Tmunu":component_names(Tmunu_names,tmn_sel),"jQBS":component_names(jQBS_names,jqbs_sel),"v":component_names(v_names,vl_sel)}
+            #the arrays keep the order of the cells of the input files, in which x is the fastest index
+            lattice["axes"]=lattice_archive.native_axes
+            if(moment_components is not None):
+                lattice["moments"]=[n for n in Tmunu_names+jQBS_names+v_names if n in moment_components]
         else:
-            fp_vl=open(i_vl,"rb")
-        lattice_dimensions_vl, lattice_spacing_vl, lattice_origin_vl = read_binary_header(fp_vl)
-    else:
-        if(i_vl[-3:]==".gz"):
-            fp_vl=gzip.open(i_vl,"r")
+            check_lattice(file_lattice,lattice_dimensions,lattice_spacing,lattice_origin,i_tmn)
+
+        index=0 #index of the timestep in the results
+        step=0 #index of the timestep in the file
+
+        #with the index, the timesteps before the time window are not read at all, we move directly to the first selected one
+        if((file_offsets is not None) and (time_window is not None) and (not mapped) and (not caching) and (None not in file_offsets[n_i]["offsets"])):
+            selected=[h for h,time in enumerate(file_offsets[n_i]["times"]) if time_selected(time)]
+            if(len(selected)>0):
+                for fp, offsets in zip((fp_tmn,fp_jqbs,fp_vl),file_offsets[n_i]["offsets"]):
+                    fp.seek(offsets[selected[0]])
+
+        while(True):
+            if(mapped):
+                if(step==nt_file):
+                    break
+                time=times_tmn[step]
+                #the timesteps outside the time window are not read at all
+                if(not time_selected(time)):
+                    step=step+1
+                    continue
+                Tmunu=mapped_timestep_tmn(data_tmn,step,nx,ny,nz)
+                j_QBS=mapped_timestep_jqbs(data_jqbs,step,nx,ny,nz) #first index: j component then z, y, x
+                vl=mapped_timestep_vl(data_vl,step,nx,ny,nz) #first index: v component then z, y, x
+                #the data of the mapped files are actually read from the disk only in the reshape and accumulate stages
+                instrumentation.add("bytes_read",data_tmn[step].nbytes+data_jqbs[step].nbytes+data_vl[step].nbytes)
+            elif(use_binary):
+                eof,time,Tmunu=read_binary_timestep_tmn(fp_tmn,nx,ny,nz)
+                if(eof):
+                    break
+                j_QBS=read_binary_timestep_jqbs(fp_jqbs,nx,ny,nz) #first index: j component then z, y, x
+                vl=read_binary_timestep_vl(fp_vl,nx,ny,nz) #first index: v component then z, y, x
+            else:
+                eof,time=read_ascii_time(fp_tmn)
+                if(eof):
+                    break
+                if(caching or time_selected(time)):
+                    Tmunu=read_ascii_timestep_tmn(fp_tmn,nx,ny,nz,time)
+                    j_QBS=read_ascii_timestep_jqbs(fp_jqbs,nx,ny,nz,time) #first index: j component then z, y, x
+                    vl=read_ascii_timestep_vl(fp_vl,nx,ny,nz,time) #first index: v component then z, y, x
+                else:
+                    #we skip the lines of the timesteps outside the time window without parsing them
+                    skip_ascii_rows(fp_tmn,10*ny*nz)
+                    skip_ascii_rows(fp_jqbs,1+nx*ny*nz)
+                    skip_ascii_rows(fp_vl,1+nx*ny*nz)
+                if(caching):
+                    write_cache_timestep(fc_tmn,time,Tmunu)
+                    write_cache_timestep(fc_jqbs,time,j_QBS.transpose(1,2,3,0))
+                    write_cache_timestep(fc_vl,time,vl.transpose(1,2,3,0))
+            step=step+1
+            if(not time_selected(time)):
+                #the times are in increasing order, so, unless we are filling the cache, we can stop reading the files
+                if((time>time_window[1]) and (not caching)):
+                    break
+                continue
+            with instrumentation.stage("reshape"):
+                Tmunu=Tmunu[tmn_sel,sz,sy,sx]
+                j_QBS=j_QBS[jqbs_sel,sz,sy,sx]
+                vl=vl[vl_sel,sz,sy,sx]
+            if(n_i==0):
+                tt.append(time)
+            else:
+                if(index>=nt):
+                    print("Error when reading file "+i_tmn+": it contains more than the "+str(nt)+" timesteps of the previous files. I quit.\n")
+                    sys.exit(2)
+                if(time!=tt[index]):
+                    print("Error when reading file "+i_tmn+":")
+                    print("At step "+str(index)+" time "+str(tt[index])+" was expected, while "+str(time)+" was found. I quit.\n")
+                    sys.exit(2)
+
+            accumulate_start=timer()
+            if(n_i==0):
+                T_list.append(Tmunu)
+                jQBS_list.append(j_QBS)
+                v_list.append(vl)
+            else:
+                if(M2_arr is not None):
+                    #Welford update of the second moments, the means before and after this event are obtained from the sums
+                    x=lattice_archive.moment_values(lattice,Tmunu,j_QBS,vl)
+                    delta=x-lattice_archive.moment_values(lattice,T_arr[index],jQBS_arr[index],v_arr[index])/n_i
+                #we add the new event in place, without allocating new arrays
+                T_arr[index]+=Tmunu
+                jQBS_arr[index]+=j_QBS
+                v_arr[index]+=vl
+                if(M2_arr is not None):
+                    M2_arr[index]+=delta*(x-lattice_archive.moment_values(lattice,T_arr[index],jQBS_arr[index],v_arr[index])/(n_i+1))
+            instrumentation.add_time("accumulate",timer()-accumulate_start)
+            instrumentation.add("timesteps",1)
+
+            index=index+1
+
+            if(verbose):
+                print("Done timestep: "+str(index)+", simulation time: "+str(time))
+
+        #we check that we counted correctly the timesteps:
+        if(len(tt)!=index):
+            print("Error, I counted "+str(index)+" timesteps, but I have "+str(len(tt))+" entries in the list of timesteps...\nI quit.")
+            sys.exit(2)
+        if(n_i==0):
+            nt=index
+            # now that we know nt we allocate the arrays with the results
+            # and we move the first event in them one timestep at a time, to save memory
+            T_arr=np.zeros((nt,len(lattice["components"]["Tmunu"]),cnz,cny,cnx),dtype=np.float64)
+            jQBS_arr=np.zeros((nt,len(lattice["components"]["jQBS"]),cnz,cny,cnx),dtype=np.float64)
+            v_arr=np.zeros((nt,len(lattice["components"]["v"]),cnz,cny,cnx),dtype=np.float64)
+            if(moment_components is not None):
+                M2_arr=np.zeros((nt,len(lattice["moments"]),cnz,cny,cnx),dtype=np.float64)
+            else:
+                M2_arr=None
+            accumulate_start=timer()
+            for h in range(nt):
+                T_arr[h]=T_list[h]
+                jQBS_arr[h]=jQBS_list[h]
+                v_arr[h]=v_list[h]
+                T_list[h]=jQBS_list[h]=v_list[h]=None
+            T_list=jQBS_list=v_list=None
+            instrumentation.add_time("accumulate",timer()-accumulate_start)
+
+        if(mapped):
+            #we drop the references to the mapped files
+            times_tmn=data_tmn=times_jqbs=data_jqbs=times_vl=data_vl=None
+        else:
+            fp_tmn.close()
+            fp_jqbs.close()
+            fp_vl.close()
+        if(caching):
+            close_cache_writer(fc_tmn,i_tmn)
+            close_cache_writer(fc_jqbs,i_jqbs)
+            close_cache_writer(fc_vl,i_vl)
+        if(verbose):
+            end_time = timer()
+            print(str(i_tmn)+", "+str(i_jqbs)+", "+str(i_vl)+" read in "+tf.format(end_time-start_time)+" seconds")
+        instrumentation.add("events",1)
+        if((checkpoint is not None) and ((timer()-last_checkpoint>checkpoint_interval*60) or (n_i==nf-1))):
+            with instrumentation.stage("checkpoint"):
+                write_checkpoint(checkpoint,(lattice,tt,n_i+1,T_arr,jQBS_arr,v_arr,M2_arr),file_lattice,[os.path.realpath(f) for f in Tmunu_files[:n_i+1]])
+            last_checkpoint=timer()
+    N_events=nf
+
+    return lattice,tt,N_events,T_arr,jQBS_arr,v_arr,M2_arr
+
+def process_chunk(chunk):
+    #entry point of the worker processes, chunk is a tuple with the lists of the files of a subset of events
+    #it returns the name of the first file of the chunk, used in the error messages, the partial sums and the measurements of the instrumentation
+    #in case of errors the message has already been printed and we return None, so that the main process can quit
+    instrumentation.reset()
+    try:
+        return chunk[0][0], process_events(*chunk), instrumentation.snapshot()
+    except SystemExit:
+        return chunk[0][0], None, None
+    finally:
+        discard_cache_writers()
+
+def add_partial_results(results,partial,filename):
+    #it adds the partial sums in place to results, after checking that they refer to the same lattice and timesteps
+    lattice,tt,N_events,T_arr,jQBS_arr,v_arr,M2_arr=results
+    p_lattice,p_tt,p_N_events,p_T_arr,p_jQBS_arr,p_v_arr,p_M2_arr=partial
+    check_lattice(lattice,p_lattice["dimensions"],p_lattice["spacing"],p_lattice["origin"],filename)
+    if(len(p_tt)!=len(tt)):
+        print("Error, the events starting from file "+filename+" have "+str(len(p_tt))+" timesteps, while the previous ones have "+str(len(tt))+". I quit.\n")
+        sys.exit(2)
+    for index in range(len(tt)):
+        if(p_tt[index]!=tt[index]):
+            print("Error when reading file "+filename+":")
+            print("At step "+str(index)+" time "+str(tt[index])+" was expected, while "+str(p_tt[index])+" was found. I quit.\n")
+            sys.exit(2)
+    if(M2_arr is not None):
+        #the second moments must be merged before adding the sums
+        lattice_archive.merge_moments(M2_arr,lattice_archive.moment_values(lattice,T_arr,jQBS_arr,v_arr),N_events,\
+                                      p_M2_arr,lattice_archive.moment_values(lattice,p_T_arr,p_jQBS_arr,p_v_arr),p_N_events)
+    T_arr+=p_T_arr
+    jQBS_arr+=p_jQBS_arr
+    v_arr+=p_v_arr
+    return lattice,tt,N_events+p_N_events,T_arr,jQBS_arr,v_arr,M2_arr
+
+def tree_reduce(partials):
+    #pairwise reduction of the partial sums, which are received in the same order of the events
+    #as in a binary counter, two partial sums are merged only when they contain the same number of chunks,
+    #therefore at most log2(number of chunks) partial sums are kept in memory at the same time
+    stack=[]
+    for filename, partial, measurements in partials:
+        if(partial is None):
+            sys.exit(2)
+        instrumentation.merge(measurements)
+        level=0
+        while((len(stack)>0) and (stack[-1][0]==level)):
+            previous_level, previous_filename, previous=stack.pop()
+            with instrumentation.stage("reduce"):
+                partial=add_partial_results(previous,partial,filename)
+            filename=previous_filename
+            level=level+1
+        stack.append((level,filename,partial))
+    level, filename, results = stack.pop()
+    while(len(stack)>0):
+        previous_level, previous_filename, previous=stack.pop()
+        with instrumentation.stage("reduce"):
+            results=add_partial_results(previous,results,filename)
+        filename=previous_filename
+    return results
+
+def scan_file(filename,ncomp):
+    #it reads only the header and the time entries of an input file, without parsing the data
+    #it returns a dictionary with the lattice, the times, the byte offsets of the timesteps and, in case of problems, their description
+    #the offsets are not stored for the compressed files, which cannot be read starting from an arbitrary position
+    file_stat=os.stat(filename)
+    entry={"file":os.path.realpath(filename),"size":file_stat.st_size,"mtime_ns":file_stat.st_mtime_ns,"lattice":None,"times":[],"offsets":None,"problem":None}
+    if(file_stat.st_size==0):
+        entry["problem"]="zero length file"
+        return entry
+    seekable=not is_compressed(filename)
+    offsets=[]
+    try:
+        with open_input(filename,True) as infile:
+            if(use_binary):
+                lattice_dimensions, lattice_spacing, lattice_origin = read_binary_header(infile)
+            else:
+                lattice_dimensions, lattice_spacing, lattice_origin = read_ascii_header(io.StringIO(b"".join(islice(infile,5)).decode()))
+            entry["lattice"]={"dimensions":lattice_dimensions.tolist(),"spacing":lattice_spacing.tolist(),"origin":lattice_origin.tolist()}
+            nx,ny,nz=lattice_dimensions[:]
+            if(use_binary and seekable):
+                #the positions of the timesteps follow from the size of the file, only the times are read
+                offset=infile.tell()
+                step_dtype=binary_step_dtype(ncomp,lattice_dimensions)
+                n_steps=(file_stat.st_size-offset)//step_dtype.itemsize
+                if(offset+n_steps*step_dtype.itemsize!=file_stat.st_size):
+                    entry["problem"]="incomplete last timestep"
+                for h in range(n_steps):
+                    infile.seek(offset+h*step_dtype.itemsize)
+                    entry["times"].append(float(read_values(infile,np.float64,1)[0]))
+                    offsets.append(offset+h*step_dtype.itemsize)
+            elif(use_binary):
+                record_size=binary_step_dtype(ncomp,lattice_dimensions).itemsize-8
+                while(True):
+                    time_entry=read_values(infile,np.float64,1)
+                    if(len(time_entry)==0):
+                        break
+                    if(len(infile.read(record_size))<record_size):
+                        entry["problem"]="incomplete timestep at time "+str(time_entry[0])
+                        break
+                    entry["times"].append(float(time_entry[0]))
+            else:
+                #Tmunu has 10 rows with nx values for each y,z, j_QBS and v have a row for each cell
+                if(ncomp==10):
+                    n_rows=10*ny*nz
+                else:
+                    n_rows=nx*ny*nz
+                while(True):
+                    if(seekable):
+                        offset=infile.tell()
+                    time_entry=infile.readline()
+                    if(time_entry==b""):
+                        break
+                    time=float(time_entry)
+                    if(sum(1 for row in islice(infile,n_rows))<n_rows):
+                        entry["problem"]="incomplete timestep at time "+str(time)
+                        break
+                    entry["times"].append(time)
+                    if(seekable):
+                        offsets.append(offset)
+    except (SystemExit,ValueError,IndexError):
+        #the unsupported versions are reported by the functions reading the header
+        entry["problem"]="unreadable file"
+        return entry
+    if(seekable):
+        entry["offsets"]=offsets
+    return entry
+
+def scan_event(files):
+    #it scans the three files of an event, which must have the same lattice and timesteps
+    #it is the entry point of the worker processes with the --scan option
+    entries=[scan_file(f,ncomp) for f,ncomp in zip(files,(10,12,3))]
+    event={"files":[e["file"] for e in entries],"sizes":[e["size"] for e in entries],"mtimes_ns":[e["mtime_ns"] for e in entries],\
+           "offsets":[e["offsets"] for e in entries],"lattice":entries[0]["lattice"],"times":entries[0]["times"],"problem":None}
+    for e in entries:
+        if(e["problem"] is not None):
+            event["problem"]=e["file"]+": "+e["problem"]
+            return event
+    for e in entries[1:]:
+        if(e["lattice"]!=event["lattice"]):
+            event["problem"]=e["file"]+": different lattice than "+entries[0]["file"]
+        elif(e["times"]!=event["times"]):
+            event["problem"]=e["file"]+": different timesteps than "+entries[0]["file"]
+    return event
+
+def write_index(filename,inputdir,events):
+    #it writes the index of the events, the events with different lattice or timesteps than the first valid one are listed among the problems
+    index={"data_dir":os.path.realpath(inputdir),"binary":use_binary,"density_type":density_type,"lattice":None,"times":None,"events":[],"problems":[]}
+    for event in events:
+        if((event["problem"] is None) and (index["lattice"] is not None)):
+            if(event["lattice"]!=index["lattice"]):
+                event["problem"]="different lattice than the previous events"
+            elif(event["times"]!=index["times"]):
+                event["problem"]="different timesteps than the previous events"
+        if(event["problem"] is not None):
+            index["problems"].append({"files":event["files"],"reason":event["problem"]})
+            continue
+        if(index["lattice"] is None):
+            index["lattice"]=event["lattice"]
+            index["times"]=event["times"]
+        index["events"].append({key:event[key] for key in ("files","sizes","mtimes_ns","offsets")})
+    #as the archives, the index is written atomically
+    tmpfile=filename+"."+str(os.getpid())+".tmp"
+    with open(tmpfile,"w") as outfile:
+        json.dump(index,outfile,indent=1)
+    os.replace(tmpfile,filename)
+    return index
+
+def read_index(filename):
+    #it returns the lists of the files of the valid events in the index, their offsets and their total sizes
+    #the index must refer to the same kind of files and the files must not have been modified after the scan
+    with open(filename,"r") as infile:
+        index=json.load(infile)
+    if((index["binary"]!=use_binary) or (index["density_type"]!=density_type)):
+        print("Error, the index "+filename+" refers to "+("binary" if index["binary"] else "ascii")+" "+index["density_type"]+" files, while the script is set for "+\
+              ("binary" if use_binary else "ascii")+" "+density_type+" files.\nI quit.")
+        sys.exit(2)
+    for problem in index["problems"]:
+        print("Because of a problem in the index ("+problem["reason"]+"), I will not consider:")
+        for f in problem["files"]:
+            print(f)
+    for event in index["events"]:
+        for f,size,mtime_ns in zip(event["files"],event["sizes"],event["mtimes_ns"]):
+            if((not os.path.exists(f)) or (os.stat(f).st_size!=size) or (os.stat(f).st_mtime_ns!=mtime_ns)):
+                print("Error, the file "+f+" has been modified or removed after the creation of the index "+filename+", please scan again the input files.\nI quit.")
+                sys.exit(2)
+    Tmunu_files=[event["files"][0] for event in index["events"]]
+    net_bar_files=[event["files"][1] for event in index["events"]]
+    vLandau_files=[event["files"][2] for event in index["events"]]
+    file_offsets=[{"times":index["times"],"offsets":event["offsets"]} for event in index["events"]]
+    sizes=[sum(event["sizes"]) for event in index["events"]]
+    return Tmunu_files, net_bar_files, vLandau_files, file_offsets, sizes
+
+
+def find_events(inputdir,density,extension):
+    #it returns the sorted lists of the Tmunu, j_QBS and Landau velocity files of a density type, which must have the same length
+    prefix=density_prefixes[density]
+    net_bar_files=find_input_files(inputdir,prefix+"j_QBS_",extension)
+    Tmunu_files=find_input_files(inputdir,prefix+"tmn_landau_",extension)
+    vLandau_files=find_input_files(inputdir,prefix+"v_landau_",extension)
+
+    #we sort the lists of input files
+    net_bar_files.sort()
+    Tmunu_files.sort()
+    vLandau_files.sort()
+
+    nf_bar=len(net_bar_files)
+    nf_tmn=len(Tmunu_files)
+    nf_vl=len(vLandau_files)
+
+    if((nf_bar != nf_tmn) or (nf_bar != nf_vl)):
+        print("Sorry, but I can't continue.")
+        print("I have found "+str(nf_bar)+" "+density+" density current files, "+str(nf_tmn)+" Tmunu files, "+str(nf_vl)+" Landau velocity files")
+        sys.exit(2)
+    return Tmunu_files, net_bar_files, vLandau_files
+
+def drop_empty_events(Tmunu_files,net_bar_files,vLandau_files):
+    #it removes from the lists the events with a zero length file
+    kept_events=[]
+    for files in zip(net_bar_files,Tmunu_files,vLandau_files):
+        if((os.path.getsize(files[0])==0) or (os.path.getsize(files[1])==0) or (os.path.getsize(files[2])==0)):
+            print("Because of a zero length file, I will not consider:")
+            print(files[0])
+            print(files[1])
+            print(files[2])
         else:
-            fp_vl=open(i_vl,"r")
-        lattice_dimensions_vl, lattice_spacing_vl, lattice_origin_vl = read_ascii_header(fp_vl)
+            kept_events.append(files)
+    net_bar_files=[files[0] for files in kept_events]
+    Tmunu_files=[files[1] for files in kept_events]
+    vLandau_files=[files[2] for files in kept_events]
+    return Tmunu_files, net_bar_files, vLandau_files
 
-    #we skip the check that the grid data for the various quantities are compatible with each other 
+def event_name(filename,density):
+    #name of the file without the prefix of the density type and of the quantity, it identifies the event
+    return os.path.basename(filename)[len(density_prefixes[density]+"tmn_landau_"):]
 
-    if(n_i==0): #initially we need to acquire some information
-        lattice["dimensions"]=lattice_dimensions
-        lattice["spacing"]=lattice_spacing
-        lattice["origin"]=lattice_origin
-        nx,ny,nz=lattice_dimensions[:]
+def event_bounds(nf,event_sizes,n_chunks):
+    #it splits the events in contiguous chunks, which are summed by the worker processes, and it returns the indexes of their boundaries
+    n_chunks=min(n_chunks,nf)
+    if(event_sizes is None):
+        bounds=np.linspace(0,nf,n_chunks+1).astype(int)
     else:
-        if(not np.array_equal(lattice["dimensions"],lattice_dimensions)):
-            print("Error in file "+i_tmn+": different lattice dimensions. Until now: "+str(lattice["dimensions"])+", this time: "+str(lattice_dimensions)+".\nI quit.")
+        #with the index the chunks contain about the same amount of data, instead of the same number of events
+        cumulative_sizes=np.cumsum(event_sizes)
+        bounds=np.searchsorted(cumulative_sizes,np.linspace(0,cumulative_sizes[-1],n_chunks+1)[1:-1],side="right")
+        bounds=np.unique(np.concatenate(([0],np.clip(bounds,1,nf-1),[nf])))
+    return [int(b) for b in bounds]
+
+def split_events(Tmunu_files,net_bar_files,vLandau_files,file_offsets,bounds,checkpoint_dir):
+    #it returns the arguments of process_events for each chunk of events, each chunk has its own checkpoint in checkpoint_dir
+    chunks=[]
+    for c in range(len(bounds)-1):
+        chunks.append((Tmunu_files[bounds[c]:bounds[c+1]],net_bar_files[bounds[c]:bounds[c+1]],vLandau_files[bounds[c]:bounds[c+1]],\
+                       None if file_offsets is None else file_offsets[bounds[c]:bounds[c+1]],\
+                       None if checkpoint_dir is None else os.path.join(checkpoint_dir,"chunk_"+str(c).zfill(4))))
+    return chunks
+
+def prepare_checkpoints(checkpoint_dir,Tmunu_files,bounds):
+    #it prepares the directory with the checkpoints and it returns the boundaries of the chunks of events
+    #when a run is resumed, the chunks of the interrupted run are used, so that each chunk continues from its checkpoint
+    plan_file=os.path.join(checkpoint_dir,"chunks.json")
+    files=[os.path.realpath(f) for f in Tmunu_files]
+    if(resume and os.path.exists(plan_file)):
+        with open(plan_file,"r") as infile:
+            plan=json.load(infile)
+        if(plan["files"]!=files):
+            print("Error, the input files are different from those of the interrupted run with checkpoints in "+checkpoint_dir+".\nI quit.")
             sys.exit(2)
-        if(not np.array_equal(lattice["spacing"],lattice_spacing)):
-            print("Error in file "+i_tmn+": different lattice spacing. Until now: "+str(lattice["spacing"])+", this time: "+str(lattice_spacing)+".\nI quit.")
+        if(verbose):
+            print("Resuming the run with checkpoints in "+checkpoint_dir)
+        return plan["bounds"]
+    if(resume):
+        print("No checkpoints found in "+checkpoint_dir+", I start from the beginning")
+    if(os.path.exists(checkpoint_dir)):
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir)
+    tmpfile=plan_file+"."+str(os.getpid())+".tmp"
+    with open(tmpfile,"w") as outfile:
+        json.dump({"files":files,"bounds":bounds},outfile,indent=1)
+    os.replace(tmpfile,plan_file)
+    return bounds
+
+def write_results(outputfile,results,Tmunu_files):
+    #it writes the sums over the events in the output archive
+    lattice,tt,N_events,T_arr,jQBS_arr,v_arr,M2_arr=results
+    if(verbose):
+        print("Writing the final results in "+outputfile)
+        start_time = timer()
+
+    if(output_dtype!=np.float64):
+        T_arr=T_arr.astype(output_dtype)
+        jQBS_arr=jQBS_arr.astype(output_dtype)
+        v_arr=v_arr.astype(output_dtype)
+        if(M2_arr is not None):
+            M2_arr=M2_arr.astype(output_dtype)
+
+    #the manifest lists the events included in the archive, it is used by the combiner to avoid adding twice the same events
+    manifest=[{"file":os.path.realpath(f),"N_events":1} for f in Tmunu_files]
+    with instrumentation.stage("write"):
+        lattice_archive.save(outputfile,"lattice",lattice,tt,N_events,T_arr,jQBS_arr,v_arr,extra_fields={"M2":M2_arr},extra_metadata={"manifest":manifest},compression=compression)
+
+    if(verbose):
+        end_time = timer()
+        print("Done in "+tf.format(end_time-start_time)+" seconds")
+
+
+
+if __name__ == "__main__":
+
+    if(verbose):
+        init_start=timer()
+
+    #we parse the command line arguments
+    input_args=[]
+    arg_index=1
+    while(arg_index<len(sys.argv)):
+        if((sys.argv[arg_index]=="--workers") and (arg_index+1<len(sys.argv))):
+            workers=int(sys.argv[arg_index+1])
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--cache") and (arg_index+1<len(sys.argv))):
+            cache_dir=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--cache-size") and (arg_index+1<len(sys.argv))):
+            cache_max_size=float(sys.argv[arg_index+1])
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--box") and (arg_index+6<len(sys.argv))):
+            box=[int(b) for b in sys.argv[arg_index+1:arg_index+7]]
+            arg_index=arg_index+7
+        elif((sys.argv[arg_index]=="--time-range") and (arg_index+2<len(sys.argv))):
+            time_window=[float(t) for t in sys.argv[arg_index+1:arg_index+3]]
+            arg_index=arg_index+3
+        elif((sys.argv[arg_index]=="--components") and (arg_index+1<len(sys.argv))):
+            selected_components=[]
+            for c in sys.argv[arg_index+1].split(","):
+                if(c in component_presets):
+                    selected_components=selected_components+component_presets[c]
+                elif(c in Tmunu_names+jQBS_names+v_names):
+                    selected_components.append(c)
+                else:
+                    print("Unknown component "+c+", the available components are: "+",".join(Tmunu_names+jQBS_names+v_names+list(component_presets.keys())))
+                    sys.exit(1)
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--moments") and (arg_index+1<len(sys.argv))):
+            moment_components=sys.argv[arg_index+1].split(",")
+            for c in moment_components:
+                if(c not in Tmunu_names+jQBS_names+v_names):
+                    print("Unknown component "+c+", the available components are: "+",".join(Tmunu_names+jQBS_names+v_names))
+                    sys.exit(1)
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--compress") and (arg_index+1<len(sys.argv))):
+            compression=sys.argv[arg_index+1]
+            lattice_archive.check_codec(compression)
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--scan") and (arg_index+1<len(sys.argv))):
+            index_file=sys.argv[arg_index+1]
+            scan_only=True
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--index") and (arg_index+1<len(sys.argv))):
+            index_file=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--density-type") and (arg_index+1<len(sys.argv))):
+            density_type=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--checkpoint") and (arg_index+1<len(sys.argv))):
+            checkpoint_interval=float(sys.argv[arg_index+1])
+            arg_index=arg_index+2
+        elif((sys.argv[arg_index]=="--stats") and (arg_index+1<len(sys.argv))):
+            stats_file=sys.argv[arg_index+1]
+            arg_index=arg_index+2
+        elif(sys.argv[arg_index]=="--resume"):
+            resume=True
+            arg_index=arg_index+1
+        elif(sys.argv[arg_index]=="--float32"):
+            output_dtype=np.float32
+            arg_index=arg_index+1
+        else:
+            input_args.append(sys.argv[arg_index])
+            arg_index=arg_index+1
+    N_input_args=len(input_args)
+
+    if((moment_components is not None) and (selected_components is not None)):
+        for c in moment_components:
+            if(c not in selected_components):
+                print("The component "+c+" given to --moments must be also among the components given to --components.")
+                sys.exit(1)
+
+    if((N_input_args!=(1 if scan_only else 2)) or (workers<1) or (density_type not in ["hadron","baryon","both"]) or ((index_file is not None) and (density_type=="both"))):
+       print ('Syntax: python3 preprocess_thermodynamic_lattice_output_smash.py [--workers N] [--cache <cache dir>] [--cache-size GB] [--box imin imax jmin jmax kmin kmax] [--time-range tmin tmax] [--components c1,c2,...] [--moments c1,c2,...] [--float32] [--compress codec] [--density-type hadron|baryon|both] [--index <index file>] [--checkpoint minutes] [--resume] [--stats <json file>] <data dir> <outputfile>')
+       print ('   or: python3 preprocess_thermodynamic_lattice_output_smash.py [--workers N] [--density-type hadron|baryon] [--stats <json file>] --scan <index file> <data dir>')
+       print ("where:\n  <data dir> is the directory containing the files produced by SMASH with Thermodynamic Lattice Output")
+       print ("  <outputfile> is the name of the output archive (a directory) with the results of the postprocessing")
+       print ("  --workers N (optional) reads the events with N parallel processes (default: 1)")
+       print ("  --cache <cache dir> (optional) stores binary copies of the ascii input files in <cache dir> and uses them in the next runs")
+       print ("  --cache-size GB (optional) maximum size of the cache, the least recently used files are deleted when it is exceeded (default: "+str(cache_max_size)+")")
+       print ("  --box imin imax jmin jmax kmin kmax (optional) keeps only the cells with imin<=i<imax, jmin<=j<jmax, kmin<=k<kmax")
+       print ("  --time-range tmin tmax (optional) keeps only the timesteps with tmin<=t<=tmax (in fm)")
+       print ("  --components c1,c2,... (optional) stores only the listed components, chosen among:")
+       print ("      "+",".join(Tmunu_names)+"\n      "+",".join(jQBS_names)+"\n      "+",".join(v_names))
+       print ("      or the predefined set vorticity, i.e. "+",".join(component_presets["vorticity"]))
+       print ("  --moments c1,c2,... (optional) stores also the sums of the squared deviations from the mean over the events")
+       print ("      of the listed components (e.g. T00,jB0,vx,vy,vz), to estimate their statistical errors")
+       print ("  --float32 (optional) stores the results in single precision")
+       print ("  --compress codec (optional) compresses the arrays of the output archive with codec, chosen among: "+", ".join(lattice_archive.codecs))
+       print ("  --density-type hadron|baryon|both (optional) chooses the files to process (default: "+density_type+"), with both the hadron")
+       print ("      and net_baryon files are processed concurrently and written in <outputfile>_hadron and <outputfile>_baryon")
+       print ("  --checkpoint minutes (optional) writes every given number of minutes a checkpoint of the partial sums in <outputfile>.checkpoint")
+       print ("  --resume (optional) continues an interrupted run from its checkpoints (it implies --checkpoint "+str(default_checkpoint_interval)+", if not given)")
+       print ("  --stats <json file> (optional) prints the time spent in each stage (decompression, parsing, reshaping, accumulation...),")
+       print ("      the bytes read, the events per second and the peak memory and it writes them in <json file>")
+       print ("  --scan <index file> reads only the headers and the time entries of the input files and writes in <index file> (json) the lattice,")
+       print ("      the timesteps, their positions in the files and the list of the files with problems, without processing the events")
+       print ("  --index <index file> (optional) takes the input files from <index file>, skipping those with problems")
+       sys.exit(1)
+
+    #we get the name of input and output files
+    inputdir=input_args[0]
+    if(not scan_only):
+        outputfile=input_args[1]
+
+    #we prepare lists of the input files
+    if(use_binary):
+        extension=".bin"
+    else:
+        extension=".dat"
+    if(density_type=="both"):
+        density_types=["hadron","baryon"]
+    else:
+        density_types=[density_type]
+
+    #for each density type, the lists of the files, the offsets of the timesteps and the sizes of the events (the last two only with the index)
+    families={}
+    if((index_file is not None) and (not scan_only)):
+        #the files and the positions of their timesteps are read from the index
+        families[density_type]=read_index(index_file)
+    else:
+        for density in density_types:
+            families[density]=find_events(inputdir,density,extension)+(None,None)
+
+    if(scan_only):
+        #we read only the headers and the time entries of the files and we write the index
+        if(verbose):
+            start_time = timer()
+        Tmunu_files, net_bar_files, vLandau_files, file_offsets, event_sizes = families[density_type]
+        events=list(zip(Tmunu_files,net_bar_files,vLandau_files))
+        if((workers==1) or (len(events)<2)):
+            scanned=[scan_event(files) for files in events]
+        else:
+            with multiprocessing.Pool(min(workers,len(events))) as pool:
+                scanned=pool.map(scan_event,events)
+        index=write_index(index_file,inputdir,scanned)
+        for problem in index["problems"]:
+            print("Problem with the event "+problem["files"][0]+": "+problem["reason"])
+        if(index["lattice"] is None):
+            print("No valid events found in "+inputdir)
+        else:
+            print(str(len(index["events"]))+" valid events with "+str(len(index["times"]))+" timesteps, lattice dimensions "+str(index["lattice"]["dimensions"])+\
+                  ", "+str(len(index["problems"]))+" events with problems, index written in "+index_file)
+        if(verbose):
+            print("Done in "+tf.format(timer()-start_time)+" seconds")
+        if(stats_file is not None):
+            instrumentation.report("preprocess_thermodynamic_lattice_output_smash.py",stats_file)
+        sys.exit(0)
+
+    for density in density_types:
+        Tmunu_files, net_bar_files, vLandau_files, file_offsets, event_sizes = families[density]
+        if(file_offsets is None):
+            #we check that all the input files have non zero length
+            families[density]=drop_empty_events(Tmunu_files,net_bar_files,vLandau_files)+(None,None)
+        if(len(families[density][0])==0):
+            print("Input files missing. I quit")
             sys.exit(2)
-        if(not np.array_equal(lattice["origin"],lattice_origin)):
-            print("Error in file "+i_tmn+": different lattice origin. Until now: "+str(lattice["origin"])+", this time: "+str(lattice_origin)+".\nI quit.")
+
+    if(len(density_types)>1):
+        #the two families of files must contain the same events
+        events_hadron=[event_name(f,"hadron") for f in families["hadron"][0]]
+        events_baryon=[event_name(f,"baryon") for f in families["baryon"][0]]
+        if(events_hadron!=events_baryon):
+            print("Error, the hadron and net_baryon files refer to different events: "+str(sorted(set(events_hadron)^set(events_baryon)))+".\nI quit.")
             sys.exit(2)
 
-    index=0
+    if(cache_dir is not None):
+        os.makedirs(cache_dir,exist_ok=True)
+        evict_cache()
 
-    while(True):
-        if(use_binary):
-            eof,time,Tmunu=read_binary_timestep_tmn(fp_tmn)
-            if(eof):
-                break
-            j_QBS=read_binary_timestep_jqbs(fp_jqbs) #first index: j component then x, y, z
-            vl=read_binary_timestep_vl(fp_vl) #first index: v component then x, y, z
+    #names of the output archives
+    if(len(density_types)>1):
+        outputfiles={density:outputfile+"_"+density for density in density_types}
+    else:
+        outputfiles={density_type:outputfile}
+
+    if(resume and (checkpoint_interval is None)):
+        checkpoint_interval=default_checkpoint_interval
+
+    #we split the events of each density type in contiguous chunks, that we sum separately and then pairwise
+    chunks={}
+    for density in density_types:
+        Tmunu_files, net_bar_files, vLandau_files, file_offsets, event_sizes = families[density]
+        if((workers==1) and (len(density_types)==1)):
+            bounds=[0,len(Tmunu_files)]
         else:
-            eof,time,Tmunu=read_ascii_timestep_tmn(fp_tmn)
-            if(eof):
-                break
-            j_QBS=read_ascii_timestep_jqbs(fp_jqbs) #first index: j component then x, y, z
-            vl=read_ascii_timestep_vl(fp_vl) #first index: v component then x, y, z
-        if(n_i==0):
-            tt.append(time)
+            bounds=event_bounds(len(Tmunu_files),event_sizes,workers)
+        if(checkpoint_interval is None):
+            checkpoint_dir=None
         else:
-            if(time!=tt[index]):
-                print("Error when reading file "+str(i)+":")
-                print("At step "+str(index)+" time "+str(tt[index])+" was expected, while "+str(time)+" was found. I quit.\n")
-                sys.exit(2)
+            checkpoint_dir=outputfiles[density]+".checkpoint"
+            bounds=prepare_checkpoints(checkpoint_dir,Tmunu_files,bounds)
+        chunks[density]=split_events(Tmunu_files,net_bar_files,vLandau_files,file_offsets,bounds,checkpoint_dir)
 
-        if(n_i==0):
-            T_list.append(Tmunu)
-            jQBS_list.append(j_QBS)
-            v_list.append(vl)
+    results={}
+    #the cache is trimmed also when the reading of the events fails, so that the failed runs do not make it grow beyond cache_max_size
+    try:
+        if((workers==1) and (len(density_types)==1)):
+            #a resumed run may have more than one chunk, they are summed one after the other
+            results[density_type]=tree_reduce((chunk[0][0],process_events(*chunk),None) for chunk in chunks[density_type])
         else:
-            T_list[index]=T_list[index]+Tmunu
-            jQBS_list[index]=jQBS_list[index]+j_QBS
-            v_list[index]=v_list[index]+vl
+            #the chunks of all the density types are read by the same processes, so the density types are processed concurrently
+            n_chunks=sum(len(chunks[density]) for density in density_types)
+            n_proc=min(max(workers,len(density_types)),n_chunks)
+            if(verbose):
+                print("Reading "+str(sum(len(families[density][0]) for density in density_types))+" events with "+str(n_proc)+" processes")
+            settings={"cache_dir":cache_dir,"box":box,"time_window":time_window,"selected_components":selected_components,"moment_components":moment_components,\
+                      "checkpoint_interval":checkpoint_interval}
+            with multiprocessing.Pool(n_proc,initializer=init_worker,initargs=(settings,)) as pool:
+                partials=pool.imap(process_chunk,[chunk for density in density_types for chunk in chunks[density]])
+                for density in density_types:
+                    results[density]=tree_reduce(islice(partials,len(chunks[density])))
 
-        index=index+1
+        if(len(density_types)>1):
+            #the lattice and the timesteps must be the same for the two density types
+            lattice,tt=results["hadron"][0:2]
+            check_lattice(lattice,*[results["baryon"][0][key] for key in ("dimensions","spacing","origin")],families["baryon"][0][0])
+            if(results["baryon"][1]!=tt):
+                print("Error, the timesteps of the hadron files "+str(tt)+" are different from those of the net_baryon files "+str(results["baryon"][1])+".\nI quit.")
+                sys.exit(2)
+    finally:
+        #the temporary copies of an event whose reading failed are deleted (the workers delete their own)
+        discard_cache_writers()
+        if(cache_dir is not None):
+            evict_cache()
 
-        if(verbose):
-            print("Done timestep: "+str(index)+", simulation time: "+str(time))
+    for density in density_types:
+        write_results(outputfiles[density],results[density],families[density][0])
+        #the output archive is complete, the checkpoints are not needed anymore
+        if(checkpoint_interval is not None):
+            shutil.rmtree(outputfiles[density]+".checkpoint")
 
-    #we check that we counted correctly the timesteps:
-    if(len(tt)!=index):
-        print("Error, I counted "+str(index)+" timesteps, but I have "+str(len(tt))+" entries in the list of timesteps...\nI quit.")
-        sys.exit(2)
-    if(n_i==0):
-        nt=index
+    if(stats_file is not None):
+        instrumentation.report("preprocess_thermodynamic_lattice_output_smash.py",stats_file)
 
-    fp_tmn.close()
-    fp_jqbs.close()
-    fp_vl.close()
     if(verbose):
-        end_time = timer()
-        print(str(i_tmn)+", "+str(i_jqbs)+", "+str(i_vl)+" read in "+tf.format(end_time-start_time)+" seconds")
-N_events=n_i+1
-
-# we transform the lists of 3D arrays into 4D arrays
-# we do it one by one to save memory
-T_arr=np.zeros((nt,10,nx,ny,nz),dtype=np.float64)
-for i in range(nt):
-    T_arr[i,:,:,:]=T_list[i][:,:,:,:]
-T_list=None
-del T_list
-jQBS_arr=np.zeros((nt,12,nx,ny,nz),dtype=np.float64)
-for i in range(nt):
-    jQBS_arr[i,:,:,:]=jQBS_list[i][:,:,:,:]
-jQBS_list=None
-del jQBS_list
-v_arr=np.zeros((nt,3,nx,ny,nz),dtype=np.float64)
-for i in range(nt):
-    v_arr[i,:,:,:]=v_list[i][:,:,:,:]
-v_list=None
-del v_list
-
-
-if(verbose):
-    print("Writing the final results in "+outputfile)
-    start_time = timer()
-
-with open(outputfile,"wb") as po:
-      pickle.dump((lattice,tt,N_events,T_arr,jQBS_arr,v_arr),po)
-
-if(verbose):
-    end_time = timer()
-    print("Done in "+tf.format(end_time-start_time)+" seconds")
-    print("All done in "+tf.format(end_time-init_start)+" seconds")
+        print("All done in "+tf.format(timer()-init_start)+" seconds")